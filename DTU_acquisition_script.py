@@ -12,6 +12,12 @@ import os
 from time import sleep
 import astropy
 from astropy.table import Table, Column, MaskedColumn
+from DTU_storage import ShotWriter, BackgroundWriter
+from DTU_pvs import PVAcquisition, SHOT_PVS, SETTING_PVS, OPTIONAL_PVS, FRAME_SHAPE_PVS, frame_shapes
+from DTU_fitting import fit_run
+from DTU_scheduler import ShotScheduler
+from DTU_reduction import FrameReducer
+import metrics
 
 '''
 Created on 26 Sep 2017
@@ -27,25 +33,21 @@ TIMESTAMP = time.strftime("%H:%M:%S")
 FILENAME = 'HV10_run_780nm-' + TIMESTAMP + '.hdf5'
 
 
-def twoD_Gaussian(X, amplitude, xo, yo, sigma_x, sigma_y, theta, offset):
-    x, y = X
-    xo = float(xo)
-    yo = float(yo)
-    a = (np.cos(theta)**2)/(2*sigma_x**2) + (np.sin(theta)**2)/(2*sigma_y**2)
-    b = -(np.sin(2*theta))/(4*sigma_x**2) + (np.sin(2*theta))/(4*sigma_y**2)
-    c = (np.sin(theta)**2)/(2*sigma_x**2) + (np.cos(theta)**2)/(2*sigma_y**2)
-    g = offset + amplitude*np.exp( - (a*((x-xo)**2) + 2*b*(x-xo)*(y-yo)+ c*((y-yo)**2)))
-    return g.ravel()
-
-
-def main():
-    # define the time interval between shots
-    minute = 5 # 60s / 3
-    N_minutes = 1
-    # delta_T in s 	
-    delta_T = N_minutes * minute
-    # number of shots in 8h shift
-    NN = 20
+def main(delta_T=5, NN=20, shift=None, max_pending=4, keep_every=10, change=0.1, pv_class=PV, shapes=None, timeout=10):
+    '''
+    takes a shot every delta_T s, NN of them or, given shift (in s), as
+    many as fit in the shift (8 h at 5 s is 5760)
+    camera frames are stored reduced (see DTU_reduction), whole only every
+    keep_every shots or when their profiles have changed by change
+    shapes ({'dataset_cam': (rows, columns), 'dataset_camROI': ...}) stands
+    in for the frame size PVs if the IOC doesn't serve them
+    pv_class=fakePV.dtuServer().PV runs it without the IOC, timeout is how
+    long (in s) to wait for each PV
+    '''
+    if shift is not None:
+        schedule = ShotScheduler.for_shift(delta_T, shift)
+    else:
+        schedule = ShotScheduler(delta_T, NN)
     
     spectr_100=[]
     spectr_200=[]
@@ -57,82 +59,118 @@ def main():
     # save_spectrum_CCS100 = PV('CCS1:HDF1:WriteFile')
     # save_spectrum_CCS200 = PV('CCS2:HDF1:WriteFile')
 
-    get_image = PV('CAM1:image1:ArrayData')
-    get_image_ROI = PV('CAM1:image2:ArrayData')
-    
-    get_CCS200_spectr = PV('CCS1:trace1:ArrayData')
-    get_CCS200_wavel = PV('CCS1:det1:TlWavelengthData_RBV')
-
-
-    get_CCS100_spectr = PV('CCS2:trace1:ArrayData')
-    get_CCS100_wavel = PV('CCS2:det1:TlWavelengthData_RBV')
-
-    get_CCS200_acq_time = PV('CCS1:det1:AcquireTime_RBV')
-    get_CCS100_acq_time = PV('CCS2:det1:AcquireTime_RBV')
-  
-    get_cam_acq_time = PV('CAM1:det1:AcquireTime_RBV')
-    get_cam_gain = PV('CAM1:det1:Gain_RBV')
+    pvs = PVAcquisition(SHOT_PVS, SETTING_PVS, timeout=timeout, pv_class=pv_class, optional=OPTIONAL_PVS)
+    # before the first shot, rather than at it
+    shapes = shapes or {}
+    unserved = [SETTING_PVS[label] for (name, labels) in FRAME_SHAPE_PVS.items() for label in labels
+                if label in pvs.missing and shapes.get(name) is None]
+    if unserved:
+        pvs.close()
+        raise ValueError('the IOC serves no {}, give the frame shapes (--cam-shape, --roi-shape) instead'.format(', '.join(unserved)))
 
 
     logging.info('Configured and started')
     
-    f=h5py.File(FILENAME,'w')
-    f.attrs['file_name']        = FILENAME
-    f.attrs['file_time']        = TIMESTAMP
-    f.attrs['HDF5_Version']     = h5py.version.hdf5_version
-
-    for ii in range (0, NN):
+    # one file kept open for the run, each shot appended along the first axis
+    # (readable while we go, see DTU_storage.open_live), the settings are
+    # stored once per distinct value rather than once per shot
+    writer = ShotWriter(FILENAME, attrs={'file_name': FILENAME,
+                                         'file_time': TIMESTAMP,
+                                         'HDF5_Version': h5py.version.hdf5_version,
+                                         'delta_T': delta_T},
+                        dedup=SETTING_PVS, sparse=['dataset_cam', 'dataset_camROI'])
+    reducer = FrameReducer(['dataset_cam', 'dataset_camROI'], keep_every=keep_every, change=change)
+    # written in the background so the disk never holds up the next shot
+    writer = BackgroundWriter(writer, max_pending=max_pending)
+
+    for (ii, due) in schedule:
 
-        if ii>0:
-            f=h5py.File(FILENAME,'a')
         print('iteration # = ', ii)
-        print("acquisition of the image + ROI ")
-        my_grp=f.create_group(str(ii))
+        print("acquisition of the image + ROI + spectra")
                 
         # save_image.put(1)
         # save_image_ROI.put(1)
-        image_0 = get_image.get(timeout=10)
-        image_0_ROI = get_image_ROI.get(timeout=10)
-
-        time_cam = get_cam_acq_time.get(timeout=10)
-        gain_cam = get_cam_gain.get(timeout=10)
-
-
-        # save spectra
-        print("acquisition of spectra ")
         #save_spectrum_CCS100.put(1)
         #save_spectrum_CCS200.put(1)
-        spectr_200 = get_CCS200_spectr.get(timeout=10)
-        spectr_100 = get_CCS100_spectr.get(timeout=10)
-        print(spectr_100.shape)
-
-        wavelength_200 = get_CCS200_wavel.get(timeout=10)
-        wavelength_100 = get_CCS100_wavel.get(timeout=10)
-
-        time_200 = get_CCS200_acq_time.get(timeout=10)
-        time_100 = get_CCS100_acq_time.get(timeout=10)
-
-        print(spectr_100)
-        my_grp.create_dataset('dataset_spectr100', data=spectr_100)
-        my_grp.create_dataset('dataset_spectr200', data=spectr_200)
-        my_grp.create_dataset('dataset_cam', data=image_0)
-        my_grp.create_dataset('dataset_camROI', data=image_0_ROI)
-        my_grp.create_dataset('dataset_camTime', data=time_cam)
-        my_grp.create_dataset('dataset_camGain', data=gain_cam)
-        my_grp.create_dataset('dataset_spectr100Time', data=time_100)
-        my_grp.create_dataset('dataset_spectr200Time', data=time_200)
-        my_grp.create_dataset('dataset_wavelength_200', data=wavelength_200)
-        my_grp.create_dataset('dataset_wavelength_100', data=wavelength_100)
-
-        #
-        f.close() 
-        sleep(1)
+        (shot, timestamps) = pvs.snapshot()
+        print(shot['dataset_spectr100'].shape)
+        print(shot['dataset_spectr100'])
+
+        # with the EPICS time stamp of each value
+        shot.update({name + '_timestamp': timestamps[name] for name in timestamps})
+        shot['shot_number'] = ii
+        writer.append(reducer.reduce(shot, frame_shapes(shot, shapes)))
 
         print("acquire image")
         logging.info('new image acquired')
 
-        print('pause', delta_T, 's')
-        sleep(delta_T)
+    writer.close()
+    pvs.close()
+    stats = schedule.stats()
+    logging.info('%(taken)d shots taken, %(missed)d missed, started up to %(max_late).3f s late', stats)
+    logging.info('%.1f s writing, %.1f s of it held up acquisition', writer.write_time, writer.blocked_time)
+    logging.info('whole frames kept: %s of %d shots', reducer.n_kept, reducer.n_shots)
+    if stats['missed']:
+        print(stats['missed'], 'shots missed, the shots take longer than delta_T =', delta_T, 's')
+
+    # beam spot parameters for the kept frames, stored next to them as fit_*
+    fits = fit_run(FILENAME, output=FILENAME)
+    logging.info('beam spot fitted in %d of %d shots', fits['success'].sum(), len(fits))
+    if metrics.enabled:
+        logging.info('where the time went:\n%s', metrics.report())
+
+def check():
+    '''
+    runs against fakePV with the frame size PVs missing until a few shots
+    in, every shot has to be stored all the same
+    '''
+    import tempfile
+    import threading
+    import fakePV
+    server = fakePV.dtuServer()
+    sizes = {SETTING_PVS[label]: server.values.pop(SETTING_PVS[label])[0] for label in OPTIONAL_PVS}
+    shapes = {'dataset_cam': (480, 640), 'dataset_camROI': (240, 320)}
+    connect = threading.Timer(1.5, lambda: [server.set(name, value) for (name, value) in sizes.items()])
+    os.chdir(tempfile.mkdtemp())
+    connect.start()
+    main(delta_T=0.25, NN=12, pv_class=server.PV, shapes=shapes, timeout=0.5)
+    connect.join()
+    with h5py.File(FILENAME, 'r') as f:
+        assert len(f['shot_number']) == 12, 'not every shot was stored'
+        stamps = f['dataset_camWidth_timestamp'][:]
+        assert np.isnan(stamps[0]) and np.isfinite(stamps[-1]), 'the frame sizes never turned up: {}'.format(stamps)
+    print('ok: frame size PVs connected at shot', int(np.isnan(stamps).sum()), 'of 12, all stored in', os.path.abspath(FILENAME))
 
 if __name__ == '__main__':
-    main()
+    import argparse
+    parser = argparse.ArgumentParser(description='Records DTU camera images and spectra at a fixed interval')
+    parser.add_argument('--delta-T', type=float, default=5, help='seconds between shots')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--shots', type=int, default=20, help='number of shots')
+    group.add_argument('--shift', type=float, help='hours to run for instead of a number of shots')
+    parser.add_argument('--keep-every', type=int, default=10, help='store the whole camera frames every this many shots')
+    parser.add_argument('--change', type=float, default=0.1, help='also store them when their profiles change by this fraction')
+    parser.add_argument('--cam-shape', type=int, nargs=2, metavar=('ROWS', 'COLUMNS'), help='camera frame size, if the IOC has no CAM1:image1:ArraySize PVs')
+    parser.add_argument('--roi-shape', type=int, nargs=2, metavar=('ROWS', 'COLUMNS'), help='ROI frame size, if the IOC has no CAM1:image2:ArraySize PVs')
+    parser.add_argument('--fake', action='store_true', help='read a simulated IOC (fakePV.dtuServer) instead of the real one')
+    parser.add_argument('--check', action='store_true', help='check a short simulated run in a temporary directory, the frame size PVs connecting part way through')
+    parser.add_argument('--metrics', help='time PV reads, frame reduction and HDF5 writes, with snapshots appended to this file every minute')
+    parser.add_argument('--metrics-port', type=int, help='also serve them at http://127.0.0.1:<port>/metrics (and /report)')
+    args = parser.parse_args()
+    if args.check:
+        check()
+        sys.exit()
+    exporter = None
+    if args.metrics is not None or args.metrics_port is not None:
+        metrics.enable()
+        exporter = metrics.Exporter(args.metrics, interval=60, port=args.metrics_port)
+    if args.fake:
+        import fakePV
+        pv_class = fakePV.dtuServer().PV
+    else:
+        pv_class = PV
+    main(delta_T=args.delta_T, NN=args.shots, shift=None if args.shift is None else args.shift*3600,
+         keep_every=args.keep_every, change=args.change, pv_class=pv_class,
+         shapes={'dataset_cam': args.cam_shape, 'dataset_camROI': args.roi_shape})
+    if exporter is not None:
+        exporter.stop()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+'''
+2-D Gaussian beam spot fitting for the DTU camera images.
+
+Each image gets moment based starting values, is cropped to a box around
+the spot and binned down to at most max_size pixels a side, then fitted
+with twoD_Gaussian and its analytic Jacobian. A run's images are shared
+out to a process pool, each worker reading its own shots from the file:
+
+    fits = fit_run(FILENAME, shape=(480, 640), output=FILENAME)
+
+or from the shell
+    python DTU_fitting.py run.hdf5 480 640
+'''
+import sys
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy.optimize as opt
+import h5py
+from DTU_storage import open_live
+
+PARAMS = ('amplitude', 'xo', 'yo', 'sigma_x', 'sigma_y', 'theta', 'offset')
+FIT_DTYPE = np.dtype([(p, 'f8') for p in PARAMS] + [(p + '_err', 'f8') for p in PARAMS] + [('success', '?')])
+
+
+def twoD_Gaussian(X, amplitude, xo, yo, sigma_x, sigma_y, theta, offset):
+    x, y = X
+    xo = float(xo)
+    yo = float(yo)
+    a = (np.cos(theta)**2)/(2*sigma_x**2) + (np.sin(theta)**2)/(2*sigma_y**2)
+    b = -(np.sin(2*theta))/(4*sigma_x**2) + (np.sin(2*theta))/(4*sigma_y**2)
+    c = (np.sin(theta)**2)/(2*sigma_x**2) + (np.cos(theta)**2)/(2*sigma_y**2)
+    g = offset + amplitude*np.exp( - (a*((x-xo)**2) + 2*b*(x-xo)*(y-yo)+ c*((y-yo)**2)))
+    return g.ravel()
+
+
+def twoD_Gaussian_jacobian(X, amplitude, xo, yo, sigma_x, sigma_y, theta, offset):
+    '''derivatives of twoD_Gaussian by each parameter, one column each'''
+    x, y = X
+    dx = np.ravel(x) - xo
+    dy = np.ravel(y) - yo
+    cos, sin = np.cos(theta), np.sin(theta)
+    sin2, cos2 = np.sin(2*theta), np.cos(2*theta)
+    a = cos**2/(2*sigma_x**2) + sin**2/(2*sigma_y**2)
+    b = -sin2/(4*sigma_x**2) + sin2/(4*sigma_y**2)
+    c = sin**2/(2*sigma_x**2) + cos**2/(2*sigma_y**2)
+    e = np.exp(-(a*dx**2 + 2*b*dx*dy + c*dy**2))
+    ae = amplitude*e
+    # d(quadratic form)/d parameter for a, b, c in turn
+    quad = lambda da, db, dc: da*dx**2 + 2*db*dx*dy + dc*dy**2
+    sx3, sy3 = sigma_x**3, sigma_y**3
+    dtheta = 1/(2*sigma_y**2) - 1/(2*sigma_x**2)
+    jac = np.empty((dx.size, 7))
+    jac[:, 0] = e
+    jac[:, 1] = ae*(2*a*dx + 2*b*dy)
+    jac[:, 2] = ae*(2*b*dx + 2*c*dy)
+    jac[:, 3] = -ae*quad(-cos**2/sx3, sin2/(2*sx3), -sin**2/sx3)
+    jac[:, 4] = -ae*quad(-sin**2/sy3, -sin2/(2*sy3), -cos**2/sy3)
+    jac[:, 5] = -ae*quad(sin2*dtheta, cos2*dtheta, -sin2*dtheta)
+    jac[:, 6] = 1.0
+    return jac
+
+
+def moments_guess(image, x, y, level=0.2):
+    '''
+    amplitude, centroid, sigmas, theta and offset from the image moments
+    only what's more than level of the peak above the background counts, so
+    the noise over the rest of the frame doesn't widen the spot; the moments
+    of a gaussian cut off like that are scaled back to sigma by _cut_moment
+    '''
+    offset = np.median(image)
+    amplitude = image.max() - offset
+    w = np.clip(image - offset - level*amplitude, 0, None)
+    total = w.sum()
+    if total <= 0:
+        return (0.0, x.mean(), y.mean(), 1.0, 1.0, 0.0, offset)
+    xo = (w*x).sum()/total
+    yo = (w*y).sum()/total
+    cxx = (w*(x - xo)**2).sum()/total
+    cyy = (w*(y - yo)**2).sum()/total
+    cxy = (w*(x - xo)*(y - yo)).sum()/total
+    # principal axes of the covariance, twoD_Gaussian's theta turns the other way
+    theta = -0.5*np.arctan2(2*cxy, cxx - cyy)
+    (l1, l2) = np.linalg.eigvalsh([[cxx, cxy], [cxy, cyy]])[::-1]
+    k = _cut_moment(level)
+    sigma_x = np.sqrt(max(l1/k, 0.25))
+    sigma_y = np.sqrt(max(l2/k, 0.25))
+    return (amplitude, xo, yo, sigma_x, sigma_y, theta, offset)
+
+
+def _cut_moment(level):
+    '''second moment along an axis, in sigma**2, of a gaussian weighted by its height above level of the peak'''
+    r2 = -2*np.log(level)
+    return (2 - (r2 + 2)*level - level*r2**2/4)/(2*(1 - level + level*np.log(level)))
+
+
+def crop_and_bin(image, guess, n_sigma=4, max_size=64):
+    '''
+    cuts out the n_sigma box around the guessed spot and bins it to at most
+    max_size pixels a side, returns (data, x, y) with x, y the bin centres in
+    pixels of the full image
+    '''
+    (amplitude, xo, yo, sigma_x, sigma_y, theta, offset) = guess
+    half = n_sigma*max(sigma_x, sigma_y)
+    (ny, nx) = image.shape
+    x0 = int(np.clip(np.floor(xo - half), 0, nx - 1))
+    x1 = int(np.clip(np.ceil(xo + half) + 1, x0 + 1, nx))
+    y0 = int(np.clip(np.floor(yo - half), 0, ny - 1))
+    y1 = int(np.clip(np.ceil(yo + half) + 1, y0 + 1, ny))
+    roi = image[y0:y1, x0:x1]
+    k = max(1, int(np.ceil(max(roi.shape)/max_size)))
+    (h, w) = (roi.shape[0]//k*k, roi.shape[1]//k*k)
+    if min(h, w) == 0:
+        k = 1
+        (h, w) = roi.shape
+    data = roi[:h, :w].reshape(h//k, k, w//k, k).mean(axis=(1, 3))
+    xs = x0 + np.arange(w//k)*k + (k - 1)/2
+    ys = y0 + np.arange(h//k)*k + (k - 1)/2
+    (x, y) = np.meshgrid(xs, ys)
+    return (data, x, y)
+
+
+def fit_image(image, n_sigma=4, max_size=64):
+    '''fits one 2-D image, returns a FIT_DTYPE record'''
+    image = np.asarray(image, dtype=float)
+    (y, x) = np.indices(image.shape)
+    guess = moments_guess(image, x, y)
+    (data, x, y) = crop_and_bin(image, guess, n_sigma, max_size)
+    result = np.zeros((), dtype=FIT_DTYPE)
+    try:
+        (popt, pcov) = opt.curve_fit(twoD_Gaussian, (x, y), data.ravel(), p0=guess,
+                                     jac=twoD_Gaussian_jacobian, maxfev=2000)
+        perr = np.sqrt(np.abs(np.diag(pcov)))
+        result['success'] = np.all(np.isfinite(popt))
+    except (RuntimeError, ValueError, opt.OptimizeWarning):
+        (popt, perr) = (np.array(guess, dtype=float), np.full(7, np.nan))
+        result['success'] = False
+    # one way round: sigma_x the larger, theta in [-pi/2, pi/2)
+    popt[3:5] = np.abs(popt[3:5])
+    if popt[3] < popt[4]:
+        popt[[3, 4]] = popt[[4, 3]]
+        perr[[3, 4]] = perr[[4, 3]]
+        popt[5] = popt[5] + np.pi/2
+    popt[5] = (popt[5] + np.pi/2) % np.pi - np.pi/2
+    for (i, p) in enumerate(PARAMS):
+        result[p] = popt[i]
+        result[p + '_err'] = perr[i]
+    return result
+
+
+def fit_images(images, **kwargs):
+    '''fits a stack of images in this process, returns a FIT_DTYPE array'''
+    return np.array([fit_image(image, **kwargs) for image in images], dtype=FIT_DTYPE)
+
+
+def _fit_shots(args):
+    '''worker: fits the given shots of a run file'''
+    (filename, dataset, shots, shape, kwargs) = args
+    with open_live(filename) as f:
+        images = f[dataset][shots]
+    if shape is not None:
+        images = images.reshape((len(images),) + tuple(shape))
+    return fit_images(images, **kwargs)
+
+
+def fit_run(filename, shape=None, dataset='dataset_cam', processes=None, shots_per_task=16, output=None, **kwargs):
+    '''
+    fits every image of a DTU_storage run file across a process pool
+    shape is (rows, columns) when the images were stored flat (as
+    areaDetector's ArrayData is), the results are returned and if output
+    is given also written there as one fit_<parameter> dataset each
+    when only some shots kept their image (DTU_reduction) only those are
+    fitted, the rest get NaN and success False
+    '''
+    with open_live(filename) as f:
+        n_shots = len(f[dataset])
+        stored = f[dataset].stored() if hasattr(f[dataset], 'stored') else np.arange(n_shots)
+    tasks = [(filename, dataset, stored[start:start + shots_per_task], shape, kwargs)
+             for start in range(0, len(stored), shots_per_task)]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        parts = list(pool.map(_fit_shots, tasks))
+    fits = np.zeros(n_shots, dtype=FIT_DTYPE)
+    for name in PARAMS:
+        fits[name] = np.nan
+        fits[name + '_err'] = np.nan
+    if parts:
+        fits[stored] = np.concatenate(parts)
+    if output is not None:
+        with h5py.File(output, 'a') as f:
+            for name in FIT_DTYPE.names:
+                key = 'fit_' + name
+                if key in f:
+                    del f[key]
+                f.create_dataset(key, data=fits[name])
+    return fits
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 4):
+        print('usage: {} run.hdf5 [rows columns]'.format(sys.argv[0]))
+        sys.exit(1)
+    shape = tuple(int(n) for n in sys.argv[2:4]) or None
+    fits = fit_run(sys.argv[1], shape=shape, output=os.path.splitext(sys.argv[1])[0] + '_fits.hdf5')
+    print('fitted', len(fits), 'images,', int(fits['success'].sum()), 'converged')
@@ -0,0 +1,146 @@
+'''
+Concurrent EPICS PV acquisition for the DTU runs.
+
+Per-shot PVs (camera images, spectra) are read all at once from a thread
+pool, so a shot costs one round trip instead of one per PV and the camera
+and spectrometer snapshots are taken close together. Slowly changing PVs
+(wavelength calibrations, acquire times, gain) are read once and then kept
+up to date by CA monitors, so they only cross the network when they change.
+Every value comes with its EPICS timestamp.
+
+pv_class can be swapped for a stand-in with the pyepics PV interface, such
+as fakePV.FakePVServer().PV, to run without an IOC.
+'''
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import epics
+from epics import PV
+import metrics
+
+# what the DTU runs read: labels (dataset names) -> PV names
+# every shot, all at once
+SHOT_PVS = {'dataset_cam': 'CAM1:image1:ArrayData',
+            'dataset_camROI': 'CAM1:image2:ArrayData',
+            'dataset_spectr200': 'CCS1:trace1:ArrayData',
+            'dataset_spectr100': 'CCS2:trace1:ArrayData'}
+# hardly ever change, kept up to date by monitors
+SETTING_PVS = {'dataset_wavelength_200': 'CCS1:det1:TlWavelengthData_RBV',
+               'dataset_wavelength_100': 'CCS2:det1:TlWavelengthData_RBV',
+               'dataset_spectr200Time': 'CCS1:det1:AcquireTime_RBV',
+               'dataset_spectr100Time': 'CCS2:det1:AcquireTime_RBV',
+               'dataset_camTime': 'CAM1:det1:AcquireTime_RBV',
+               'dataset_camGain': 'CAM1:det1:Gain_RBV',
+               'dataset_camWidth': 'CAM1:image1:ArraySize0_RBV',
+               'dataset_camHeight': 'CAM1:image1:ArraySize1_RBV',
+               'dataset_camROIWidth': 'CAM1:image2:ArraySize0_RBV',
+               'dataset_camROIHeight': 'CAM1:image2:ArraySize1_RBV'}
+# the frames' (rows, columns) labels, their PVs are optional (see frame_shapes)
+FRAME_SHAPE_PVS = {'dataset_cam': ('dataset_camHeight', 'dataset_camWidth'),
+                   'dataset_camROI': ('dataset_camROIHeight', 'dataset_camROIWidth')}
+OPTIONAL_PVS = tuple(label for labels in FRAME_SHAPE_PVS.values() for label in labels)
+
+
+def frame_shapes(shot, fallback=None):
+    '''
+    (rows, columns) of each frame in FRAME_SHAPE_PVS, from the shot's
+    ArraySize PVs or, where the IOC doesn't serve them, from fallback
+    (name -> shape), which is then put in the shot so every shot stores its
+    frame sizes; raises ValueError naming what's missing if neither has it
+    '''
+    fallback = fallback or {}
+    shapes = {}
+    for (name, labels) in FRAME_SHAPE_PVS.items():
+        if all(shot.get(label) is not None for label in labels):
+            shapes[name] = tuple(int(shot[label]) for label in labels)
+        elif fallback.get(name) is not None:
+            shapes[name] = tuple(int(n) for n in fallback[name])
+            shot.update(zip(labels, shapes[name]))
+        else:
+            missing = [SETTING_PVS[label] for label in labels if shot.get(label) is None]
+            raise ValueError('the IOC serves no {} so the shape of {} has to be given'.format(' or '.join(missing), name))
+    return shapes
+
+
+class PVAcquisition:
+    '''
+    fast_pvs and slow_pvs map labels to PV names, snapshot() returns
+    values and timestamps keyed by those labels
+    slow PVs labelled in optional may be missing from the IOC, their values
+    are left out of the snapshots (and they're listed in missing) until they
+    first turn up, their timestamps are NaN meanwhile so every snapshot has
+    the same timestamp labels
+    '''
+    def __init__(self, fast_pvs, slow_pvs, timeout=10, pv_class=PV, optional=()):
+        self.timeout = timeout
+        self.missing = set() # optional labels with no value yet
+        self.lock = threading.Lock()
+        self.cache = {} # label -> (value, timestamp) for the monitored PVs
+        self.n_updates = {label: 0 for label in slow_pvs} # monitor events seen per label
+        self.labels = {name: label for (label, name) in slow_pvs.items()}
+        # pool threads have to share our channel access context
+        initializer = epics.ca.use_initial_context if pv_class is PV else None
+        self.pool = ThreadPoolExecutor(max_workers=max(len(fast_pvs), len(slow_pvs), 1), initializer=initializer)
+
+        # big arrays aren't monitored, they're read when a shot is taken
+        self.fast = {label: pv_class(name, auto_monitor=False) for (label, name) in fast_pvs.items()}
+        self.slow = {label: pv_class(name, auto_monitor=True) for (label, name) in slow_pvs.items()}
+        for pv in self.slow.values():
+            pv.add_callback(self._on_change)
+        # first values for the monitored ones, unless a monitor got there first
+        futures = {label: self.pool.submit(self._get, label, pv) for (label, pv) in self.slow.items()}
+        for (label, future) in futures.items():
+            try:
+                (value, timestamp) = future.result()
+            except TimeoutError as e:
+                if label not in optional:
+                    raise
+                logging.warning('%s, carrying on without it', e)
+                with self.lock:
+                    if label not in self.cache:
+                        self.missing.add(label)
+                continue
+            with self.lock:
+                if label not in self.cache:
+                    self.cache[label] = (value, timestamp)
+
+    def _on_change(self, pvname=None, value=None, timestamp=None, **kw):
+        '''monitor callback, runs in a channel access thread'''
+        label = self.labels[pvname]
+        with self.lock:
+            self.cache[label] = (value, timestamp)
+            self.n_updates[label] = self.n_updates[label] + 1
+            self.missing.discard(label)
+        metrics.count('dtu.pvMonitorEvents')
+
+    def _get(self, label, pv):
+        with metrics.timer('dtu.pvGet ' + label):
+            data = pv.get_with_metadata(timeout=self.timeout, use_monitor=False, form='time')
+        if data is None:
+            metrics.count('dtu.pvTimeouts')
+            raise TimeoutError('no reply from {} ({}) within {} s'.format(pv.pvname, label, self.timeout))
+        return (data['value'], data['timestamp'])
+
+    def _get_all(self, pvs):
+        '''reads every PV in pvs at the same time, returns label -> (value, timestamp)'''
+        futures = {label: self.pool.submit(self._get, label, pv) for (label, pv) in pvs.items()}
+        return {label: future.result() for (label, future) in futures.items()}
+
+    def snapshot(self):
+        '''
+        reads all the per-shot PVs concurrently and adds the cached slow ones,
+        returns (values, timestamps), both dicts keyed by label
+        '''
+        with metrics.timer('dtu.snapshot'):
+            readings = self._get_all(self.fast)
+        with self.lock:
+            readings.update(self.cache)
+        values = {label: value for (label, (value, timestamp)) in readings.items()}
+        timestamps = {label: timestamp for (label, (value, timestamp)) in readings.items()}
+        timestamps.update((label, float('nan')) for label in self.slow if label not in timestamps)
+        return (values, timestamps)
+
+    def close(self):
+        for pv in list(self.fast.values()) + list(self.slow.values()):
+            pv.disconnect()
+        self.pool.shutdown()
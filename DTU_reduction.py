@@ -0,0 +1,118 @@
+'''
+Online reduction of the DTU camera frames.
+
+Most shots only need the beam's profiles and totals, so each frame is cut
+down to its x and y projections, integrated intensity, centroid and second
+moments, and the frame itself is only kept every keep_every shots or when
+its profiles have changed by more than change since the last kept one.
+Kept frames go to a ShotWriter as sparse quantities (compressed, one frame
+per chunk), the rest of the shots store None for them.
+'''
+import numpy as np
+import metrics
+
+REDUCTIONS = ('proj_x', 'proj_y', 'total', 'background', 'centroid_x', 'centroid_y', 'var_x', 'var_y', 'cov_xy')
+
+
+def _moments(weights, x, y):
+    '''centroid, variances and covariance of a stack of weight images'''
+    wx = weights.sum(axis=-2)
+    wy = weights.sum(axis=-1)
+    total = wx.sum(axis=-1)
+    centroid_x = wx @ x/total
+    centroid_y = wy @ y/total
+    dx = x - centroid_x[..., None]
+    dy = y - centroid_y[..., None]
+    var_x = (wx*dx**2).sum(axis=-1)/total
+    var_y = (wy*dy**2).sum(axis=-1)/total
+    cov_xy = np.einsum('...i,...ij,...j->...', dy, weights, dx)/total
+    return (centroid_x, centroid_y, var_x, var_y, cov_xy)
+
+
+def _span(inside):
+    '''first and one past the last index that's inside in any of the stack'''
+    hits = np.flatnonzero(inside.reshape(-1, inside.shape[-1]).any(axis=0))
+    return (hits[0], hits[-1] + 1) if len(hits) else (0, 0)
+
+
+def reduce_frames(frames, window=4, iterations=3):
+    '''
+    reduces a frame, or a stack of them (..., rows, columns), returns a dict
+    of REDUCTIONS with the stack's leading shape, positions in pixels
+    background is the mean of the edge pixels and is taken off everything;
+    the centroid and moments are taken within window sigmas of the
+    centroid, found in a few iterations starting from the pixels well above
+    the noise, as the noise summed over the whole frame would swamp them
+    '''
+    frames = np.asarray(frames)
+    (ny, nx) = frames.shape[-2:]
+    edge = np.concatenate([frames[..., 0, :], frames[..., -1, :], frames[..., 1:-1, 0], frames[..., 1:-1, -1]], axis=-1)
+    background = edge.mean(axis=-1)
+    noise = edge.std(axis=-1)
+    signal = frames - background[..., None, None]
+    proj_x = signal.sum(axis=-2)
+    proj_y = signal.sum(axis=-1)
+    x = np.arange(nx, dtype=float)
+    y = np.arange(ny, dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        moments = _moments(np.where(signal > 5*noise[..., None, None], signal, 0), x, y)
+        for i in range(iterations):
+            (centroid_x, centroid_y, var_x, var_y, cov_xy) = moments
+            inside_x = np.abs(x - centroid_x[..., None]) <= window*np.sqrt(var_x)[..., None]
+            inside_y = np.abs(y - centroid_y[..., None]) <= window*np.sqrt(var_y)[..., None]
+            # only the box round every frame's window needs looking at
+            (x0, x1) = _span(inside_x)
+            (y0, y1) = _span(inside_y)
+            inside = inside_y[..., y0:y1, None] & inside_x[..., None, x0:x1]
+            moments = _moments(signal[..., y0:y1, x0:x1]*inside, x[x0:x1], y[y0:y1])
+    (centroid_x, centroid_y, var_x, var_y, cov_xy) = moments
+    return {'proj_x': proj_x, 'proj_y': proj_y, 'total': proj_x.sum(axis=-1), 'background': background,
+            'centroid_x': centroid_x, 'centroid_y': centroid_y,
+            'var_x': var_x, 'var_y': var_y, 'cov_xy': cov_xy}
+
+
+def profile_change(proj_x, proj_y, kept_x, kept_y):
+    '''fraction of the kept frame's profiles that has moved, 0 same to 2 nothing in common'''
+    with np.errstate(invalid='ignore', divide='ignore'):
+        change = 0.5*(np.abs(proj_x - kept_x).sum()/np.abs(kept_x).sum()
+                      + np.abs(proj_y - kept_y).sum()/np.abs(kept_y).sum())
+    return change if np.isfinite(change) else np.inf
+
+
+class FrameReducer:
+    '''
+    reduces the frames named in names as shots go by, reduce() adds
+    <name>_<reduction> for each of REDUCTIONS to the shot and leaves the
+    frame in it (as rows x columns) only when it's to be kept, else None
+    '''
+    def __init__(self, names, keep_every=10, change=0.1):
+        self.names = list(names)
+        self.keep_every = keep_every
+        self.change = change
+        self.kept_profiles = {} # name -> projections of the last kept frame
+        self.n_shots = 0
+        self.n_kept = {name: 0 for name in self.names}
+
+    def reduce(self, shot, shapes):
+        '''
+        reduces shot's frames in place and returns it, shapes gives each
+        name's (rows, columns) as flat areaDetector arrays don't carry it
+        '''
+        for name in self.names:
+            frame = np.asarray(shot[name]).reshape(shapes[name])
+            with metrics.timer('dtu.frameReduction'):
+                reduced = reduce_frames(frame)
+            for key in REDUCTIONS:
+                shot[name + '_' + key] = reduced[key]
+            kept = self.kept_profiles.get(name)
+            keep = (kept is None or self.n_shots % self.keep_every == 0
+                    or profile_change(reduced['proj_x'], reduced['proj_y'], *kept) > self.change)
+            if keep:
+                self.kept_profiles[name] = (reduced['proj_x'], reduced['proj_y'])
+                self.n_kept[name] = self.n_kept[name] + 1
+                metrics.count('dtu.framesKept')
+                shot[name] = frame
+            else:
+                shot[name] = None
+        self.n_shots = self.n_shots + 1
+        return shot
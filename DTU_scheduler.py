@@ -0,0 +1,74 @@
+'''
+Shot timing for the DTU runs.
+
+Shots are due at fixed times, start + n*period, rather than a sleep after
+each one, so however long a shot takes the run doesn't drift. A shot that
+can't start until its successor is already due is counted as missed and
+skipped, rather than firing a burst of late shots to catch up:
+
+    schedule = ShotScheduler(period=5, n_shots=5760)
+    for (ii, due) in schedule:
+        take_shot()
+    print(schedule.stats())
+'''
+import time
+import metrics
+
+
+class ShotScheduler:
+    '''
+    iterating gives (shot number, time it was due) for each shot, waiting
+    until it's due; n_shots=None goes on for ever
+    time is time.monotonic(), start defaults to the first iteration
+    '''
+    def __init__(self, period, n_shots=None, start=None, clock=time.monotonic, sleep=time.sleep):
+        if period <= 0:
+            raise ValueError('period must be positive, not {}'.format(period))
+        self.period = period
+        self.n_shots = n_shots
+        self.start = start
+        self.clock = clock
+        self.sleep = sleep
+        self.taken = 0
+        self.missed = 0
+        self.max_late = 0.0
+        self.total_late = 0.0
+
+    @classmethod
+    def for_shift(cls, period, shift, **kwargs):
+        '''as many shots as fit in shift seconds'''
+        return cls(period, n_shots=int(shift // period), **kwargs)
+
+    def __iter__(self):
+        if self.start is None:
+            self.start = self.clock()
+        n = 0
+        while self.n_shots is None or n < self.n_shots:
+            due = self.start + n*self.period
+            now = self.clock()
+            if now < due:
+                self.sleep(due - now)
+                now = self.clock()
+            elif now >= due + self.period:
+                # too late to take, the next one is due already
+                skipped = int((now - due) // self.period)
+                if self.n_shots is not None:
+                    skipped = min(skipped, self.n_shots - n)
+                self.missed = self.missed + skipped
+                metrics.count('dtu.shotsMissed', skipped)
+                n = n + skipped
+                continue
+            late = max(now - due, 0.0)
+            self.max_late = max(self.max_late, late)
+            self.total_late = self.total_late + late
+            metrics.observe('dtu.shotLateness', late)
+            self.taken = self.taken + 1
+            yield (n, due)
+            n = n + 1
+
+    def stats(self):
+        '''shots taken and missed, and how late the taken ones started'''
+        return {'taken': self.taken,
+                'missed': self.missed,
+                'mean_late': self.total_late/self.taken if self.taken else 0.0,
+                'max_late': self.max_late}
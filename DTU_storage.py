@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+'''
+Appendable single-file HDF5 storage for the DTU acquisition runs.
+
+Every quantity gets one dataset with the shots stacked along the first
+axis, created (chunked, optionally compressed) on the first shot and grown
+by one per shot after that. The file stays open for the whole run and is
+switched to SWMR so an analysis session can read it while the run goes on:
+
+    f = open_live(FILENAME)
+    f['dataset_cam'].refresh()
+    latest_image = f['dataset_cam'][-1]
+
+Quantities that hardly ever change (calibrations, settings) can be named in
+dedup: each distinct value is then stored once, in UNIQUE_GROUP, and the
+shots only hold an index into it. open_live resolves those indices, so
+f['dataset_wavelength_100'][-1] is the array either way. Quantities named
+in sparse are kept the same way for the shots that carry them (not None)
+and have index -1 in the rest, see DTU_reduction.
+
+Files written by the old one-group-per-shot layout are converted with
+    python DTU_storage.py old.hdf5 new.hdf5
+'''
+import sys
+import time
+import hashlib
+import queue
+import threading
+import h5py
+import numpy as np
+import metrics
+
+UNIQUE_GROUP = '_unique'
+
+
+class ShotWriter:
+    '''
+    Appends shots (dicts of name -> array or scalar) to filename.
+    All shots must carry the same names with the same shapes, as SWMR
+    doesn't allow new datasets once readers may be attached.
+    A shot_time dataset (unix time of each append) is added for free.
+    Names in dedup are stored by content and names in sparse only for the
+    shots that have them, see the module docstring. The first shot must
+    have every sparse quantity, for its shape.
+    '''
+    def __init__(self, filename, attrs=None, compression='gzip', compression_opts=1, shuffle=True, swmr=True, dedup=(), sparse=()):
+        self.filename = filename
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.shuffle = shuffle
+        self.swmr = swmr
+        self.dedup = set(dedup)
+        self.sparse = set(sparse)
+        self.digests = {name: {} for name in self.dedup} # name -> {content hash: index in its unique dataset}
+        self.unique = {} # name -> dataset of its distinct (or sparse) values
+        self.n_shots = 0
+        self.f = h5py.File(filename, 'w', libver='latest')
+        for (key, value) in (attrs or {}).items():
+            self.f.attrs[key] = value
+        self.datasets = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _create(self, shot):
+        '''makes the shot-stacked datasets from the first shot'''
+        self.datasets = {}
+        for (name, value) in shot.items():
+            if value is None:
+                raise ValueError('the first shot has no {}, so its shape is unknown'.format(name))
+            value = np.asarray(value)
+            if name in self.dedup or name in self.sparse:
+                # all of these have to exist before SWMR starts, so the
+                # values go in one growing dataset per name
+                self.unique[name] = self._stacked(UNIQUE_GROUP + '/' + name, value)
+                value = np.int32(0) if name in self.sparse else np.uint32(0)
+            self.datasets[name] = self._stacked(name, value)
+            if name in self.unique:
+                self.datasets[name].attrs['unique'] = self.unique[name].name
+                self.datasets[name].attrs['sparse'] = name in self.sparse
+        if self.swmr:
+            self.f.swmr_mode = True
+
+    def _stacked(self, name, value):
+        '''an empty dataset to stack values like value along the first axis'''
+        if value.ndim == 0:
+            # scalars: many shots per chunk, not worth compressing
+            chunks = (1024,)
+            compression = None
+        else:
+            # one shot per chunk so appending never rewrites old data
+            chunks = (1,) + value.shape
+            compression = self.compression
+        return self.f.create_dataset(
+            name, shape=(0,) + value.shape, maxshape=(None,) + value.shape, dtype=value.dtype,
+            chunks=chunks, compression=compression,
+            compression_opts=self.compression_opts if compression else None,
+            shuffle=bool(compression and self.shuffle))
+
+    def append(self, shot):
+        '''writes one shot and flushes it so SWMR readers can see it'''
+        shot = dict(shot)
+        shot['shot_time'] = time.time()
+        for name in self.sparse:
+            shot.setdefault(name, None)
+        if self.datasets is None:
+            self._create(shot)
+        if set(shot) != set(self.datasets):
+            raise ValueError('shot has datasets {} but the file has {}'.format(sorted(shot), sorted(self.datasets)))
+        with metrics.timer('dtu.hdf5Append'):
+            self._append(shot)
+        with metrics.timer('dtu.hdf5Flush'):
+            self.f.flush()
+        metrics.count('dtu.shotsWritten')
+
+    def _append(self, shot):
+        '''writes shot's values at the end of their datasets'''
+        for (name, value) in shot.items():
+            ds = self.datasets[name]
+            if name in self.sparse:
+                value = np.int32(-1 if value is None else self._store(name, np.asarray(value)))
+            elif name in self.unique:
+                value = self._unique_index(name, np.asarray(value))
+            value = np.asarray(value)
+            if value.shape != ds.shape[1:]:
+                raise ValueError('{} has shape {} but the file holds {}'.format(name, value.shape, ds.shape[1:]))
+            ds.resize(self.n_shots + 1, axis=0)
+            ds[self.n_shots] = value
+        self.n_shots = self.n_shots + 1
+
+    def _unique_index(self, name, value):
+        '''index of value among name's distinct values, storing it if it's new'''
+        value = np.asarray(value, order='C')
+        digest = hashlib.blake2b(value.tobytes(), digest_size=16)
+        digest.update(str((value.dtype.str, value.shape)).encode())
+        digest = digest.digest()
+        index = self.digests[name].get(digest)
+        if index is None:
+            index = self._store(name, value)
+            self.digests[name][digest] = index
+        return np.uint32(index)
+
+    def _store(self, name, value):
+        '''appends value to name's stored values, returns its index there'''
+        ds = self.unique[name]
+        if value.shape != ds.shape[1:]:
+            raise ValueError('{} has shape {} but the file holds {}'.format(name, value.shape, ds.shape[1:]))
+        index = ds.shape[0]
+        ds.resize(index + 1, axis=0)
+        ds[index] = value
+        return index
+
+    def close(self):
+        if self.f.id.valid:
+            self.f.close()
+
+
+class BackgroundWriter:
+    '''
+    hands shots to a ShotWriter in a thread of its own so the next shot can
+    be acquired while this one goes to disk
+    append() only blocks once max_pending shots are waiting (back-pressure
+    rather than an unbounded backlog), and an error from the writing thread
+    is raised from the next append() or close()
+    '''
+    def __init__(self, writer, max_pending=4):
+        self.writer = writer
+        self.pending = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.blocked_time = 0.0 # total time append() spent waiting for room
+        self.write_time = 0.0 # total time spent writing
+        self.thread = threading.Thread(target=self._writeLoop, name='shotWriter', daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _writeLoop(self):
+        while True:
+            shot = self.pending.get()
+            if shot is None:
+                return
+            if self.error is None:
+                t0 = time.perf_counter()
+                try:
+                    self.writer.append(shot)
+                except Exception as e:
+                    self.error = e
+                    metrics.count('dtu.writeErrors')
+                self.write_time = self.write_time + time.perf_counter() - t0
+
+    def _raise(self):
+        if self.error is not None:
+            raise RuntimeError('writing {} failed'.format(self.writer.filename)) from self.error
+
+    def append(self, shot):
+        self._raise()
+        t0 = time.perf_counter()
+        self.pending.put(shot)
+        blocked = time.perf_counter() - t0
+        self.blocked_time = self.blocked_time + blocked
+        metrics.observe('dtu.writerBackPressure', blocked)
+
+    def close(self):
+        '''writes what's still queued and closes the file'''
+        if self.thread.is_alive():
+            self.pending.put(None)
+            self.thread.join()
+        self.writer.close()
+        self._raise()
+
+
+class Deduplicated:
+    '''
+    a stored-once quantity as the shots see it: indexing it looks up the
+    shots' indices and returns the values they point to
+    '''
+    def __init__(self, index, unique):
+        self.index = index
+        self.unique = unique
+
+    @property
+    def shape(self):
+        return self.index.shape + self.unique.shape[1:]
+
+    @property
+    def dtype(self):
+        return self.unique.dtype
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, key):
+        # the index is 4 bytes a shot, read it all and let numpy do the indexing
+        indices = np.asarray(self.index[()][key])
+        # h5py wants increasing indices, and each distinct value only needs reading once
+        (wanted, inverse) = np.unique(indices, return_inverse=True)
+        return self.unique[wanted][inverse.reshape(indices.shape)]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[()], dtype=dtype)
+
+    def refresh(self):
+        self.index.refresh()
+        self.unique.refresh()
+
+
+class Sparse(Deduplicated):
+    '''
+    a quantity only some shots have: indexing a shot without one is a
+    KeyError, stored() says which shots to ask for
+    '''
+    def stored(self):
+        '''numbers of the shots that have a value'''
+        return np.flatnonzero(self.index[()] >= 0)
+
+    def __getitem__(self, key):
+        indices = np.asarray(self.index[()][key])
+        if np.any(indices < 0):
+            raise KeyError('{} was not kept for shot(s) {}'.format(self.index.name, np.arange(len(self))[key][indices < 0]))
+        return Deduplicated.__getitem__(self, key)
+
+
+class ShotFile:
+    '''
+    read side of a ShotWriter file, f[name] is the h5py dataset or, for
+    deduplicated and sparse quantities, a Deduplicated or Sparse view of it
+    '''
+    def __init__(self, filename, swmr=True):
+        self.f = h5py.File(filename, 'r', libver='latest', swmr=swmr)
+        self.attrs = self.f.attrs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getitem__(self, name):
+        ds = self.f[name]
+        if 'unique' in ds.attrs:
+            view = Sparse if ds.attrs.get('sparse', False) else Deduplicated
+            return view(ds, self.f[ds.attrs['unique']])
+        return ds
+
+    def __contains__(self, name):
+        return name in self.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [name for name in self.f if name != UNIQUE_GROUP]
+
+    def close(self):
+        self.f.close()
+
+
+def open_live(filename):
+    '''opens a file that's still being written for reading (call refresh() on datasets to see new shots)'''
+    return ShotFile(filename, swmr=True)
+
+
+def convert(old_filename, new_filename, **kwargs):
+    '''
+    rewrites a one-group-per-shot file (groups '0', '1', ...) in the
+    stacked layout, returns the number of shots converted
+    shot_time isn't known for old shots so it's the conversion time
+    '''
+    with h5py.File(old_filename, 'r') as old:
+        attrs = dict(old.attrs)
+        shots = sorted((name for name in old if isinstance(old[name], h5py.Group)), key=int)
+        with ShotWriter(new_filename, attrs=attrs, **kwargs) as writer:
+            for name in shots:
+                group = old[name]
+                writer.append({key: group[key][()] for key in group})
+    return len(shots)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('usage: {} old.hdf5 new.hdf5'.format(sys.argv[0]))
+        sys.exit(1)
+    n = convert(sys.argv[1], sys.argv[2])
+    print('converted', n, 'shots')
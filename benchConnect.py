@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+# driver startup time against the simulated instrument: the old
+# flush-by-timeout connect versus the constructor's fast connect
+
+from fakeKeithley import FakeKeithley
+from k24xx import K24xx
+from k6485 import K6485
+import serial
+import time
+import argparse
+
+parser = argparse.ArgumentParser(description='Benchmarks Keithley driver connect time on a fake Keithley')
+parser.add_argument('-k','--keithley', dest='series', type=int, default=6, help='Keithley series number to simulate (4 or 6)')
+parser.add_argument('-r','--repeats', dest='repeats', type=int, default=5, help='Connects to time per method')
+parser.add_argument('-j','--junk', dest='junk', type=int, default=3, help='Stale reply lines left on the line before each connect')
+args = parser.parse_args()
+
+if args.series == 4:
+  fake = FakeKeithley(model='2410')
+  driver = K24xx
+else:
+  fake = FakeKeithley(model='6485')
+  driver = K6485
+staleLine = '+1.234567E-09,+1.234567E-09\r\n'
+
+def legacyConnect(port, baud=57600, timeout=30):
+  """what the constructors used to do: drain a byte at a time until a 1 s read
+  times out, then reopen the port
+  """
+  p = serial.Serial(port,baud,timeout=1)
+  p.write(b'*RST\n')
+  p.flush()
+  c = b'c'
+  while c != b'':
+    c = p.read()
+  p.close()
+  p = serial.Serial(port,baud,timeout=timeout)
+  return(p)
+
+def fastConnect(port):
+  return(driver(port=port))
+
+def ident(conn):
+  """asks whatever connect returned for the ident"""
+  if isinstance(conn, serial.Serial):
+    conn.write(b'*IDN?\n')
+    return(conn.readline().decode('utf-8'))
+  else:
+    return(conn.transport.query('*IDN?'))
+
+print('method, mean connect time [s], ident ok')
+for (name, connect) in [('legacy', legacyConnect), ('fast', fastConnect)]:
+  times = []
+  ok = True
+  for i in range(args.repeats):
+    fake.junk(staleLine * args.junk)
+    t0 = time.perf_counter()
+    conn = connect(fake.port)
+    times.append(time.perf_counter() - t0)
+    identStr = ident(conn)
+    if isinstance(conn, serial.Serial):
+      conn.close()
+    del(conn)
+    ok = ok and (identStr == fake.deviceStrings[fake.model])
+  print('{:}, {:.3f}, {:}'.format(name, sum(times) / len(times), ok))
+
+fake.close()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# bytes written and write time per DTU shot: whole camera frames as they
+# were stored, whole frames compressed, and reduced frames (DTU_reduction)
+
+from DTU_storage import ShotWriter
+from DTU_reduction import FrameReducer
+from DTU_fitting import twoD_Gaussian
+import numpy as np
+import tempfile
+import time
+import os
+import argparse
+
+parser = argparse.ArgumentParser(description='Benchmarks DTU shot storage with and without camera frame reduction')
+parser.add_argument('-n','--shots', dest='n', type=int, default=100, help='Shots per layout')
+parser.add_argument('-k','--keep-every', dest='keepEvery', type=int, default=10, help='Keep whole frames every this many shots')
+parser.add_argument('-c','--change', dest='change', type=float, default=0.1, help='Or when their profiles change by this fraction')
+parser.add_argument('-s','--shape', dest='shape', type=int, nargs=2, default=[480, 640], help='Camera frame rows and columns')
+args = parser.parse_args()
+
+rows, cols = args.shape
+y, x = np.indices((rows, cols))
+rng = np.random.default_rng(0)
+wavelength = np.linspace(200, 1000, 3648)
+
+def shots(n):
+  """a spot wandering slowly round the frame on a noisy background, plus spectra"""
+  for i in range(n):
+    xo = cols / 2 + cols / 8 * np.sin(i / 50)
+    yo = rows / 2 + rows / 8 * np.cos(i / 70)
+    frame = twoD_Gaussian((x, y), 2000, xo, yo, cols / 20, rows / 30, 0.3, 100).reshape(rows, cols)
+    frame = (frame + rng.normal(0, 5, frame.shape)).astype(np.uint16)
+    yield {'dataset_cam': frame.ravel(),
+           'dataset_camROI': frame[rows // 4:3 * rows // 4, cols // 4:3 * cols // 4].ravel(),
+           'dataset_spectr100': rng.normal(1000, 30, 3648),
+           'dataset_spectr200': rng.normal(1000, 30, 3648),
+           'dataset_wavelength_100': wavelength,
+           'dataset_wavelength_200': wavelength}
+
+shapes = {'dataset_cam': (rows, cols), 'dataset_camROI': (rows // 2, cols // 2)}
+frames = list(shots(args.n))
+settings = ['dataset_wavelength_100', 'dataset_wavelength_200']
+layouts = [('whole frames, uncompressed', dict(compression=None, dedup=settings), False),
+           ('whole frames, gzip', dict(dedup=settings), False),
+           ('reduced frames', dict(dedup=settings, sparse=list(shapes)), True)]
+
+print('layout, kB/shot, ms/shot, frames kept')
+with tempfile.TemporaryDirectory() as directory:
+  for (name, options, reduce) in layouts:
+    fileName = os.path.join(directory, 'bench.hdf5')
+    reducer = FrameReducer(shapes, keep_every=args.keepEvery, change=args.change)
+    t0 = time.perf_counter()
+    with ShotWriter(fileName, **options) as writer:
+      for shot in frames:
+        shot = dict(shot)
+        if reduce:
+          reducer.reduce(shot, shapes)
+        writer.append(shot)
+    dt = time.perf_counter() - t0
+    kept = reducer.n_kept['dataset_cam'] if reduce else args.n
+    print('{:}, {:.1f}, {:.2f}, {:}'.format(name, os.path.getsize(fileName) / args.n / 1e3, dt / args.n * 1e3, kept))
+    os.remove(fileName)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+
+# READ? throughput vs pipeline depth against the simulated instrument
+
+from fakeKeithley import FakeKeithley
+from k24xx import K24xx
+from k6485 import K6485
+import time
+import argparse
+
+parser = argparse.ArgumentParser(description='Benchmarks pipelined READ? throughput vs depth on a fake Keithley')
+parser.add_argument('-k','--keithley', dest='series', type=int, default=6, help='Keithley series number to simulate (4 or 6)')
+parser.add_argument('-c','--nplc', dest='nplc', type=float, default=0.1, help='Number of power line cycles per reading')
+parser.add_argument('-n','--measurements', dest='n', type=int, default=200, help='Readings per depth')
+parser.add_argument('-d','--depths', dest='depths', type=int, nargs='+', default=[1, 2, 4, 8], help='Pipeline depths to try')
+args = parser.parse_args()
+
+if args.series == 4:
+  fake = FakeKeithley(model='2410')
+  driver = K24xx
+else:
+  fake = FakeKeithley(model='6485')
+  driver = K6485
+
+print('depth, readings/s')
+for depth in args.depths:
+  k = driver(port=fake.port, pipelineDepth=depth)
+  k.currentSetup(nplc=args.nplc)
+  t0 = time.perf_counter()
+  for current in k.iterCurrent(args.n):
+    pass
+  dt = time.perf_counter() - t0
+  print('{:}, {:.1f}'.format(depth, args.n / dt))
+  del(k)
+
+fake.close()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+# IV curve time, host stepping the level point by point vs the 2410 running
+# the whole sweep itself, against the simulated instrument
+
+from fakeKeithley import FakeKeithley
+from k24xx import K24xx
+import numpy as np
+import time
+import argparse
+
+parser = argparse.ArgumentParser(description='Benchmarks instrument side IV sweeps against host stepping on a fake Keithley 2410')
+parser.add_argument('-c','--nplc', dest='nplc', type=float, default=0.1, help='Number of power line cycles per reading')
+parser.add_argument('-n','--points', dest='n', type=int, default=101, help='Points per IV curve')
+parser.add_argument('-d','--delay', dest='delay', type=float, default=0.005, help='Settling time at each level [s]')
+parser.add_argument('-f','--format', dest='dataFormat', type=str.upper, default='SREAL', help='Reading transfer format: ASCII or SREAL')
+args = parser.parse_args()
+
+fake = FakeKeithley(model='2410')
+k = K24xx(port=fake.port)
+levels = np.linspace(-1, 1, args.n)
+
+print('method, s per curve, points/s')
+
+# the host sets each level, waits for it to settle and asks for a reading
+k.currentSetup(nplc=args.nplc, t=True, dataFormat=args.dataFormat)
+k._write(':SOUR:VOLT:RANG {:.6g}'.format(np.abs(levels).max())) # currentSetup leaves it at MIN
+k.setOutput(True)
+t0 = time.perf_counter()
+currents = []
+for level in levels:
+  k._write(':SOUR:VOLT:LEV {:.6g}'.format(level))
+  time.sleep(args.delay)
+  currents.append(k.getCurrent()[0])
+dt = time.perf_counter() - t0
+k.setOutput(False)
+print('host stepping, {:.3f}, {:.1f}'.format(dt, args.n / dt))
+
+t0 = time.perf_counter()
+(v, i, t) = k.sweep(levels[0], levels[-1], args.n, delay=args.delay, nplc=args.nplc)
+dt = time.perf_counter() - t0
+print('sweep, {:.3f}, {:.1f}'.format(dt, args.n / dt))
+
+t0 = time.perf_counter()
+(v, i, t) = k.sweepList(levels, delay=args.delay, nplc=args.nplc)
+dt = time.perf_counter() - t0
+print('list sweep, {:.3f}, {:.1f}'.format(dt, args.n / dt))
+
+del(k)
+fake.close()
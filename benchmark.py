@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+# offline benchmark suite, every acquisition path against its stand-in:
+# the keithleys on fakeKeithley ptys, ps4262 on fakePs4000 and the DTU shot
+# path (PV snapshot, frame reduction, HDF5 append) on fakePV.dtuServer
+
+import os
+import sys
+import time
+import json
+import tempfile
+import argparse
+import numpy as np
+import metrics
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'picoscope'))
+
+parser = argparse.ArgumentParser(description='Benchmarks the drivers and the DTU shot path against simulated instruments')
+parser.add_argument('-o','--only', dest='only', nargs='+', choices=['keithley', 'picoscope', 'dtu'], default=['keithley', 'picoscope', 'dtu'], help='Benchmarks to run')
+parser.add_argument('-c','--nplc', dest='nplc', type=float, default=0.1, help='Keithley power line cycles per reading')
+parser.add_argument('-n','--measurements', dest='n', type=int, default=200, help='Keithley readings per test')
+parser.add_argument('-d','--depth', dest='depth', type=int, default=4, help='Keithley pipeline depth to compare with no pipelining')
+parser.add_argument('-t','--duration', dest='duration', type=float, default=10, help='Seconds of triggered picoscope captures')
+parser.add_argument('-f','--triggers-per-minute', dest='triggersPerMinute', type=float, default=600, help='Picoscope trigger rate')
+parser.add_argument('-s','--shots', dest='shots', type=int, default=50, help='DTU shots')
+parser.add_argument('-l','--latency', dest='latency', type=float, default=0.02, help='Simulated EPICS round trip [s]')
+parser.add_argument('-j','--json', dest='json', help='Also write the results to this file')
+parser.add_argument('-m','--metrics', dest='metrics', action='store_true', help='Turn the hot path metrics on and print where the time went after each benchmark')
+args = parser.parse_args()
+if args.metrics:
+  metrics.enable()
+
+def percentiles(seconds):
+  """p50/p90/p99 and max of a list of durations, in ms"""
+  ms = np.array(seconds) * 1e3
+  return {'p50': np.percentile(ms, 50), 'p90': np.percentile(ms, 90), 'p99': np.percentile(ms, 99), 'max': ms.max()}
+
+def benchKeithley(model):
+  """readings/s and READ? latency, one query at a time and pipelined"""
+  from fakeKeithley import FakeKeithley
+  from k24xx import K24xx
+  from k6485 import K6485
+  fake = FakeKeithley(model=model)
+  driver = K24xx if model == '2410' else K6485
+  results = {}
+  try:
+    k = driver(port=fake.port)
+    k.currentSetup(nplc=args.nplc)
+    latencies = []
+    for i in range(args.n):
+      t0 = time.perf_counter()
+      k.getCurrent()
+      latencies.append(time.perf_counter() - t0)
+    results['readings/s'] = args.n / sum(latencies)
+    results['READ? latency [ms]'] = percentiles(latencies)
+    del(k)
+
+    k = driver(port=fake.port, pipelineDepth=args.depth)
+    k.currentSetup(nplc=args.nplc)
+    t0 = time.perf_counter()
+    for current in k.iterCurrent(args.n):
+      pass
+    results['readings/s, depth {:}'.format(args.depth)] = args.n / (time.perf_counter() - t0)
+    del(k)
+  finally:
+    fake.close()
+  return results
+
+def benchPicoscope():
+  """captures/s, dead time and missed triggers for triggered block captures"""
+  from ps4262 import ps4262
+  from fakePs4000 import PS4000
+  with tempfile.TemporaryDirectory() as directory:
+    # keep the real edge count out of it
+    ps4262.persistentFile = os.path.join(directory, 'edgeCount.bin')
+    ps4262.metrics = metrics
+    ps = ps4262(ps=PS4000(), tCapture=0.01, triggersPerMinute=args.triggersPerMinute)
+    nCaptures = 0
+    t0 = time.monotonic()
+    while time.monotonic() - t0 < args.duration:
+      capture = ps.getData(timeout=0.1)
+      if capture is not None:
+        capture.release()
+        nCaptures = nCaptures + 1
+    elapsed = time.monotonic() - t0
+    stats = ps.getDeadTimeStats()
+    deadTimes = list(ps.deadTimes)
+    ps.stop()
+    ps.edgeCounter.close()
+  return {'captures/s': nCaptures / elapsed,
+          'triggers/s': args.triggersPerMinute / 60,
+          'dead time [ms]': percentiles(deadTimes),
+          'missed triggers': stats['missedTriggers'],
+          'dropped captures': ps.capturesDropped}
+
+def benchDTU():
+  """time per shot to read the PVs, reduce the frames and append to the file"""
+  from fakePV import dtuServer
+  from DTU_pvs import PVAcquisition, SHOT_PVS, SETTING_PVS, frame_shapes
+  from DTU_storage import ShotWriter
+  from DTU_reduction import FrameReducer
+  server = dtuServer(latency=args.latency)
+  pvs = PVAcquisition(SHOT_PVS, SETTING_PVS, pv_class=server.PV)
+  frames = ['dataset_cam', 'dataset_camROI']
+  reducer = FrameReducer(frames)
+  (snapshots, reductions, writes) = ([], [], [])
+  with tempfile.TemporaryDirectory() as directory:
+    fileName = os.path.join(directory, 'bench.hdf5')
+    with ShotWriter(fileName, dedup=SETTING_PVS, sparse=frames) as writer:
+      for i in range(args.shots):
+        t0 = time.perf_counter()
+        (shot, timestamps) = pvs.snapshot()
+        t1 = time.perf_counter()
+        reducer.reduce(shot, frame_shapes(shot))
+        t2 = time.perf_counter()
+        writer.append(shot)
+        t3 = time.perf_counter()
+        snapshots.append(t1 - t0)
+        reductions.append(t2 - t1)
+        writes.append(t3 - t2)
+    size = os.path.getsize(fileName)
+  pvs.close()
+  return {'PV snapshot [ms]': percentiles(snapshots),
+          'frame reduction [ms]': percentiles(reductions),
+          'shot write [ms]': percentiles(writes),
+          'kB/shot': size / args.shots / 1e3}
+
+def show(name, results):
+  for (key, value) in results.items():
+    if isinstance(value, dict):
+      value = ', '.join('{:} {:.2f}'.format(k, v) for (k, v) in value.items())
+    elif isinstance(value, float):
+      value = '{:.2f}'.format(value)
+    print('{:}, {:}, {:}'.format(name, key, value))
+  if metrics.enabled:
+    results['metrics'] = metrics.snapshot()
+    print(metrics.report())
+    metrics.reset()
+
+results = {}
+if 'keithley' in args.only:
+  for model in ('2410', '6485'):
+    results['keithley ' + model] = benchKeithley(model)
+    show('keithley ' + model, results['keithley ' + model])
+if 'picoscope' in args.only:
+  results['ps4262'] = benchPicoscope()
+  show('ps4262', results['ps4262'])
+if 'dtu' in args.only:
+  results['dtu'] = benchDTU()
+  show('dtu', results['dtu'])
+
+if args.json is not None:
+  with open(args.json, 'w') as f:
+    json.dump(results, f, indent=2, default=float)
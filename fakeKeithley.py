@@ -0,0 +1,289 @@
+# stand-in keithley 2410/6485 on a pseudo terminal
+# lets the drivers and benchmarks run without the hardware
+
+import os
+import pty
+import tty
+import select
+import threading
+import queue
+import time
+import numpy as np
+
+class FakeKeithley:
+  """serves the SCPI subset K24xx and K6485 use on a pty
+  point a driver at .port, readings take nplc power line cycles each plus
+  the model's readingOverhead (trigger and A/D housekeeping) and any source
+  delay, the 2410 steps through its sweep or list levels from one reading to
+  the next (limited to what the source range can put out) and sees
+  current + voltage / resistance, clipped at the compliance, every command
+  takes commandTime to parse, replies are held back for as long as they'd
+  take on the wire at baud and both directions see latency seconds of link
+  delay (USB-serial adapters)
+  """
+  deviceStrings = {
+    '2410': 'KEITHLEY INSTRUMENTS INC.,MODEL 2410,4090615,C33   Mar 31 2015 09:32:39/A02  /J/K\r\n',
+    '6485': 'KEITHLEY INSTRUMENTS INC.,MODEL 6485,4038279,C01   Jun 23 2010 12:22:00/A02  /H\r\n'}
+  lineFrequency = 50 # Hz
+  bufferSize = 2500
+  readingOverheads = {'2410': 1.5e-3, '6485': 0.6e-3} # s per reading on top of the integration
+  sourceRanges = [0.2, 2.0, 20.0, 1000.0] # 2410 voltage source ranges [V], each goes 5% over
+  commandTime = 0.2e-3 # s to parse and act on one command
+  def __init__(self, model='6485', baud=57600, latency=2e-3, current=1e-9, noise=1e-11, resistance=1e9):
+    """opens the pty and starts serving
+    """
+    self.model = model
+    self.baud = baud
+    self.latency = latency
+    self.current = current
+    self.noise = noise
+    self.resistance = resistance
+    self.readingOverhead = self.readingOverheads[model]
+    self.rng = np.random.default_rng()
+    self.nQueries = 0
+    self.nLines = 0 # command lines received
+    self._reset()
+
+    (self.master, self.slave) = pty.openpty()
+    tty.setraw(self.slave)
+    self.port = os.ttyname(self.slave)
+    self.running = True
+    self.commands = queue.Queue() # (arrival time, line)
+    self.replies = queue.Queue() # (delivery time, payload)
+    self.lineFree = time.monotonic()
+    self.threads = [threading.Thread(name='fakeKeithleyRx', target=self._receive, daemon=True),
+                    threading.Thread(name='fakeKeithley', target=self._serve, daemon=True),
+                    threading.Thread(name='fakeKeithleyTx', target=self._send, daemon=True)]
+    for thread in self.threads:
+      thread.start()
+
+  def close(self):
+    """stops serving and closes the pty
+    """
+    self.running = False
+    self.commands.put(None)
+    self.replies.put(None)
+    for thread in self.threads:
+      thread.join()
+    os.close(self.master)
+    os.close(self.slave)
+
+  def _reset(self):
+    """*RST state
+    """
+    self.settings = {}
+    self.nplc = 1.0
+    self.nMean = 1
+    self.elements = ['READ'] if self.model == '6485' else ['VOLT', 'CURR', 'RES', 'TIME', 'STAT']
+    self.dataFormat = 'ASC'
+    self.byteOrder = 'NORM'
+    self.trigCount = 1
+    self.tracePoints = self.bufferSize
+    self.traceControl = 'NEV'
+    self.trace = []
+    self.lastReadings = []
+    self.output = False
+    self.t0 = time.time()
+
+  def junk(self, payload):
+    """puts stale bytes on the line, like a reply an earlier session never read
+    """
+    if isinstance(payload, str):
+      payload = payload.encode('utf-8')
+    os.write(self.master, payload)
+
+  def _receive(self):
+    """reads command lines off the pty as they arrive
+    """
+    rx = b''
+    while self.running:
+      (r, w, x) = select.select([self.master], [], [], 0.05)
+      if not r:
+        continue
+      try:
+        rx = rx + os.read(self.master, 4096)
+      except OSError:
+        break
+      while b'\n' in rx:
+        (line, rx) = rx.split(b'\n', 1)
+        self.commands.put((time.monotonic(), line.decode('utf-8').strip()))
+
+  def _serve(self):
+    """answers the command lines one at a time, like the instrument does
+    """
+    while True:
+      item = self.commands.get()
+      if item is None:
+        break
+      (arrival, line) = item
+      wait = arrival + self.latency - time.monotonic()
+      if wait > 0:
+        time.sleep(wait)
+      self.nLines = self.nLines + 1
+      # compound commands are separated with ;, and so are their replies
+      self.lineReplies = []
+      for cmd in line.split(';'):
+        cmd = cmd.strip()
+        if cmd != '':
+          time.sleep(self.commandTime)
+          self._handle(cmd)
+      if self.lineReplies != []:
+        self._sendReply(b';'.join(reply.rstrip(b'\r\n') for reply in self.lineReplies) + b'\r\n')
+
+  def _send(self):
+    """writes replies back out once they'd have crossed the link
+    """
+    while True:
+      item = self.replies.get()
+      if item is None:
+        break
+      (delivery, payload) = item
+      wait = delivery - time.monotonic()
+      if wait > 0:
+        time.sleep(wait)
+      os.write(self.master, payload)
+
+  def _reply(self, payload):
+    """adds payload to the reply for the command line being handled
+    """
+    if isinstance(payload, str):
+      payload = payload.encode('utf-8')
+    self.lineReplies.append(payload)
+
+  def _sendReply(self, payload):
+    """queues payload to be sent, taking as long as the serial line would
+    """
+    self.lineFree = max(self.lineFree, time.monotonic()) + len(payload) * 10 / self.baud
+    self.replies.put((self.lineFree + self.latency, payload))
+
+  def _levels(self, n):
+    """source voltage for each of n readings
+    """
+    mode = self.settings.get('SOUR:VOLT:MODE', 'FIX').upper()
+    sourceRange = self.settings.get('SOUR:VOLT:RANG', 'MIN').upper()
+    if sourceRange.startswith('MIN'):
+      sourceRange = self.sourceRanges[0]
+    elif sourceRange.startswith('MAX') or sourceRange.startswith('DEF'):
+      sourceRange = self.sourceRanges[-1]
+    else:
+      sourceRange = next((r for r in self.sourceRanges if r >= abs(float(sourceRange))), self.sourceRanges[-1])
+    if mode.startswith('SWE'):
+      (start, stop) = (float(self.settings.get('SOUR:VOLT:STAR', 0)), float(self.settings.get('SOUR:VOLT:STOP', 0)))
+      if self.settings.get('SOUR:SWE:RANG', 'BEST').upper().startswith('BEST'):
+        sourceRange = next((r for r in self.sourceRanges if r >= max(abs(start), abs(stop))), self.sourceRanges[-1])
+      points = int(self.settings.get('SOUR:SWE:POIN', 2500))
+      if self.settings.get('SOUR:SWE:SPAC', 'LIN').upper().startswith('LOG'):
+        levels = np.geomspace(start, stop, points)
+      else:
+        levels = np.linspace(start, stop, points)
+    elif mode == 'LIST':
+      levels = np.array([float(level) for level in self.settings.get('SOUR:LIST:VOLT', '0').split(',')])
+    else:
+      levels = np.array([float(self.settings.get('SOUR:VOLT:LEV', 0))])
+    limit = 1.05 * sourceRange
+    return(np.clip(np.resize(levels, n), -limit, limit))
+
+  def _measure(self, n):
+    """takes n readings in real time, returns rows of the configured elements
+    """
+    rows = []
+    perReading = self.nplc * max(self.nMean, 1) / self.lineFrequency + self.readingOverhead
+    if self.settings.get('SOUR:DEL:AUTO', 'ON').upper() in ('0', 'OFF'):
+      perReading = perReading + float(self.settings.get('SOUR:DEL', 0))
+    compliance = float(self.settings.get('SENS:CURR:PROT', 105e-6))
+    levels = self._levels(n)
+    start = time.monotonic()
+    for i in range(n):
+      # paced against the start so short sleeps don't add up their overshoot
+      wait = start + (i + 1) * perReading - time.monotonic()
+      if wait > 0:
+        time.sleep(wait)
+      current = self.current + self.noise * self.rng.standard_normal()
+      if self.model != '6485':
+        current = np.clip(current + levels[i] / self.resistance, -compliance, compliance)
+      tStamp = time.time() - self.t0
+      row = []
+      for elem in self.elements:
+        if elem in ('READ', 'CURR'):
+          row.append(current)
+        elif elem == 'TIME':
+          row.append(tStamp)
+        elif elem == 'VOLT':
+          row.append(levels[i])
+        elif elem == 'RES':
+          row.append(9.91e37)
+        elif elem == 'STAT':
+          row.append(0.0)
+      rows.append(row)
+      if self.traceControl == 'NEXT' and len(self.trace) < self.tracePoints:
+        self.trace.append(row)
+    self.lastReadings = rows
+    return(rows)
+
+  def _format(self, rows):
+    """renders rows of readings in the current data format
+    """
+    vals = [val for row in rows for val in row]
+    if self.dataFormat == 'ASC':
+      return(','.join('{:+.6E}'.format(val) for val in vals) + '\r\n')
+    order = '<' if self.byteOrder == 'SWAP' else '>'
+    dtype = order + ('f8' if self.dataFormat == 'DRE' else 'f4')
+    return(b'#0' + np.array(vals, dtype=dtype).tobytes() + b'\r\n')
+
+  def _handle(self, cmd):
+    """acts on one SCPI command
+    """
+    if ' ' in cmd:
+      (header, value) = cmd.split(' ', 1)
+      value = value.strip()
+    else:
+      (header, value) = (cmd, '')
+    header = header.upper().lstrip(':')
+    isQuery = header.endswith('?')
+    if isQuery:
+      self.nQueries = self.nQueries + 1
+
+    if header == '*RST':
+      self._reset()
+    elif header == '*CLS':
+      pass
+    elif header == '*IDN?':
+      self._reply(self.deviceStrings[self.model])
+    elif header == '*OPC?':
+      self._reply('1\r\n')
+    elif header in ('READ?', 'MEAS?', 'MEAS:CURR?'):
+      self._reply(self._format(self._measure(self.trigCount)))
+    elif header == 'FETC?':
+      self._reply(self._format(self.lastReadings))
+    elif header in ('INIT', 'INIT:IMM'):
+      self._measure(self.trigCount)
+    elif header == 'TRAC:DATA?':
+      self._reply(self._format(self.trace))
+    elif header in ('TRAC:CLE', 'TRAC:CLEAR'):
+      self.trace = []
+    elif isQuery:
+      # setting readback
+      self._reply(self.settings.get(header[:-1], '0') + '\r\n')
+    else:
+      if value != '':
+        self.settings[header] = value
+      if header.endswith('NPLC'):
+        self.nplc = float(value)
+      elif header == 'SENS:AVER:STAT' and value in ('0', 'OFF'):
+        self.nMean = 1
+      elif header == 'SENS:AVER:COUN':
+        self.nMean = int(value)
+      elif header == 'FORM:ELEM':
+        self.elements = [elem.strip().upper() for elem in value.split(',')]
+      elif header == 'FORM:DATA':
+        self.dataFormat = value.upper()[:3]
+      elif header == 'FORM:BORD':
+        self.byteOrder = value.upper()[:4]
+      elif header == 'TRIG:COUN':
+        self.trigCount = int(value)
+      elif header == 'TRAC:POIN':
+        self.tracePoints = int(value)
+      elif header == 'TRAC:FEED:CONT':
+        self.traceControl = value.upper()[:4]
+      elif header == 'OUTP':
+        self.output = value.upper() in ('1', 'ON')
@@ -0,0 +1,163 @@
+# stand-in EPICS PVs with the pyepics PV interface
+# lets DTU_acquisition_script and DTU_pvs run without an IOC
+
+import collections
+import threading
+import time
+import numpy as np
+
+class FakePVServer:
+  """holds PV values in memory, hand server.PV to code that wants epics.PV
+  every get waits latency seconds like a network round trip,
+  set() updates a value and fires the monitors on it, setGenerator()
+  makes a PV whose value is made afresh for every get (a camera, say)
+  """
+  def __init__(self, latency=0.02):
+    self.latency = latency
+    self.values = {} # name -> (value, timestamp)
+    self.generators = {} # name -> function returning a new value
+    self.monitors = collections.defaultdict(list) # name -> FakePVs monitoring it
+    self.lock = threading.Lock()
+    self.nGets = 0
+
+  def set(self, pvname, value, timestamp=None):
+    """sets a PV, like a caput on the IOC
+    """
+    if timestamp is None:
+      timestamp = time.time()
+    with self.lock:
+      self.values[pvname] = (value, timestamp)
+      monitors = list(self.monitors[pvname])
+    for pv in monitors:
+      pv._monitorEvent(value, timestamp)
+
+  def setGenerator(self, pvname, generator):
+    """gets of pvname return generator(), timestamped when they're made
+    """
+    self.generators[pvname] = generator
+    self.set(pvname, generator())
+
+  def PV(self, pvname, **kwargs):
+    """makes a PV on this server, takes epics.PV's arguments
+    """
+    return FakePV(self, pvname, **kwargs)
+
+  def _get(self, pvname):
+    time.sleep(self.latency)
+    generator = self.generators.get(pvname)
+    if generator is not None:
+      reply = (generator(), time.time())
+    with self.lock:
+      self.nGets = self.nGets + 1
+      if generator is not None:
+        self.values[pvname] = reply
+      return self.values.get(pvname)
+
+
+def dtuServer(latency=0.02, shape=(480, 640), roiShape=(240, 320), nWavelengths=3648, seed=None):
+  """a FakePVServer serving the PVs DTU_acquisition_script reads: a camera
+  with a noisy beam spot wandering slowly about its frame, an ROI of it, two
+  spectrometers and their calibrations and settings
+  """
+  server = FakePVServer(latency)
+  rng = np.random.default_rng(seed)
+  (rows, cols) = shape
+  y = np.arange(rows)
+  x = np.arange(cols)
+  start = time.monotonic()
+  frames = {}
+
+  def frame():
+    t = time.monotonic() - start
+    (xo, yo) = (cols / 2 + cols / 8 * np.sin(t / 60), rows / 2 + rows / 8 * np.cos(t / 90))
+    spot = np.outer(np.exp(-(y - yo)**2 / (2 * (rows / 30)**2)), np.exp(-(x - xo)**2 / (2 * (cols / 20)**2)))
+    frames['last'] = (2000 * spot + 100 + rng.normal(0, 5, shape)).astype(np.uint16)
+    return frames['last'].ravel()
+
+  def roi():
+    # the ROI plugin works on the frame the camera took last
+    (r0, c0) = ((rows - roiShape[0]) // 2, (cols - roiShape[1]) // 2)
+    return frames['last'][r0:r0 + roiShape[0], c0:c0 + roiShape[1]].ravel()
+
+  def spectrum():
+    return rng.normal(1000, 30, nWavelengths)
+
+  server.setGenerator('CAM1:image1:ArrayData', frame)
+  server.setGenerator('CAM1:image2:ArrayData', roi)
+  server.setGenerator('CCS1:trace1:ArrayData', spectrum)
+  server.setGenerator('CCS2:trace1:ArrayData', spectrum)
+  server.set('CCS1:det1:TlWavelengthData_RBV', np.linspace(200, 1000, nWavelengths))
+  server.set('CCS2:det1:TlWavelengthData_RBV', np.linspace(500, 1100, nWavelengths))
+  for name in ('CCS1:det1:AcquireTime_RBV', 'CCS2:det1:AcquireTime_RBV', 'CAM1:det1:AcquireTime_RBV'):
+    server.set(name, 0.01)
+  server.set('CAM1:det1:Gain_RBV', 1.0)
+  server.set('CAM1:image1:ArraySize0_RBV', cols)
+  server.set('CAM1:image1:ArraySize1_RBV', rows)
+  server.set('CAM1:image2:ArraySize0_RBV', roiShape[1])
+  server.set('CAM1:image2:ArraySize1_RBV', roiShape[0])
+  return server
+
+
+class FakePV:
+  """the parts of epics.PV the DTU scripts use
+  """
+  def __init__(self, server, pvname, callback=None, form='time', auto_monitor=None, **kwargs):
+    self.server = server
+    self.pvname = pvname
+    self.form = form
+    self.auto_monitor = auto_monitor
+    self.callbacks = []
+    self.value = None
+    self.timestamp = None
+    if callback is not None:
+      self.callbacks.append(callback)
+    if auto_monitor:
+      with server.lock:
+        server.monitors[pvname].append(self)
+        current = server.values.get(pvname)
+      if current is not None:
+        # a new subscription always gets the current value first
+        self._monitorEvent(*current)
+
+  @property
+  def connected(self):
+    return self.pvname in self.server.values
+
+  def wait_for_connection(self, timeout=None):
+    return self.connected
+
+  def _monitorEvent(self, value, timestamp):
+    (self.value, self.timestamp) = (value, timestamp)
+    for callback in self.callbacks:
+      callback(pvname=self.pvname, value=value, timestamp=timestamp)
+
+  def add_callback(self, callback=None, index=None, run_now=False, **kw):
+    self.callbacks.append(callback)
+    if run_now and self.value is not None:
+      callback(pvname=self.pvname, value=self.value, timestamp=self.timestamp)
+    return len(self.callbacks) - 1
+
+  def get_with_metadata(self, count=None, as_string=False, as_numpy=True, timeout=None, form=None, use_monitor=True, **kw):
+    if use_monitor and self.auto_monitor and self.value is not None:
+      reply = (self.value, self.timestamp)
+    else:
+      reply = self.server._get(self.pvname)
+    if reply is None:
+      return None # that's what pyepics does on a timeout
+    (value, timestamp) = reply
+    if isinstance(value, np.ndarray):
+      value = value.copy()
+    return {'pvname': self.pvname, 'value': value, 'timestamp': timestamp}
+
+  def get(self, count=None, as_string=False, as_numpy=True, timeout=None, use_monitor=True, **kw):
+    data = self.get_with_metadata(timeout=timeout, use_monitor=use_monitor)
+    return None if data is None else data['value']
+
+  def put(self, value, wait=False, timeout=30, **kw):
+    self.server.set(self.pvname, value)
+
+  def disconnect(self):
+    with self.server.lock:
+      if self in self.server.monitors[self.pvname]:
+        self.server.monitors[self.pvname].remove(self)
+    self.callbacks = []
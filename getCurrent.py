@@ -7,6 +7,10 @@
 
 from k24xx import K24xx
 from k6485 import K6485
+from recorder import Recorder
+import metrics
+from time import monotonic
+import numpy as np
 import sys
 import argparse
 
@@ -20,35 +24,92 @@ parser.add_argument('-c','--nplc', dest='nplc', type=float, default=10.0, help='
 parser.add_argument('-s','--timestamp', dest='time', action='store_true', default=False, help='Print out timestamp with current value')
 parser.add_argument('-n','--measurements', dest='n', type=int, default=1, help='Number of measurements to make (-1 for infinty)')
 parser.add_argument('-k','--keithley', dest='series', type=int, default=6, help='Keithley series number to talk to (4 or 6)')
+parser.add_argument('-f','--format', dest='dataFormat', type=str.upper, default='ASCII', help='Reading transfer format: ASCII, SREAL or DREAL (6485 only)')
+parser.add_argument('-r','--reset', dest='reset', action='store_true', default=False, help='Reset the instrument instead of only sending the settings that changed')
+parser.add_argument('-z','--zero-correct', dest='zcor', type=str, default='auto', choices=['auto','yes','no'], help='6485 zero correction: acquire one (yes), keep the current one (no) or reuse a recent one (auto)')
+parser.add_argument('-d','--depth', dest='depth', type=int, default=1, help='Number of queries to keep in flight when reading one at a time')
+parser.add_argument('-o','--output', dest='output', type=str, default=None, help='Record time, current pairs to this file from a background writer instead of printing them (.npy for binary, anything else for text)')
+parser.add_argument('-B','--burst', dest='burst', type=int, default=0, help='Collect this many readings per trip through the instrument buffer (0 to query one at a time)')
+parser.add_argument('-m','--metrics', dest='metrics', type=str, default=None, help='Time the serial I/O, parsing and disk writes and append snapshots to this file every 10 s, with a summary at the end')
 
 args = parser.parse_args()
 
+exporter = None
+if args.metrics is not None:
+  metrics.enable()
+  exporter = metrics.Exporter(args.metrics, interval=10)
+
 if args.series == 4:
-  k = K24xx(baud=args.baud, port=args.port, timeout=args.timeout)
+  k = K24xx(baud=args.baud, port=args.port, timeout=args.timeout, pipelineDepth=args.depth)
 elif args.series == 6:
-  k = K6485(baud=args.baud, port=args.port, timeout=args.timeout)
+  k = K6485(baud=args.baud, port=args.port, timeout=args.timeout, pipelineDepth=args.depth)
 else:
   print('ERROR: bad series value')
   exit(-1)
 
-k.currentSetup(nplc=args.nplc, nMean=args.meanValues, t=args.time)
+if args.series == 4:
+  k.currentSetup(nplc=args.nplc, nMean=args.meanValues, t=args.time, dataFormat=args.dataFormat, reset=args.reset)
+else:
+  zeroCorrect = {'auto': 'auto', 'yes': True, 'no': False}[args.zcor]
+  k.currentSetup(nplc=args.nplc, nMean=args.meanValues, t=args.time, dataFormat=args.dataFormat, reset=args.reset, zeroCorrect=zeroCorrect)
 if args.series == 4:
   k.setOutput(True)
 
-m = 0
-while True:
-  if args.time == True:
-    [current, time] = k.getCurrent()
-    print(time,', ',current)
-  else:
-    current = k.getCurrent()
-    print(current)
-  m = m + 1
+rec = None
+if args.output is not None:
+  rec = Recorder(args.output)
+t0 = monotonic() # host clock for recordings without instrument timestamps
 
-  if args.n == m:
-      break
+# Ctrl-C is how an endless (-n -1) run ends, so it still tidies up after it
+try:
+  m = 0
+  while args.burst > 0:
+    nBurst = args.burst
+    if args.n > 0:
+      nBurst = min(nBurst, args.n - m)
+    tStart = monotonic() - t0
+    vals = k.getCurrentBurst(nBurst)
+    if rec is not None:
+      if args.time == True:
+        rec.recordMany(vals[:,1], vals[:,0])
+      else:
+        # no instrument timestamps, so spread the burst over the time it took
+        rec.recordMany(np.linspace(tStart, monotonic() - t0, len(vals)), vals)
+    else:
+      for val in vals:
+        if args.time == True:
+          print(val[1],', ',val[0])
+        else:
+          print(val)
+    m = m + nBurst
 
-if args.series == 4:
-  k.setOutput(False)
+    if args.n == m:
+        break
+
+  if args.burst <= 0:
+    for val in k.iterCurrent(args.n):
+      if args.time == True:
+        [current, time] = val
+      else:
+        current = val
+        time = monotonic() - t0
+      if rec is not None:
+        rec.record(time, current)
+      elif args.time == True:
+        print(time,', ',current)
+      else:
+        print(current)
+except KeyboardInterrupt:
+  pass
+finally:
+  if rec is not None:
+    rec.close()
+
+  if args.series == 4:
+    k.setOutput(False)
+
+  if exporter is not None:
+    exporter.stop()
+    print(metrics.report(), file=sys.stderr)
 
 sys.exit(0)
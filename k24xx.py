@@ -1,42 +1,234 @@
 # written by grey@christoforo.net
 # on 8 Nov 2017
 
-import serial
 import time
-import sys
+import numpy as np
+import collections
+import asyncio
+from scpi import SerialTransport, PipelinedTransport, AsyncTransport, ScpiState
 
-class K24xx:
-  """keithley 24xx library
+class K24xxCore:
+  """keithley 24xx command building and reply parsing
+  shared by the blocking (K24xx) and asyncio (AsyncK24xx) libraries
   """
   port = None
+  transport = None
+  state = None # ScpiState, what the sourcemeter is configured with
   expectedDeviceString = 'KEITHLEY INSTRUMENTS INC.,MODEL 2410,4090615,C33   Mar 31 2015 09:32:39/A02  /J/K\r\n'
   outOnSettleTime = 0.5 # seconds to settle after output turned on
-  def __init__(self, port='/dev/ttyUSB0', baud=57600, timeout=30):
+  bufferSize = 2500 # readings the instrument's trace buffer can hold
+  lineFrequency = 50 # Hz, sets how long one power line cycle takes
+  # reading transfer formats, binary ones are sent little endian (:FORM:BORD SWAP)
+  dataFormats = {'ASCII': None, 'SREAL': '<f4'}
+  dataFormat = 'ASCII'
+  nplc = 10.0
+  nMean = 1
+  t = False
+  connectDeadline = 2.0 # seconds to wait for the ident reply when connecting
+  maxSweepPoints = 2500 # points in a :SOUR:SWE linear or log sweep
+  maxListPoints = 100 # levels the source list memory holds
+  sweepDelay = 0.0 # seconds the source waits at each level before measuring
+
+  def _isIdent(self, line):
+    """True for an *IDN? reply line
+    """
+    return('KEITHLEY' in line)
+
+  def _currentSetupCmds(self,nplc=10.0,nMean=1,t=False,dataFormat='ASCII',compliance=105e-6):
+    """Commands that setup sourcemeter for current measurements
+    compliance is the current limit [A], 105 uA is the *RST default
+    """
+    self.nplc = nplc
+    self.nMean = nMean
+    self.t = (t == True)
+    cmds = []
+    cmds.append(':TRIG:COUN 1')
+    cmds.append(':TRAC:FEED:CONT NEV')
+    cmds.append(':SOUR:FUNC VOLT')
+    cmds.append(':SOUR:VOLT:MODE FIXED')
+    cmds.append(':SOUR:CLE:AUTO OFF')
+    cmds.append(':SOUR:DEL:AUTO ON')
+    cmds.append(':SENS:FUNC "CURR"')
+    cmds.append(':SENS:CURR:PROT {:}'.format(compliance))
+    cmds.append(':SENS:CURR:NPLC {:}'.format(nplc))
+    cmds.append(':SOUR:VOLT:RANG MIN')
+    cmds.append(':SOUR:VOLT:LEV 0')
+    if t == False:
+      cmds.append(':FORM:ELEM CURR')
+    elif t == True:
+      cmds.append(':FORM:ELEM CURR, TIME')
+    else:
+      print('ERROR: t parameter data type')
+      cmds.append(':FORM:ELEM CURR')
+    
+    if dataFormat not in self.dataFormats:
+      print('ERROR: Got invalid dataFormat value')
+      dataFormat = 'ASCII'
+    self.dataFormat = dataFormat
+    if dataFormat == 'ASCII':
+      cmds.append(':FORM:DATA ASC')
+    else:
+      cmds.append(':FORM:BORD SWAP')
+      cmds.append(':FORM:DATA {:}'.format(dataFormat))
+    
+    nMean = int(nMean)
+    if nMean == 1:
+      cmds.append(':SENS:AVER:STAT 0')
+    elif (nMean > 1) and (nMean <= 100):
+      cmds.append(':SENS:AVER:STAT 1')
+      cmds.append(':SENS:AVER:COUN {:}'.format(nMean))
+    else:
+      print('ERROR: Got invalid nMean value')
+    
+    return(cmds)
+
+  def _outputCmd(self,value):
+    """Command that switches the output on or off
+    """
+    if value == True:
+      return(':OUTP ON')
+    elif value == False:
+      return(':OUTP OFF')
+    else:
+      print('Invalid data type')
+      return(None)
+
+  def _readingQuery(self):
+    """READ? reply layout as transport keyword arguments
+    """
+    if self.dataFormat != 'ASCII':
+      return({'nVals': 2 if self.t else 1, 'dtype': self.dataFormats[self.dataFormat], 'parse': self._parseReading})
+    else:
+      return({'parse': self._parseReading})
+
+  def _parseReading(self, reply):
+    """Turns one READ? reply (text or binary) into a float or [current, time]
+    """
+    if isinstance(reply, str):
+      vals = reply.split(',')
+    else:
+      vals = reply.tolist()
+    if len(vals) == 1:
+      ret = float(vals[0])
+    else:
+      ret = [float(val) for val in vals ]
+    return(ret)
+
+  def _burstDuration(self, n):
+    """Estimates how long n readings take at the current setup [s]
+    """
+    return(n * max(int(self.nMean), 1) * self.nplc / self.lineFrequency + 1)
+
+  def _sweepCmds(self,n,delay=0.0,compliance=1e-3,nplc=None,autoOutput=True):
+    """Commands that setup a sweep of n points, common to all spacings
+    the source steps on its own, waits delay seconds at each level, then
+    takes a voltage, current, time reading, all n come back to one READ?
+    autoOutput turns the output on for the sweep and off again after it
+    """
+    if nplc is not None:
+      self.nplc = nplc
+    self.sweepDelay = delay
+    cmds = []
+    cmds.append(':TRAC:FEED:CONT NEV')
+    cmds.append(':SOUR:FUNC VOLT')
+    cmds.append(':SENS:FUNC "CURR"')
+    cmds.append(':SENS:CURR:PROT {:}'.format(compliance))
+    cmds.append(':SENS:CURR:NPLC {:}'.format(self.nplc))
+    cmds.append(':SOUR:DEL:AUTO OFF')
+    cmds.append(':SOUR:DEL {:}'.format(delay))
+    if autoOutput == True:
+      cmds.append(':SOUR:CLE:AUTO ON')
+    else:
+      cmds.append(':SOUR:CLE:AUTO OFF')
+    cmds.append(':FORM:ELEM VOLT, CURR, TIME')
+    cmds.append(':TRIG:COUN {:}'.format(n))
+    return(cmds)
+
+  def _stairCmds(self,start,stop,n,spacing='LIN'):
+    """Commands for an n point linear or log staircase from start to stop [V]
+    """
+    spacing = spacing.upper()
+    if spacing not in ('LIN', 'LOG'):
+      print('ERROR: Got invalid spacing value')
+      return(None)
+    if (spacing == 'LOG') and not (start * stop > 0):
+      print('ERROR: log sweeps need start and stop nonzero and of the same sign')
+      return(None)
+    if (n < 2) or (n > self.maxSweepPoints):
+      print('ERROR: Got invalid number of sweep points')
+      return(None)
+    cmds = []
+    cmds.append(':SOUR:VOLT:MODE SWE')
+    cmds.append(':SOUR:SWE:RANG BEST')
+    cmds.append(':SOUR:SWE:SPAC {:}'.format(spacing))
+    cmds.append(':SOUR:VOLT:STAR {:}'.format(start))
+    cmds.append(':SOUR:VOLT:STOP {:}'.format(stop))
+    cmds.append(':SOUR:SWE:POIN {:}'.format(n))
+    return(cmds)
+
+  def _listCmds(self,levels,vMax):
+    """Commands that load levels [V] (at most maxListPoints) into the source list
+    on a fixed source range that takes vMax [V], the biggest level of the whole list
+    (the list doesn't pick its range like :SOUR:SWE:RANG BEST does for staircases)
+    """
+    cmds = []
+    cmds.append(':SOUR:VOLT:MODE LIST')
+    cmds.append(':SOUR:VOLT:RANG {:.6g}'.format(vMax))
+    cmds.append(':SOUR:LIST:VOLT ' + ','.join('{:.6g}'.format(level) for level in levels))
+    return(cmds)
+
+  def _listChunks(self,levels):
+    """Splits a list of levels into runs that fit the source list memory
+    """
+    levels = np.asarray(levels, dtype=float).ravel()
+    return([levels[i:i+self.maxListPoints] for i in range(0, len(levels), self.maxListPoints)])
+
+  def _sweepDuration(self, n):
+    """Estimates how long an n point sweep takes [s]
+    """
+    return(self._burstDuration(n) + n * self.sweepDelay)
+
+  def _sweepQuery(self, n):
+    """READ? reply layout of an n point sweep as transport keyword arguments
+    """
+    if self.dataFormat != 'ASCII':
+      return({'nVals': 3*n, 'dtype': self.dataFormats[self.dataFormat], 'timeout': 2 * self._sweepDuration(n)})
+    else:
+      return({'parse': lambda reply: np.fromstring(reply, sep=','), 'timeout': 2 * self._sweepDuration(n)})
+
+  def _parseSweep(self, vals):
+    """Splits the readings of a sweep into voltage, current and time arrays
+    """
+    vals = np.asarray(vals, dtype=float).reshape(-1, 3)
+    return(vals[:, 0].copy(), vals[:, 1].copy(), vals[:, 2].copy())
+
+class K24xx(K24xxCore):
+  """keithley 24xx library
+  """
+  def __init__(self, port='/dev/ttyUSB0', baud=57600, timeout=30, pipelineDepth=1):
     """keithley 24xx library constructor
+    pipelineDepth > 1 lets that many queries be in flight at once (see iterCurrent)
     """
 
-    # flush the read buffer here
-    self.port = serial.Serial(port,baud,timeout=1)
-    self._write('*RST')
-    self.port.flush()
-    if sys.version_info[0] > 3:
-      self.port.reset_output_buffer()
-      self.port.reset_input_buffer()
-    c = b'c'
-    while c is not b'':
-      c = self.port.read()
-      #print('Flush Read:', c)
-    self.port.close()
-
-    self.port = serial.Serial(port,baud,timeout=timeout)
-    identStr = self._qu('*IDN?')
+    if pipelineDepth > 1:
+      self.transport = PipelinedTransport(port, baud, timeout, depth=pipelineDepth)
+    else:
+      self.transport = SerialTransport(port, baud, timeout)
+    self.port = self.transport.port
+
+    # clear status (settings are kept for currentSetup to diff against),
+    # then skip past anything stale still on the line until the ident comes back
+    self.state = ScpiState()
+    self.transport.write('*CLS')
+    identStr = self.transport.sync('*IDN?', self._isIdent, self.connectDeadline)
     
-    if identStr == self.expectedDeviceString:
+    # a stale partial line can end up glued to the front of the reply
+    if identStr.endswith(self.expectedDeviceString):
       pass
       #print('Conected to', deviceString.decode("utf-8"))
     else:
       print('ERROR: Got unexpected device string:', identStr)
-      self.port.close()
+      self.transport.close()
       
   def __del__(self):
     """keithley 24xx library deconstructor
@@ -60,74 +252,246 @@ class K24xx:
       pass
     
     try:
-      self.port.close()
+      self.transport.close()
     except:
       pass
     
   def _write(self,cmd):
     """Send command to sourcemeter
     """
-    toSend = cmd.encode('utf-8') + b'\n'
-    self.port.write(toSend)
+    self.transport.write(cmd)
     
-  def _qu(self,cmd):
+  def _qu(self,cmd,timeout=None):
     """Query sourcemeter with command
-    """    
-    self._write(cmd)
-    result = self.port.readline()
-    decoded = result.decode('utf-8')
-    return(decoded)
+    """
+    return(self.transport.query(cmd, timeout=timeout))
+
+  def _quBinary(self,cmd,nVals):
+    """Query sourcemeter with command, expecting nVals binary values back
+    """
+    return(self.transport.queryBinary(cmd, nVals, self.dataFormats[self.dataFormat]))
     
-  def currentSetup(self,nplc=10.0,nMean=1,t=False):
+  def currentSetup(self,nplc=10.0,nMean=1,t=False,dataFormat='ASCII',reset=False,compliance=105e-6):
     """Setup sourcemeter for current measurements
+    dataFormat is ASCII or SREAL (binary, 4 bytes per reading)
+    compliance is the current limit [A], also undoing a sweep's
+    only settings the sourcemeter doesn't already have are sent,
+    reset=True starts over from *RST instead
     """
-    cmds = []
-    cmds.append('*RST')
-    cmds.append(':SOUR:FUNC VOLT')
-    cmds.append(':SOUR:VOLT:MODE FIXED')
-    cmds.append(':SENS:FUNC "CURR"')
-    cmds.append(':SENS:CURR:NPLC {:}'.format(nplc))
-    cmds.append(':SOUR:VOLT:RANG MIN')
-    cmds.append(':SOUR:VOLT:LEV 0')
-    if t == False:
-      cmds.append(':FORM:ELEM CURR')
-    elif t == True:
-      cmds.append(':FORM:ELEM CURR, TIME')
-    else:
-      print('ERROR: t parameter data type')
-      cmds.append(':FORM:ELEM CURR')
-    
-    nMean = int(nMean)
-    if nMean == 1:
-      cmds.append(':SENS:AVER:STAT 0')
-    elif (nMean > 1) and (nMean <= 100):
-      cmds.append(':SENS:AVER:STAT 1')
-      cmds.append(':SENS:AVER:STAT {:}'.format(nMean))
-    else:
-      print('ERROR: Got invalid nMean value')
-    
-    for cmd in cmds:
-      #print('Sending', cmd)
-      self._write(cmd)
+    cmds = self._currentSetupCmds(nplc, nMean, t, dataFormat, compliance)
+    if reset:
+      self._write('*RST')
+      self.state.reset()
+    elif not self.state.known:
+      self.state.seed(self._qu(self.state.seedQuery(cmds)))
+    for line in self.state.batch(self.state.changed(cmds)):
+      #print('Sending', line)
+      self._write(line)
       #self.port.write(b':SYST:ERR?\n')
       #err = self.port.readline()
       #print(err)
 
   def setOutput(self,value):
+    cmd = self._outputCmd(value)
+    if cmd is not None:
+      self._write(cmd)
     if value == True:
-      self._write(':OUTP ON')
       time.sleep(self.outOnSettleTime) # let the output settle
-    elif value == False:
-      self._write(':OUTP OFF')
-    else:
-      print('Invalid data type')
       
   def getCurrent(self):
     """Reads current from sourcemeter
     """    
-    vals = self._qu('READ?').split(',')
-    if len(vals) == 1:
-      ret = float(vals[0])
-    else:
-      ret = [float(val) for val in vals ]
+    return(self.getCurrentFuture().result())
+
+  def getCurrentFuture(self):
+    """Starts a current reading, returns a Future for its value
+    """
+    return(self.transport.submit('READ?', **self._readingQuery()))
+
+  def iterCurrent(self, n=-1):
+    """Yields n currents (-1 for infinity) in order
+    keeps up to pipelineDepth READ? queries in flight
+    """
+    inFlight = collections.deque()
+    m = 0
+    while True:
+      while (m != n) and (len(inFlight) < self.transport.depth):
+        inFlight.append(self.getCurrentFuture())
+        m = m + 1
+      if len(inFlight) == 0:
+        break
+      yield inFlight.popleft().result()
+
+  def getCurrentBurst(self, n):
+    """Reads n currents in one go via the sourcemeter's trace buffer
+    returns a numpy array of currents, or an (n,2) array of [current, time]
+    rows if timestamps were enabled in currentSetup
+    """
+    nElem = 2 if self.t else 1
+    n = int(n)
+    ret = np.empty(n*nElem)
+    done = 0
+    while done < n:
+      nBurst = min(n - done, self.bufferSize)
+      ret[done*nElem:(done+nBurst)*nElem] = self._burst(nBurst, nElem)
+      done = done + nBurst
+    if self.t:
+      ret = ret.reshape(n, nElem)
     return(ret)
+
+  def _burst(self, n, nElem):
+    """Fills the trace buffer with n readings and reads it back
+    """
+    cmds = []
+    cmds.append(':TRAC:CLE')
+    cmds.append(':TRAC:POIN {:}'.format(n))
+    cmds.append(':TRAC:FEED SENS')
+    cmds.append(':TRAC:FEED:CONT NEXT')
+    cmds.append(':TRIG:COUN {:}'.format(n))
+    for line in self.state.batch(cmds):
+      self._write(line)
+
+    # *OPC? only answers once the buffer is full, so wait at least that long
+    self._write(':INIT')
+    self._qu('*OPC?', timeout=self._burstDuration(n) * 2)
+    if self.dataFormat == 'ASCII':
+      vals = np.fromstring(self._qu(':TRAC:DATA?'), sep=',')
+    else:
+      vals = self._quBinary(':TRAC:DATA?', n*nElem)
+
+    # back to one reading per READ?
+    self._write(':TRAC:FEED:CONT NEV;:TRIG:COUN 1')
+    return(vals)
+
+  def sweep(self,start,stop,n,spacing='LIN',delay=0.0,compliance=1e-3,nplc=None,autoOutput=True):
+    """Sweeps the voltage from start to stop [V] in n LIN or LOG spaced steps
+    the sourcemeter steps through them on its own, waiting delay seconds at
+    each level and limiting the current to compliance [A], nplc defaults to
+    currentSetup's, and every reading comes back in one transfer
+    returns (voltage, current, time) numpy arrays,
+    call currentSetup() again to go back to single readings
+    """
+    stair = self._stairCmds(start, stop, n, spacing)
+    if stair is None:
+      return(None)
+    return(self._runSweep(self._sweepCmds(n, delay, compliance, nplc, autoOutput) + stair, n))
+
+  def sweepList(self,levels,delay=0.0,compliance=1e-3,nplc=None,autoOutput=True):
+    """Like sweep() but sources each of levels [V] in turn
+    lists longer than the source list memory run as several sweeps
+    """
+    runs = []
+    chunks = self._listChunks(levels)
+    vMax = max([np.abs(chunk).max() for chunk in chunks], default=0)
+    for chunk in chunks:
+      cmds = self._sweepCmds(len(chunk), delay, compliance, nplc, autoOutput) + self._listCmds(chunk, vMax)
+      runs.append(self._runSweep(cmds, len(chunk)))
+    if runs == []:
+      print('ERROR: Got no levels to sweep')
+      return(None)
+    return(tuple(np.concatenate(arrays) for arrays in zip(*runs)))
+
+  def _runSweep(self, cmds, n):
+    """Sends the sweep settings that changed, runs it and reads it back
+    """
+    for line in self.state.batch(self.state.changed(cmds)):
+      self._write(line)
+    return(self._parseSweep(self.transport.submit('READ?', **self._sweepQuery(n)).result()))
+
+class AsyncK24xx(K24xxCore):
+  """keithley 24xx library for asyncio
+  connect with await AsyncK24xx.open(...) so many instruments can share one event loop
+  """
+  def __init__(self, transport):
+    """wraps an already open AsyncTransport, see open()
+    """
+    self.transport = transport
+    self.port = transport.port
+    self.state = ScpiState()
+
+  @classmethod
+  async def open(cls, port='/dev/ttyUSB0', baud=57600, timeout=30):
+    """keithley 24xx asyncio library constructor
+    """
+    self = cls(AsyncTransport(port, baud, timeout))
+    await self._write('*CLS')
+    identStr = await self.transport.sync('*IDN?', self._isIdent, self.connectDeadline)
+    if not identStr.endswith(self.expectedDeviceString):
+      print('ERROR: Got unexpected device string:', identStr)
+      self.transport.close()
+    return(self)
+
+  async def close(self):
+    """turns the output off and lets go of the port
+    """
+    try:
+      await self._write(':OUTP OFF')
+    finally:
+      self.transport.close()
+
+  async def _write(self,cmd):
+    """Send command to sourcemeter
+    """
+    await self.transport.write(cmd)
+
+  async def _qu(self,cmd,timeout=None):
+    """Query sourcemeter with command
+    """
+    return(await self.transport.query(cmd, timeout=timeout))
+
+  async def currentSetup(self,nplc=10.0,nMean=1,t=False,dataFormat='ASCII',reset=False,compliance=105e-6):
+    """Setup sourcemeter for current measurements
+    dataFormat is ASCII or SREAL (binary, 4 bytes per reading)
+    compliance is the current limit [A], also undoing a sweep's
+    only settings the sourcemeter doesn't already have are sent,
+    reset=True starts over from *RST instead
+    """
+    cmds = self._currentSetupCmds(nplc, nMean, t, dataFormat, compliance)
+    if reset:
+      await self._write('*RST')
+      self.state.reset()
+    elif not self.state.known:
+      self.state.seed(await self._qu(self.state.seedQuery(cmds)))
+    for line in self.state.batch(self.state.changed(cmds)):
+      await self._write(line)
+
+  async def setOutput(self,value):
+    cmd = self._outputCmd(value)
+    if cmd is not None:
+      await self._write(cmd)
+    if value == True:
+      await asyncio.sleep(self.outOnSettleTime) # let the output settle
+
+  async def getCurrent(self):
+    """Reads current from sourcemeter
+    """
+    return(await self.transport.ask('READ?', **self._readingQuery()))
+
+  async def sweep(self,start,stop,n,spacing='LIN',delay=0.0,compliance=1e-3,nplc=None,autoOutput=True):
+    """Sweeps the voltage from start to stop [V] on the sourcemeter, see K24xx.sweep
+    """
+    stair = self._stairCmds(start, stop, n, spacing)
+    if stair is None:
+      return(None)
+    return(await self._runSweep(self._sweepCmds(n, delay, compliance, nplc, autoOutput) + stair, n))
+
+  async def sweepList(self,levels,delay=0.0,compliance=1e-3,nplc=None,autoOutput=True):
+    """Sources each of levels [V] in turn on the sourcemeter, see K24xx.sweepList
+    """
+    runs = []
+    chunks = self._listChunks(levels)
+    vMax = max([np.abs(chunk).max() for chunk in chunks], default=0)
+    for chunk in chunks:
+      cmds = self._sweepCmds(len(chunk), delay, compliance, nplc, autoOutput) + self._listCmds(chunk, vMax)
+      runs.append(await self._runSweep(cmds, len(chunk)))
+    if runs == []:
+      print('ERROR: Got no levels to sweep')
+      return(None)
+    return(tuple(np.concatenate(arrays) for arrays in zip(*runs)))
+
+  async def _runSweep(self, cmds, n):
+    """Sends the sweep settings that changed, runs it and reads it back
+    """
+    for line in self.state.batch(self.state.changed(cmds)):
+      await self._write(line)
+    return(self._parseSweep(await self.transport.ask('READ?', **self._sweepQuery(n))))
@@ -1,42 +1,180 @@
 # written by grey@christoforo.net
 # on 15 Nov 2017
 
-import serial
 import time
-import sys
+import json
+import numpy as np
+import collections
+from scpi import SerialTransport, PipelinedTransport, AsyncTransport, ScpiState
 
-class K6485:
-  """keithley 6485 library
+class K6485Core:
+  """keithley 6485 command building and reply parsing
+  shared by the blocking (K6485) and asyncio (AsyncK6485) libraries
   """
   port = None
+  transport = None
+  state = None # ScpiState, what the picoammeter is configured with
   expectedDeviceString = 'KEITHLEY INSTRUMENTS INC.,MODEL 6485,4038279,C01   Jun 23 2010 12:22:00/A02  /H\r\n'
   outOnSettleTime = 0.5 # seconds to settle after output turned on
-  def __init__(self, port='/dev/ttyUSB0', baud=57600, timeout=30):
+  bufferSize = 2500 # readings the instrument's trace buffer can hold
+  lineFrequency = 50 # Hz, sets how long one power line cycle takes
+  # reading transfer formats, binary ones are sent little endian (:FORM:BORD SWAP)
+  dataFormats = {'ASCII': None, 'SREAL': '<f4', 'DREAL': '<f8'}
+  dataFormat = 'ASCII'
+  nplc = 10.0
+  nMean = 1
+  t = False
+  connectDeadline = 2.0 # seconds to wait for the ident reply when connecting
+  zcorMaxAge = 3600 # seconds a zero correction is reused for with zeroCorrect='auto'
+  zcorFile = '/var/tmp/k6485Zcor.json' # when each port last acquired a zero correction
+
+  def _isIdent(self, line):
+    """True for an *IDN? reply line
+    """
+    return('KEITHLEY' in line)
+
+  def _currentSetupCmds(self,nplc=10.0,nMean=1,t=False,dataFormat='ASCII'):
+    """Commands that setup sourcemeter for current measurements
+    """
+    self.nplc = nplc
+    self.nMean = nMean
+    self.t = (t == True)
+    cmds = """:TRIG:COUN 1
+      :TRAC:FEED:CONT NEV
+      :SYST:ZCOR ON
+      :CURR:RANG MIN
+      :SYST:ZCH OFF
+      """
+    cmds = cmds.splitlines()
+    cmds.append(':CURR:NPLC {:}'.format(nplc))
+    
+    if t == False:
+      cmds.append(':FORM:ELEM READ')
+    elif t == True:
+      cmds.append(':FORM:ELEM READ, TIME')
+    else:
+      print('ERROR: time parameter data type')
+      cmds.append(':FORM:ELEM READ')
+    
+    if dataFormat not in self.dataFormats:
+      print('ERROR: Got invalid dataFormat value')
+      dataFormat = 'ASCII'
+    self.dataFormat = dataFormat
+    if dataFormat == 'ASCII':
+      cmds.append(':FORM:DATA ASC')
+    else:
+      cmds.append(':FORM:BORD SWAP')
+      cmds.append(':FORM:DATA {:}'.format(dataFormat))
+    
+    nMean = int(nMean)
+    if nMean == 1:
+      cmds.append(':SENS:AVER:STAT 0')
+    elif (nMean > 1) and (nMean <= 100):
+      cmds.append(':SENS:AVER:STAT 1')
+      cmds.append(':SENS:AVER:TCON REP')
+      cmds.append(':SENS:AVER:COUN {:}'.format(nMean))
+    else:
+      print('ERROR: Got invalid nMean value')
+    
+    cmds = [cmd.strip() for cmd in cmds if cmd.strip() != '']
+    return(cmds)
+
+  def _zcorCmds(self, zeroCorrect='auto'):
+    """Commands that acquire a new zero correction, or none if it isn't needed
+    zeroCorrect True always acquires, False keeps whatever the picoammeter has and
+    'auto' reuses one that's on and younger than zcorMaxAge
+    """
+    if zeroCorrect == 'auto':
+      fresh = (time.time() - self._zcorTime()) < self.zcorMaxAge
+      zeroCorrect = not (fresh and self.state.isSet(':SYST:ZCOR', 'ON'))
+    if zeroCorrect == True:
+      cmds = """:TRIG:COUN 1
+        :TRAC:FEED:CONT NEV
+        :SYST:ZCH ON
+        :CURR:RANG 2e-9
+        :INIT
+        :SYST:ZCOR:ACQ
+        """
+      return([cmd.strip() for cmd in cmds.splitlines() if cmd.strip() != ''])
+    return([])
+
+  def _zcorTime(self):
+    """When this port last acquired a zero correction [s since epoch], 0 for never
+    """
+    try:
+      with open(self.zcorFile) as f:
+        return(json.load(f).get(self.port.port, 0))
+    except:
+      return(0)
+
+  def _zcorRecord(self):
+    """Notes that this port just acquired a zero correction
+    """
+    try:
+      with open(self.zcorFile) as f:
+        times = json.load(f)
+    except:
+      times = {}
+    times[self.port.port] = time.time()
+    try:
+      with open(self.zcorFile, 'w') as f:
+        json.dump(times, f)
+    except:
+      print('ERROR: Could not record zero correction time in', self.zcorFile)
+
+  def _readingQuery(self):
+    """READ? reply layout as transport keyword arguments
+    """
+    if self.dataFormat != 'ASCII':
+      return({'nVals': 2 if self.t else 1, 'dtype': self.dataFormats[self.dataFormat], 'parse': self._parseReading})
+    else:
+      return({'parse': self._parseReading})
+
+  def _parseReading(self, reply):
+    """Turns one READ? reply (text or binary) into a float or [current, time]
+    """
+    if isinstance(reply, str):
+      vals = reply.split(',')
+    else:
+      vals = reply.tolist()
+    if len(vals) == 1:
+      ret = float(vals[0])
+    else:
+      ret = [float(val) for val in vals ]
+    return(ret)
+
+  def _burstDuration(self, n):
+    """Estimates how long n readings take at the current setup [s]
+    """
+    return(n * max(int(self.nMean), 1) * self.nplc / self.lineFrequency + 1)
+
+class K6485(K6485Core):
+  """keithley 6485 library
+  """
+  def __init__(self, port='/dev/ttyUSB0', baud=57600, timeout=30, pipelineDepth=1):
     """keithley 6485 library constructor
+    pipelineDepth > 1 lets that many queries be in flight at once (see iterCurrent)
     """
 
-    # flush the read buffer here
-    self.port = serial.Serial(port,baud,timeout=1)
-    self._write('*RST')
-    self.port.flush()
-    if sys.version_info[0] > 3:
-      self.port.reset_output_buffer()
-      self.port.reset_input_buffer()
-    c = b'c'
-    while c is not b'':
-      c = self.port.read()
-      #print('Flush Read:', c)
-    self.port.close()
+    if pipelineDepth > 1:
+      self.transport = PipelinedTransport(port, baud, timeout, depth=pipelineDepth)
+    else:
+      self.transport = SerialTransport(port, baud, timeout)
+    self.port = self.transport.port
 
-    self.port = serial.Serial(port,baud,timeout=timeout)
-    identStr = self._qu('*IDN?')
+    # clear status (settings are kept for currentSetup to diff against),
+    # then skip past anything stale still on the line until the ident comes back
+    self.state = ScpiState()
+    self.transport.write('*CLS')
+    identStr = self.transport.sync('*IDN?', self._isIdent, self.connectDeadline)
 
-    if identStr == self.expectedDeviceString:
+    # a stale partial line can end up glued to the front of the reply
+    if identStr.endswith(self.expectedDeviceString):
       pass
       #print('Conected to', deviceString.decode("utf-8"))
     else:
       print('ERROR: Got unexpected device string:', identStr)
-      self.port.close()
+      self.transport.close()
       
   def __del__(self):
     """keithley 24xx library deconstructor
@@ -59,69 +197,171 @@ class K6485:
       pass
     
     try:
-      self.port.close()
+      self.transport.close()
     except:
       pass
     
   def _write(self,cmd):
     """Send command to sourcemeter
     """
-    toSend = cmd.encode('utf-8') + b'\n'
-    self.port.write(toSend)
+    self.transport.write(cmd)
     
-  def _qu(self,cmd):
+  def _qu(self,cmd,timeout=None):
     """Query sourcemeter with command
-    """    
-    self._write(cmd)
-    result = self.port.readline()
-    decoded = result.decode('utf-8')
-    return(decoded) 
+    """
+    return(self.transport.query(cmd, timeout=timeout))
+
+  def _quBinary(self,cmd,nVals):
+    """Query sourcemeter with command, expecting nVals binary values back
+    """
+    return(self.transport.queryBinary(cmd, nVals, self.dataFormats[self.dataFormat]))
     
-  def currentSetup(self,nplc=10.0,nMean=1,t=False):
+  def currentSetup(self,nplc=10.0,nMean=1,t=False,dataFormat='ASCII',reset=False,zeroCorrect='auto'):
     """Setup sourcemeter for current measurements
+    dataFormat is ASCII, SREAL or DREAL (binary, 4 or 8 bytes per reading)
+    only settings the picoammeter doesn't already have are sent,
+    reset=True starts over from *RST instead
+    zeroCorrect is True (acquire one), False (keep the current one) or 'auto'
+    (acquire unless one younger than zcorMaxAge is on)
     """
-    cmds = """*RST
-      :SYST:ZCH ON
-      :CURR:RANG 2e-9
-      INIT
-      :SYST:ZCOR:ACQ
-      :SYST:ZCOR ON
-      :CURR:RANG MIN
-      :SYST:ZCH OFF
-      """
-    cmds = cmds.splitlines()
-    cmds.append(':CURR:NPLC {:}'.format(nplc))
-    
-    if t == False:
-      cmds.append(':FORM:ELEM READ')
-    elif t == True:
-      cmds.append(':FORM:ELEM READ, TIME')
-    else:
-      print('ERROR: time parameter data type')
-      cmds.append(':FORM:ELEM READ')
-    
-    nMean = int(nMean)
-    if nMean == 1:
-      cmds.append(':SENS:AVER:STAT 0')
-    elif (nMean > 1) and (nMean <= 100):
-      cmds.append(':SENS:AVER:STAT 1')
-      cmds.append(':SENS:AVER:TCON REP')
-      cmds.append(':SENS:AVER:STAT {:}'.format(nMean))
-    else:
-      print('ERROR: Got invalid nMean value')
-    
-    for cmd in cmds:
-      cmd = cmd.strip()
-      #print('Sending', cmd)
-      self._write(cmd)
+    cmds = self._currentSetupCmds(nplc, nMean, t, dataFormat)
+    if reset:
+      self._write('*RST')
+      self.state.reset()
+    elif not self.state.known:
+      self.state.seed(self._qu(self.state.seedQuery(cmds)))
+    zcorCmds = self._zcorCmds(zeroCorrect)
+    for line in self.state.batch(self.state.changed(zcorCmds + cmds)):
+      #print('Sending', line)
+      self._write(line)
       #print(self._qu('STAT:QUE?'))
+    if zcorCmds != []:
+      self._zcorRecord()
       
   def getCurrent(self):
     """Reads current from sourcemeter
     """    
-    vals = self._qu('READ?').split(',')
-    if len(vals) == 1:
-      ret = float(vals[0])
-    else:
-      ret = [float(val) for val in vals ]
+    return(self.getCurrentFuture().result())
+
+  def getCurrentFuture(self):
+    """Starts a current reading, returns a Future for its value
+    """
+    return(self.transport.submit('READ?', **self._readingQuery()))
+
+  def iterCurrent(self, n=-1):
+    """Yields n currents (-1 for infinity) in order
+    keeps up to pipelineDepth READ? queries in flight
+    """
+    inFlight = collections.deque()
+    m = 0
+    while True:
+      while (m != n) and (len(inFlight) < self.transport.depth):
+        inFlight.append(self.getCurrentFuture())
+        m = m + 1
+      if len(inFlight) == 0:
+        break
+      yield inFlight.popleft().result()
+
+  def getCurrentBurst(self, n):
+    """Reads n currents in one go via the picoammeter's trace buffer
+    returns a numpy array of currents, or an (n,2) array of [current, time]
+    rows if timestamps were enabled in currentSetup
+    """
+    nElem = 2 if self.t else 1
+    n = int(n)
+    ret = np.empty(n*nElem)
+    done = 0
+    while done < n:
+      nBurst = min(n - done, self.bufferSize)
+      ret[done*nElem:(done+nBurst)*nElem] = self._burst(nBurst, nElem)
+      done = done + nBurst
+    if self.t:
+      ret = ret.reshape(n, nElem)
     return(ret)
+
+  def _burst(self, n, nElem):
+    """Fills the trace buffer with n readings and reads it back
+    """
+    cmds = []
+    cmds.append(':TRAC:CLE')
+    cmds.append(':TRAC:POIN {:}'.format(n))
+    cmds.append(':TRAC:FEED SENS')
+    cmds.append(':TRAC:FEED:CONT NEXT')
+    cmds.append(':TRIG:COUN {:}'.format(n))
+    for line in self.state.batch(cmds):
+      self._write(line)
+
+    # *OPC? only answers once the buffer is full, so wait at least that long
+    self._write(':INIT')
+    self._qu('*OPC?', timeout=self._burstDuration(n) * 2)
+    if self.dataFormat == 'ASCII':
+      vals = np.fromstring(self._qu(':TRAC:DATA?'), sep=',')
+    else:
+      vals = self._quBinary(':TRAC:DATA?', n*nElem)
+
+    # back to one reading per READ?
+    self._write(':TRAC:FEED:CONT NEV;:TRIG:COUN 1')
+    return(vals)
+
+class AsyncK6485(K6485Core):
+  """keithley 6485 library for asyncio
+  connect with await AsyncK6485.open(...) so many instruments can share one event loop
+  """
+  def __init__(self, transport):
+    """wraps an already open AsyncTransport, see open()
+    """
+    self.transport = transport
+    self.port = transport.port
+    self.state = ScpiState()
+
+  @classmethod
+  async def open(cls, port='/dev/ttyUSB0', baud=57600, timeout=30):
+    """keithley 6485 asyncio library constructor
+    """
+    self = cls(AsyncTransport(port, baud, timeout))
+    await self._write('*CLS')
+    identStr = await self.transport.sync('*IDN?', self._isIdent, self.connectDeadline)
+    if not identStr.endswith(self.expectedDeviceString):
+      print('ERROR: Got unexpected device string:', identStr)
+      self.transport.close()
+    return(self)
+
+  async def close(self):
+    """lets go of the port
+    """
+    self.transport.close()
+
+  async def _write(self,cmd):
+    """Send command to sourcemeter
+    """
+    await self.transport.write(cmd)
+
+  async def _qu(self,cmd,timeout=None):
+    """Query sourcemeter with command
+    """
+    return(await self.transport.query(cmd, timeout=timeout))
+
+  async def currentSetup(self,nplc=10.0,nMean=1,t=False,dataFormat='ASCII',reset=False,zeroCorrect='auto'):
+    """Setup sourcemeter for current measurements
+    dataFormat is ASCII, SREAL or DREAL (binary, 4 or 8 bytes per reading)
+    only settings the picoammeter doesn't already have are sent,
+    reset=True starts over from *RST instead
+    zeroCorrect is True (acquire one), False (keep the current one) or 'auto'
+    (acquire unless one younger than zcorMaxAge is on)
+    """
+    cmds = self._currentSetupCmds(nplc, nMean, t, dataFormat)
+    if reset:
+      await self._write('*RST')
+      self.state.reset()
+    elif not self.state.known:
+      self.state.seed(await self._qu(self.state.seedQuery(cmds)))
+    zcorCmds = self._zcorCmds(zeroCorrect)
+    for line in self.state.batch(self.state.changed(zcorCmds + cmds)):
+      await self._write(line)
+    if zcorCmds != []:
+      self._zcorRecord()
+
+  async def getCurrent(self):
+    """Reads current from sourcemeter
+    """
+    return(await self.transport.ask('READ?', **self._readingQuery()))
@@ -0,0 +1,209 @@
+# latency histograms and counters for the acquisition hot paths
+# off by default, when off timer() hands back one shared do-nothing context
+# manager and count()/observe() return straight away, so leaving the
+# instrumentation in costs a fraction of a microsecond per call
+#
+#   import metrics
+#   metrics.enable()
+#   exporter = metrics.Exporter('metrics.jsonl', interval=10, port=8765)
+#   ...
+#   print(metrics.report())
+#
+# names are 'stage.what', e.g. scpi.serialRead, ps4262.usbTransfer,
+# dtu.hdf5Append, so report() shows which stage the time goes to
+
+import bisect
+import json
+import math
+import threading
+import time
+import http.server
+
+enabled = False
+_lock = threading.Lock()
+_histograms = {} # name -> Histogram
+_counters = {} # name -> count
+_started = time.time()
+# timers (by name prefix) that take in other timers' time, or aren't time
+# spent at all, report() lists them but leaves them out of the % shares
+enclosing = {'scpi.query ', # serialWrite, serialRead and parse
+             'ps4262.deadTime', # usbTransfer and rearm
+             'dtu.snapshot', # the pvGets
+             'dtu.shotLateness'}
+
+class Histogram:
+  """durations in log2 buckets from 1 us up, with count, sum, min and max
+  """
+  edges = [1e-6 * 2 ** i for i in range(28)] # 1 us to about 2 minutes
+  def __init__(self):
+    self.buckets = [0] * (len(self.edges) + 1)
+    self.n = 0
+    self.total = 0.0
+    self.min = math.inf
+    self.max = 0.0
+
+  def add(self, seconds):
+    self.buckets[bisect.bisect_left(self.edges, seconds)] += 1
+    self.n = self.n + 1
+    self.total = self.total + seconds
+    self.min = min(self.min, seconds)
+    self.max = max(self.max, seconds)
+
+  def percentile(self, p):
+    """upper edge of the bucket the p'th percentile falls in [s]"""
+    if self.n == 0:
+      return math.nan
+    rank = p / 100 * self.n
+    seen = 0
+    for (i, count) in enumerate(self.buckets):
+      seen = seen + count
+      if seen >= rank and count > 0:
+        return min(self.edges[i] if i < len(self.edges) else self.max, self.max)
+    return self.max
+
+  def summary(self):
+    return {'n': self.n, 'total': self.total, 'mean': self.total / self.n if self.n else math.nan,
+            'min': self.min if self.n else math.nan, 'max': self.max,
+            'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99)}
+
+class _Timer:
+  """times a with block into a histogram"""
+  __slots__ = ('name', 't0')
+  def __init__(self, name):
+    self.name = name
+
+  def __enter__(self):
+    self.t0 = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    observe(self.name, time.perf_counter() - self.t0)
+    return False
+
+class _NoTimer:
+  """what timer() gives out while metrics are off"""
+  __slots__ = ()
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+_noTimer = _NoTimer()
+
+def enable():
+  global enabled
+  enabled = True
+
+def disable():
+  global enabled
+  enabled = False
+
+def reset():
+  """forgets everything recorded so far"""
+  global _started
+  with _lock:
+    _histograms.clear()
+    _counters.clear()
+    _started = time.time()
+
+def timer(name):
+  """with metrics.timer('stage.what'): ... adds the block's duration to that histogram"""
+  if not enabled:
+    return _noTimer
+  return _Timer(name)
+
+def observe(name, seconds):
+  """adds a duration measured elsewhere"""
+  if not enabled:
+    return
+  with _lock:
+    histogram = _histograms.get(name)
+    if histogram is None:
+      histogram = _histograms[name] = Histogram()
+    histogram.add(seconds)
+
+def count(name, n=1):
+  if not enabled:
+    return
+  with _lock:
+    _counters[name] = _counters.get(name, 0) + n
+
+def snapshot():
+  """everything recorded so far as a JSON-able dict"""
+  with _lock:
+    return {'time': time.time(), 'since': _started,
+            'timers': {name: h.summary() for (name, h) in _histograms.items()},
+            'counters': dict(_counters)}
+
+def report(snap=None):
+  """the timers by total time (and share of the time the stages took), then the counters
+  enclosing timers get no share, so no time is counted twice
+  """
+  if snap is None:
+    snap = snapshot()
+  timers = sorted(snap['timers'].items(), key=lambda item: -item[1]['total'])
+  prefixes = tuple(enclosing)
+  grand = sum(t['total'] for (name, t) in timers if not name.startswith(prefixes)) or 1.0
+  lines = ['{:<32} {:>8} {:>9} {:>6} {:>9} {:>9} {:>9}'.format('timer', 'n', 'total [s]', '%', 'mean [ms]', 'p99 [ms]', 'max [ms]')]
+  for (name, t) in timers:
+    share = '' if name.startswith(prefixes) else '{:.1f}'.format(100 * t['total'] / grand)
+    lines.append('{:<32} {:>8} {:>9.3f} {:>6} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+      name, t['n'], t['total'], share, t['mean'] * 1e3, t['p99'] * 1e3, t['max'] * 1e3))
+  for (name, n) in sorted(snap['counters'].items()):
+    lines.append('{:<32} {:>8}'.format(name, n))
+  return '\n'.join(lines)
+
+class Exporter:
+  """
+  writes a snapshot() as one JSON line to fileName every interval seconds
+  and/or serves the latest one at http://127.0.0.1:port/metrics
+  (and report() at /report), stop() writes a last one
+  """
+  def __init__(self, fileName=None, interval=10, port=None):
+    self.fileName = fileName
+    self.interval = interval
+    self.stopping = threading.Event()
+    self.server = None
+    if port is not None:
+      self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), _MetricsHandler)
+      self.serverThread = threading.Thread(name='metricsServer', target=self.server.serve_forever, daemon=True)
+      self.serverThread.start()
+    self.thread = threading.Thread(name='metricsExporter', target=self._exportLoop, daemon=True)
+    self.thread.start()
+
+  def _write(self):
+    if self.fileName is not None:
+      with open(self.fileName, 'a') as f:
+        f.write(json.dumps(snapshot(), default=float) + '\n')
+
+  def _exportLoop(self):
+    while not self.stopping.wait(self.interval):
+      self._write()
+
+  def stop(self):
+    self.stopping.set()
+    self.thread.join()
+    self._write()
+    if self.server is not None:
+      self.server.shutdown()
+      self.server.server_close()
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path == '/metrics':
+      (body, kind) = (json.dumps(snapshot(), default=float), 'application/json')
+    elif self.path == '/report':
+      (body, kind) = (report(), 'text/plain')
+    else:
+      self.send_error(404)
+      return
+    body = body.encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', kind)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
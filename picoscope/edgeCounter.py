@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+# persistent trigger counter kept in a small memory mapped file
+# run this file to print the count without touching the scope:
+#   ./edgeCounter.py [/var/tmp/edgeCount.bin]
+# or to check that counts (and resets) survive reopening:
+#   ./edgeCounter.py --check
+
+import mmap
+import os
+import pickle
+import struct
+import sys
+import tempfile
+import time
+
+class EdgeCounter:
+    """
+    a count that survives restarts, updated in place through mmap
+    the file holds a magic string then two slots of (generation, count, check),
+    updates go to alternating slots with the next generation so a write torn
+    by a crash or power cut can only spoil one of them and the other still
+    holds the previous count, the newest valid generation is the count
+    (not the highest count, a reset to 0 has to win over the old one)
+    """
+    magic = b'EDGECNT2'
+    magicV1 = b'EDGECNT1' # slots of (count, count ^ mask), converted on open
+    mask = 0x5a5a5a5a5a5a5a5a
+    slot = struct.Struct('<QQQ')
+    slotV1 = struct.Struct('<QQ')
+    fileLength = 8 + 2 * 24
+    def __init__(self, fileName, syncInterval = 1.0):
+        """
+        opens (or creates) the counter file
+        syncInterval is the most seconds between pushes to disk, None to
+        leave it to the OS until close(), files left by the old pickle
+        based counter are converted keeping their count
+        """
+        self.fileName = fileName
+        self.syncInterval = syncInterval
+        self.lastSync = time.monotonic()
+        fd = os.open(fileName, os.O_RDWR | os.O_CREAT, 0o644)
+        self.fp = os.fdopen(fd, 'r+b')
+        head = self.fp.read(len(self.magic))
+        if head != self.magic:
+            count = self._oldCount(head + self.fp.read())
+            self.fp.seek(0)
+            self.fp.truncate()
+            self.fp.write(self.magic + (self.slot.pack(0, count, self._check(0, count)) * 2))
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+        self.map = mmap.mmap(self.fp.fileno(), self.fileLength)
+        (self.value, self.generation, self.nextSlot) = self._recover(self.map)
+
+    def __del__(self):
+        try:
+            self.close()
+        except:
+            pass
+
+    @staticmethod
+    def _legacyCount(contents):
+        """count stored in a pickle by earlier versions, 0 for an empty or unreadable file"""
+        try:
+            return int(pickle.loads(contents))
+        except:
+            return 0
+
+    @classmethod
+    def _oldCount(cls, contents):
+        """count stored by earlier versions, in EDGECNT1 slots or a pickle"""
+        if not contents.startswith(cls.magicV1):
+            return cls._legacyCount(contents)
+        counts = []
+        for i in range(2):
+            (count, check) = cls.slotV1.unpack_from(contents, len(cls.magicV1) + 16 * i)
+            if check == count ^ cls.mask:
+                counts.append(count)
+        # these don't say which slot is newer, the highest is the best guess
+        return max(counts, default=0)
+
+    @classmethod
+    def _check(cls, generation, count):
+        """check word for a slot, a torn write mixing old and new words won't match it"""
+        return (generation * 0x9e3779b97f4a7c15 ^ count ^ cls.mask) & 0xffffffffffffffff
+
+    @classmethod
+    def _recover(cls, buf):
+        """returns (count, generation, slot to write next) from the bytes of a counter file"""
+        valid = []
+        for i in range(2):
+            (generation, count, check) = cls.slot.unpack_from(buf, len(cls.magic) + cls.slot.size * i)
+            if check == cls._check(generation, count):
+                valid.append((generation, i, count))
+        if valid == []:
+            raise ValueError("both slots of the edge counter are corrupt")
+        (generation, i, count) = max(valid)
+        return (count, generation, 1 - i)
+
+    @classmethod
+    def read(cls, fileName):
+        """returns the count in fileName, safe to call while a driver is counting"""
+        with open(fileName, 'rb') as fp:
+            buf = fp.read(cls.fileLength)
+        if not buf.startswith(cls.magic):
+            return cls._oldCount(buf)
+        return cls._recover(buf)[0]
+
+    def set(self, count):
+        """stores a new count"""
+        self.value = count
+        self.generation = self.generation + 1
+        self.slot.pack_into(self.map, len(self.magic) + self.slot.size * self.nextSlot,
+                            self.generation, count, self._check(self.generation, count))
+        self.nextSlot = 1 - self.nextSlot
+        if (self.syncInterval is not None) and (time.monotonic() - self.lastSync >= self.syncInterval):
+            self.sync()
+
+    def add(self, n = 1):
+        """adds n to the count and returns the new count"""
+        self.set(self.value + n)
+        return self.value
+
+    def sync(self):
+        """pushes the count to disk now"""
+        self.map.flush()
+        self.lastSync = time.monotonic()
+
+    def close(self):
+        if self.map.closed:
+            return
+        self.sync()
+        self.map.close()
+        self.fp.close()
+
+def check():
+    """counts, resets, torn writes and old files all come back right after reopening"""
+    with tempfile.TemporaryDirectory() as directory:
+        fileName = os.path.join(directory, 'edgeCount.bin')
+        counter = EdgeCounter(fileName)
+        counter.add(5000)
+        counter.add(1)
+        counter.close()
+        assert EdgeCounter.read(fileName) == 5001
+        counter = EdgeCounter(fileName)
+        assert counter.value == 5001
+        counter.set(0)
+        counter.close()
+        assert EdgeCounter.read(fileName) == 0, "reset lost on reopening"
+        counter = EdgeCounter(fileName)
+        assert counter.value == 0, "reset lost on reopening"
+        counter.add(7)
+        # tear the newest write, the previous count has to come back
+        newest = 1 - counter.nextSlot
+        counter.map[len(EdgeCounter.magic) + EdgeCounter.slot.size * newest + 8] ^= 0xff
+        counter.close()
+        assert EdgeCounter.read(fileName) == 0, "torn write not rolled back"
+
+        with open(fileName, 'wb') as fp:
+            fp.write(EdgeCounter.magicV1 + EdgeCounter.slotV1.pack(42, 42 ^ EdgeCounter.mask) * 2)
+        counter = EdgeCounter(fileName)
+        assert counter.value == 42, "EDGECNT1 file not converted"
+        counter.set(0)
+        counter.close()
+        assert EdgeCounter(fileName).value == 0
+        with open(fileName, 'wb') as fp:
+            fp.write(pickle.dumps(12))
+        assert EdgeCounter(fileName).value == 12, "pickle file not converted"
+    print("edge counter ok")
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ['--check']:
+        check()
+    else:
+        fileName = sys.argv[1] if len(sys.argv) > 1 else '/var/tmp/edgeCount.bin'
+        print(EdgeCounter.read(fileName))
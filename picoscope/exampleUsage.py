@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 from ps4262 import ps4262
-import pylab as plt
+from livePlot import LivePlot
 import time
 import sys
 
@@ -16,29 +16,23 @@ print("Metadata:")
 print (ps.getMetadata())
 print("")
 
-def plot(x,y):
-    plt.ion()
-    plt.figure()
-    plt.plot(x, y*1e9)
-    plt.grid(True)
-    plt.title("Picoscope 4000 waveform")
-    plt.ylabel("Current [nA]")
-    plt.xlabel("Time [s]")
-    #plt.legend()
-    plt.show()
-    plt.pause(.001)
+# one window for the whole run, showing the last 5 captures
+plot = LivePlot(nTraces = 5)
 
 i = 0
 while i < 5:
-    i = i + 1
     print("Waiting for data...")
-    data = ps.getData() # this call will block until data is ready
+    data = ps.getData(timeout = 0.1)
+    if data is None:
+        plot.pause(0.05) # keep the window alive while we wait
+        continue
+    i = i + 1
     print("Data ready!")
-    x = data["time"]
-    y = data["current"]
     print("Drawing plot from trigger number", data["nTriggers"])
     # plot the data
-    plot(x,y)
+    plot.push(data)
+    data.release() # the plot keeps its own cut down copy
+    plot.pause(0.001)
     print("")
 
 print("Trigger frequency is", ps.triggerFrequency, "[Hz]")
@@ -49,10 +43,10 @@ time.sleep(5)
 
 print("We've seen", ps.edgesCaught, "triggers since the beginning of time.")
 
-# this is the only way I can get the threads to shutdown gracefully
-ps.edgeCounterEnabled = False
+# stop capturing
+ps.stop()
 
-time.sleep(10) # give the user a chance to look at the plots
+plot.pause(10) # give the user a chance to look at the plots
 
 # reset the global trigger count to 0
 ps.resetTriggerCount()
@@ -0,0 +1,253 @@
+# stand-in for picoscope.ps4000.PS4000 so ps4262 can run without the scope
+# written against the subset of the pico-python API that ps4262 uses
+
+import numpy as np
+import threading
+import time
+
+def _value(arg):
+    """python value of a ctypes argument"""
+    return getattr(arg, 'value', arg)
+
+class FakeLib:
+    """
+    the ps4000 driver calls pico-python leaves unwrapped (streaming),
+    takes the same ctypes arguments as the real library
+    """
+    picoOk = 0x00
+    picoBusy = 0x27
+    def __init__(self, scope):
+        self.scope = scope
+        self.buffer = None
+        self.streamStart = None
+
+    def ps4000SetDataBuffer(self, handle, channel, bufferPtr, bufferLth):
+        self.buffer = np.ctypeslib.as_array(bufferPtr, shape=(_value(bufferLth),))
+        return self.picoOk
+
+    def ps4000RunStreaming(self, handle, sampleInterval, sampleIntervalTimeUnits, maxPreTriggerSamples, maxPostTriggerSamples, autoStop, downSampleRatio, overviewBufferSize):
+        interval = sampleInterval._obj
+        self.streamInterval = interval.value * 10.0 ** (3 * _value(sampleIntervalTimeUnits) - 15)
+        self.streamStart = time.monotonic()
+        self.produced = 0 # samples the scope has made
+        self.writeIndex = 0 # where the next one goes in the buffer
+        return self.picoOk
+
+    def ps4000GetStreamingLatestValues(self, handle, callback, parameter):
+        if self.streamStart is None:
+            return self.picoBusy
+        made = int((time.monotonic() - self.streamStart) / self.streamInterval)
+        n = made - self.produced
+        if n == 0:
+            return self.picoBusy
+        # like the driver, the buffer only holds its length of the newest samples
+        if n > len(self.buffer):
+            self.produced = made - len(self.buffer)
+            n = len(self.buffer)
+        n = min(n, len(self.buffer) - self.writeIndex)
+        startIndex = self.writeIndex
+        self.buffer[startIndex:startIndex+n] = self.scope._stream(self.produced, n, self.streamInterval)
+        self.produced = self.produced + n
+        self.writeIndex = (self.writeIndex + n) % len(self.buffer)
+        callback(_value(handle), n, startIndex, 0, 0, 0, 0, None)
+        return self.picoOk
+
+    def ps4000Stop(self, handle):
+        self.streamStart = None
+        return self.picoOk
+
+class PS4000:
+    """
+    simulated PS4262: triggers arrive from the AWG at the rate set with
+    setAWGSimple and each capture holds a current pulse on top of noise
+    pass an instance to ps4262(ps=...)
+    """
+    CHANNELS = {"A": 0, "B": 1, "C": 2, "D": 3, "EXT": 4}
+    maxValue = 32767
+    memorySamples = 16 * 1024 * 1024 # samples of capture memory
+    pulseHeight = 0.5 # volts at the scope input
+    pulseTau = 5e-3 # seconds, pulse decay time
+    noise = 0.01 # volts rms
+    def __init__(self, serialNumber=None, connect=True):
+        self.handle = 1
+        self.lib = FakeLib(self)
+        self.rng = np.random.default_rng()
+        self.CHRange = [5.0] * 4
+        self.CHOffset = [0.0] * 4
+        self.sampleInterval = 1e-6
+        self.noSamples = 0
+        self.maxSamples = self.memorySamples
+        self.noSegments = 1
+        self.noCaptures = 1
+        self.triggerPeriod = None # seconds between AWG edges, None for no triggers
+        self.awgStart = time.monotonic()
+        self.readyAt = None
+        self.pretrig = 0.0
+        self.lock = threading.Lock()
+        self.nRuns = 0
+
+    def checkResult(self, errorCode):
+        if errorCode != FakeLib.picoOk:
+            raise IOError("Error calling simulated driver: {:#x}".format(errorCode))
+
+    def getAllUnitInfo(self):
+        return "Variant Info: 4262 (simulated)"
+
+    def getMaxValue(self):
+        return self.maxValue
+
+    def setChannel(self, channel='A', coupling="AC", VRange=2.0, VOffset=0.0, enabled=True, BWLimited=0, probeAttenuation=1.0):
+        chNum = self.CHANNELS[channel]
+        self.CHRange[chNum] = VRange
+        self.CHOffset[chNum] = VOffset
+        return VRange
+
+    def setSamplingInterval(self, sampleInterval, duration, oversample=0, segmentIndex=0):
+        self.sampleInterval = sampleInterval
+        self.noSamples = int(round(duration / sampleInterval))
+        self.maxSamples = self.memorySamples // self.noSegments
+        return (self.sampleInterval, self.noSamples, self.maxSamples)
+
+    def memorySegments(self, noSegments):
+        self.noSegments = noSegments
+        self.maxSamples = self.memorySamples // noSegments
+        return self.maxSamples
+
+    def setNoOfCaptures(self, noCaptures):
+        self.noCaptures = noCaptures
+
+    def setExtTriggerRange(self, VRange=0.5):
+        pass
+
+    def setSimpleTrigger(self, trigSrc, threshold_V=0.0, direction="Rising", delay=0, timeout_ms=100, enabled=True):
+        pass
+
+    def setAWGSimple(self, waveform, duration, offsetVoltage=None, pkToPk=None, indexMode="Single", shots=None, triggerType="Rising", triggerSource="ScopeTrig"):
+        self.triggerPeriod = duration
+        self.awgStart = time.monotonic()
+        return (duration, 0)
+
+    def setSigGenBuiltInSimple(self, offsetVoltage=0, pkToPk=2, waveType="Sine", frequency=1E6, shots=1, triggerType="Rising", triggerSource="None", stopFreq=None, increment=10.0, dwellTime=1E-3, sweepType="Up", numSweeps=0):
+        if waveType == "DC":
+            self.triggerPeriod = None
+        else:
+            self.triggerPeriod = 1 / frequency
+        self.awgStart = time.monotonic()
+
+    def _nextTrigger(self, after):
+        """time of the first AWG edge at or after `after`"""
+        n = np.ceil((after - self.awgStart) / self.triggerPeriod)
+        return self.awgStart + max(n, 0) * self.triggerPeriod
+
+    def runBlock(self, pretrig=0.0, segmentIndex=0, callback=None):
+        with self.lock:
+            self.nRuns = self.nRuns + 1
+            self.pretrig = pretrig
+            captureTime = self.noSamples * self.sampleInterval
+            if self.triggerPeriod is None:
+                self.readyAt = None # waits forever, like timeout_ms = 0
+                return
+            # each capture needs its pre-trigger samples before it can accept a trigger
+            t = time.monotonic()
+            for i in range(self.noCaptures):
+                t = self._nextTrigger(t + pretrig * captureTime) + (1 - pretrig) * captureTime
+            self.readyAt = t
+            self.firstSegment = segmentIndex
+
+    def isReady(self):
+        with self.lock:
+            return (self.readyAt is not None) and (time.monotonic() >= self.readyAt)
+
+    def waitReady(self, spin_delay=0.01):
+        while not self.isReady():
+            time.sleep(spin_delay)
+
+    def stop(self):
+        with self.lock:
+            self.readyAt = None
+        self.lib.ps4000Stop(self.handle)
+
+    def close(self):
+        self.stop()
+
+    def _capture(self, numSamples):
+        """one simulated capture in raw ADC counts"""
+        t = (np.arange(numSamples) - int(round(numSamples * self.pretrig))) * self.sampleInterval
+        v = self.noise * self.rng.standard_normal(numSamples)
+        v[t >= 0] += self.pulseHeight * np.exp(-t[t >= 0] / self.pulseTau)
+        raw = np.clip(np.round(v / self.CHRange[0] * self.maxValue), -self.maxValue, self.maxValue)
+        return raw.astype(np.int16)
+
+    def _stream(self, first, n, sampleInterval):
+        """samples first to first + n of a continuous stream in raw ADC counts"""
+        t = (first + np.arange(n)) * sampleInterval
+        v = self.noise * self.rng.standard_normal(n)
+        if self.triggerPeriod is not None:
+            v += self.pulseHeight * np.exp(-np.mod(t, self.triggerPeriod) / self.pulseTau)
+        raw = np.clip(np.round(v / self.CHRange[0] * self.maxValue), -self.maxValue, self.maxValue)
+        return raw.astype(np.int16)
+
+    # the driver calls ps4262 uses for downsampled transfers
+    def _lowLevelSetDataBuffer(self, channel, data, downSampleMode, segmentIndex):
+        self.dataBuffers = (data, None)
+
+    def _lowLevelSetDataBuffers(self, channel, bufferMax, bufferMin, downSampleRatioMode):
+        self.dataBuffers = (bufferMax, bufferMin)
+
+    def _lowLevelClearDataBuffer(self, channel, segmentIndex):
+        self.dataBuffers = None
+
+    def _lowLevelClearDataBuffers(self, channel):
+        self.dataBuffers = None
+
+    def _lowLevelGetValues(self, numSamples, startIndex, downSampleRatio, downSampleMode, segmentIndex):
+        """ratio modes as in ps4000Api.h: 0 none, 1 aggregate (max, min), 2 average"""
+        (bufferMax, bufferMin) = self.dataBuffers
+        nOut = min(numSamples // downSampleRatio, len(bufferMax))
+        blocks = self._capture(numSamples)[:nOut * downSampleRatio].reshape(nOut, downSampleRatio)
+        if downSampleMode == 1:
+            bufferMax[:nOut] = blocks.max(axis=1)
+            bufferMin[:nOut] = blocks.min(axis=1)
+        elif downSampleMode == 2:
+            bufferMax[:nOut] = np.round(blocks.mean(axis=1))
+        else:
+            bufferMax[:nOut] = blocks[:, 0]
+        return (nOut, 0)
+
+    def getDataRaw(self, channel='A', numSamples=0, startIndex=0, downSampleRatio=1, downSampleMode=0, segmentIndex=0, data=None):
+        if numSamples == 0:
+            numSamples = min(self.maxSamples, self.noSamples)
+        if data is None:
+            data = np.empty(numSamples, dtype=np.int16)
+        data[:numSamples] = self._capture(numSamples)
+        return (data, numSamples, False)
+
+    def getDataRawBulk(self, channel='A', numSamples=0, fromSegment=0, toSegment=None, downSampleRatio=1, downSampleMode=0, data=None):
+        if toSegment is None:
+            toSegment = self.noSegments - 1
+        if numSamples == 0:
+            numSamples = min(self.maxSamples, self.noSamples)
+        nSegments = toSegment - fromSegment + 1
+        if data is None:
+            data = np.zeros((nSegments, numSamples), dtype=np.int16)
+        for i in range(nSegments):
+            data[i, :numSamples] = self._capture(numSamples)
+        overflow = np.zeros(nSegments, dtype=np.int16)
+        return (data, numSamples, overflow)
+
+    def rawToV(self, channel, dataRaw, dataV=None, dtype=np.float64):
+        if not isinstance(channel, int):
+            channel = self.CHANNELS[channel]
+        if dataV is None:
+            dataV = np.empty(dataRaw.shape, dtype=dtype)
+        a2v = self.CHRange[channel] / dtype(self.getMaxValue())
+        np.multiply(dataRaw, a2v, dataV)
+        np.subtract(dataV, self.CHOffset[channel], dataV)
+        return dataV
+
+    def getDataV(self, channel, numSamples=0, startIndex=0, downSampleRatio=1, downSampleMode=0, segmentIndex=0, returnOverflow=False, exceptOverflow=False, dataV=None, dataRaw=None, dtype=np.float64):
+        (dataRaw, numSamplesReturned, overflow) = self.getDataRaw(channel, numSamples, startIndex, downSampleRatio, downSampleMode, segmentIndex, dataRaw)
+        dataV = self.rawToV(channel, dataRaw[:numSamplesReturned], dataV, dtype)
+        if returnOverflow:
+            return (dataV, overflow)
+        return dataV
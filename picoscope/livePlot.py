@@ -0,0 +1,104 @@
+# one matplotlib window that keeps up with ps4262 captures
+# waveforms are cut down to about one min/max pair per screen pixel as they
+# come in, so drawing costs the same however long the captures are
+
+import collections
+import threading
+import numpy as np
+import matplotlib.pyplot as plt
+
+def minMaxDecimate(x, y, nBins):
+    """
+    reduces y(x) to the min and max of each of nBins equal bins, returns
+    (x, y) with the two interleaved (2 * nBins points) so a line through
+    them traces the waveform's envelope, plus the mean of each bin
+    short waveforms come back as they are
+    """
+    n = len(y)
+    if n <= 2 * nBins:
+        return (x, y, y)
+    k = n // nBins
+    yb = y[:nBins * k].reshape(nBins, k)
+    xb = x[:nBins * k:k] + (x[1] - x[0]) * (k - 1) / 2
+    yd = np.empty((nBins, 2))
+    yd[:, 0] = yb.min(axis=1)
+    yd[:, 1] = yb.max(axis=1)
+    return (np.repeat(xb, 2), yd.ravel(), np.repeat(yb.mean(axis=1), 2))
+
+class LivePlot:
+    """
+    live view of captures: push() them from any thread, call pause() (or
+    draw()) from the thread that owns the window
+    nTraces of the latest captures are overlaid, or with average = True
+    their mean is drawn as one trace
+    """
+    def __init__(self, nTraces = 1, average = False, title = "Picoscope 4000 waveform", scale = 1e9, ylabel = "Current [nA]"):
+        self.nTraces = nTraces
+        self.average = average
+        self.scale = scale
+        self.traces = collections.deque(maxlen=nTraces) # (x, envelope, bin means)
+        self.lock = threading.Lock()
+        self.fresh = False
+        self.nPushed = 0
+
+        plt.ion()
+        self.fig, self.ax = plt.subplots()
+        self.ax.grid(True)
+        self.ax.set_title(title)
+        self.ax.set_ylabel(ylabel)
+        self.ax.set_xlabel("Time [s]")
+        # about one bin per pixel across the axes
+        self.nBins = max(int(self.ax.get_window_extent().width), 100)
+        nLines = 1 if average else nTraces
+        self.lines = [self.ax.plot([], [], color='C0')[0] for i in range(nLines)]
+        plt.show(block=False)
+
+    def push(self, data):
+        """
+        adds a capture (a ps4262.getData() dict, or a (time, current) pair),
+        rapid block captures add one trace per segment, captures whose
+        waveform was left out (summary only, see keepWaveforms) are skipped
+        """
+        if isinstance(data, dict):
+            if ("time" not in data) or (("current" not in data) and ("raw" not in data)):
+                return
+            (x, y) = (data["time"], data["current"])
+        else:
+            (x, y) = data
+        rows = [minMaxDecimate(x, row * self.scale, self.nBins) for row in np.atleast_2d(y)]
+        with self.lock:
+            self.traces.extend(rows)
+            self.nPushed = self.nPushed + len(rows)
+            self.fresh = True
+
+    def draw(self):
+        """redraws if anything new was pushed, must be called from the window's thread"""
+        with self.lock:
+            if not self.fresh:
+                return
+            traces = list(self.traces)
+            self.fresh = False
+        if self.average:
+            # the mean of the bin means is the bin mean of the average
+            (xd, envelope, means) = traces[-1]
+            self.lines[0].set_data(xd, np.mean([t[2] for t in traces if len(t[2]) == len(means)], axis=0))
+            self.ax.set_title("mean of last {:} captures".format(len(traces)), fontsize='small', loc='right')
+        else:
+            for (i, line) in enumerate(self.lines):
+                if i < len(traces):
+                    # newest on top and darkest
+                    (xd, envelope, means) = traces[-1 - i]
+                    line.set_data(xd, envelope)
+                    line.set_alpha(1.0 - 0.8 * i / max(self.nTraces - 1, 1))
+                    line.set_zorder(self.nTraces - i)
+        self.ax.relim()
+        self.ax.autoscale_view()
+        self.fig.canvas.draw_idle()
+
+    def pause(self, interval = 0.05):
+        """draws anything new and runs the window's event loop for interval seconds"""
+        self.draw()
+        plt.pause(interval)
+
+    def close(self):
+        plt.close(self.fig)
@@ -0,0 +1,17 @@
+# what ps4262 and StreamWriter record timings and counts to unless they're
+# handed the repo's metrics module (ps4262.metrics = metrics), the same
+# calls doing nothing, so the picoscope code doesn't depend on it
+
+import contextlib
+
+enabled = False
+_noTimer = contextlib.nullcontext()
+
+def timer(name):
+    return _noTimer
+
+def observe(name, seconds):
+    pass
+
+def count(name, n=1):
+    pass
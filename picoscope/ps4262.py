@@ -2,22 +2,57 @@
 # on 21 Feb 2018
 
 from picoscope import ps4000
+from edgeCounter import EdgeCounter
+from streamWriter import StreamWriter
+import pulseAnalysis
 import numpy as np
 import threading
-import pickle
+import collections
+import queue
 import time
+import ctypes
+import platform
+import noMetrics
 
-class BaseThread(threading.Thread):
-    def __init__(self, callback=None, *args, **kwargs):
-        target = kwargs.pop('target')
-        super(BaseThread, self).__init__(target=self.target_with_callback, *args, **kwargs)
-        self.callback = callback
-        self.method = target
+# ps4000StreamingReady(handle, noOfSamples, startIndex, overflow, triggerAt, triggered, autoStop, pParameter)
+_callbackType = ctypes.WINFUNCTYPE if platform.system() == 'Windows' else ctypes.CFUNCTYPE
+StreamingReadyType = _callbackType(None, ctypes.c_int16, ctypes.c_int32, ctypes.c_uint32, ctypes.c_int16,
+                                   ctypes.c_uint32, ctypes.c_int16, ctypes.c_int16, ctypes.c_void_p)
 
-    def target_with_callback(self):
-        self.method()
-        if self.callback is not None:
-            self.callback()
+class Capture(dict):
+    """
+    one capture as handed out by ps4262.getData()
+    holds the raw ADC counts, "current" in amps is only worked out
+    (and then kept) the first time it's looked up, as is "currentMin"
+    for aggregate downsampled captures
+    release() hands the raw buffer back to the driver to be reused
+    """
+    rawKeys = {"current": "raw", "currentMin": "rawMin"}
+    def __init__(self, toCurrent, releaseBuffer, buffer, *args, **kwargs):
+        super(Capture, self).__init__(*args, **kwargs)
+        self.toCurrent = toCurrent
+        self.releaseBuffer = releaseBuffer
+        self.buffer = buffer # what "raw" (and "rawMin") are views of
+
+    def release(self):
+        """
+        gives the raw buffer back for a later capture to be transferred into,
+        call it once neither "raw" nor any view of it is needed any more,
+        "raw" and "rawMin" are gone after but a "current" already worked out
+        stays, captures that are never released are just garbage collected
+        """
+        if self.buffer is None:
+            return
+        for key in self.rawKeys.values():
+            self.pop(key, None)
+        (buffer, self.buffer) = (self.buffer, None)
+        self.releaseBuffer(buffer)
+
+    def __missing__(self, key):
+        if (key not in self.rawKeys) or (self.rawKeys[key] not in self):
+            raise KeyError(key)
+        self[key] = self.toCurrent(self[self.rawKeys[key]])
+        return self[key]
 
 class ps4262:
     """
@@ -25,17 +60,48 @@ class ps4262:
     """
     currentScaleFactor = 1/10000000 # amps per volt through our LPM7721 eval board
     persistentFile = '/var/tmp/edgeCount.bin'
-    def __init__(self, VRange = 5, requestedSamplingInterval = 1e-6, tCapture = 0.3, triggersPerMinute = 30):
+    pretrig = 0.1  # 10% of the output data will be from before the trigger event
+    queuePolicies = ('block', 'dropOldest', 'grow')
+    picoBusy = 0x27 # PICO_BUSY, no new streaming data yet
+    # ps4000 RATIO_MODE values, the driver can't decimate so that's done here
+    downsampleModes = {'aggregate': 1, 'average': 2, 'decimate': 0}
+    readyPollInterval = 1e-3 # seconds between asking the scope if it's triggered
+    metrics = noMetrics # set to the repo's metrics module to time the acquisition stages
+    def __init__(self, VRange = 5, requestedSamplingInterval = 1e-6, tCapture = 0.3, triggersPerMinute = 30, queueSize = 8, queuePolicy = 'block', nSegments = 1, ps = None, streamFile = None, chunkSize = 2**16, analyse = False, keepWaveforms = 1, downsampleRatio = 1, downsampleMode = 'average'):
         """
         picotech PS4262 library constructor
+        captures wait for getData() in a queue of up to queueSize, when it's full
+        queuePolicy 'block' holds off re-arming until there's room, 'dropOldest'
+        throws away the oldest waiting capture and 'grow' lets the queue grow
+        (up to queueSize more transferred captures can be waiting for the
+        processing thread, then the acquisition thread waits too)
+        nSegments > 1 selects rapid block mode: the scope captures that many
+        triggers back-to-back in its own memory before we read them all out at once
+        ps is an already open PS4000 (or a stand-in like fakePs4000.PS4000),
+        by default the first scope found is opened
+        giving streamFile streams channel A continuously into that HDF5 file
+        at requestedSamplingInterval (see streamWriter) instead of doing
+        triggered captures, in chunkSize sample chunks until stopStreaming()
+        analyse = True adds a "summary" of each capture (see pulseAnalysis,
+        a dict here is passed on to pulseAnalysis.analyse() as its options),
+        the waveforms are then only kept for every keepWaveforms'th capture
+        (0 for never) so long runs can hold on to just the summaries
+        downsampleRatio > 1 has the scope reduce every downsampleRatio samples
+        to one before they're sent over USB, downsampleMode picks how:
+        'average' their mean, 'aggregate' their max in current and min in
+        currentMin, 'decimate' just the first (this one still transfers every
+        sample as the PS4000 can't decimate itself)
         """
         # this opens the device
-        self.ps = ps4000.PS4000()
+        if ps is None:
+            ps = ps4000.PS4000()
+        self.ps = ps
         self.edgeCounterEnabled = False
         self.lastTriggerTime = None
 
         # setup sampling interval
-        self._setTimeBase(requestedSamplingInterval = requestedSamplingInterval, tCapture = tCapture)
+        self._setTimeBase(requestedSamplingInterval = requestedSamplingInterval, tCapture = tCapture, nSegments = nSegments,
+                          downsampleRatio = downsampleRatio, downsampleMode = downsampleMode)
 
         # setup current collection channel (A)
         self._setChannel(VRange = VRange)
@@ -48,23 +114,45 @@ class ps4262:
         # 0 ms timeout means wait forever for the next trigger
         self.ps.setSimpleTrigger('EXT', 0.15, 'Rising', delay=0, timeout_ms = 0, enabled=True)
         
-        try:
-            self.fp = open(self.persistentFile, mode='r+b')
-            self.edgesCaught = pickle.load(self.fp)
-            self.fp.seek(0)
-        except:
-            self.edgesCaught = 0
-            self.fp = open(self.persistentFile, mode='wb')
-            pickle.dump(self.edgesCaught,self.fp,-1)
-            self.fp.flush()
-            self.fp.seek(0)
+        # edge count survives restarts, read it from elsewhere with EdgeCounter.read()
+        self.edgeCounter = EdgeCounter(self.persistentFile)
             
-        self.data = None
+        if queuePolicy not in self.queuePolicies:
+            raise ValueError("queuePolicy must be one of {:}".format(self.queuePolicies))
+        self.queueSize = queueSize
+        self.queuePolicy = queuePolicy
+        self.captures = collections.deque()
+        self.capturesCondition = threading.Condition()
+        self.capturesDropped = 0 # captures thrown away because nobody collected them
+        self.capturesQueued = 0 # captures ever put in the queue
+        self.analyse = analyse
+        self.analysisOptions = analyse if isinstance(analyse, dict) else {}
+        self.keepWaveforms = keepWaveforms
+        self.streaming = False
+        if streamFile is not None:
+            self.startStreaming(streamFile, chunkSize = chunkSize)
+            return
+        # dead time bookkeeping, see getDeadTimeStats()
+        self.deadTimes = collections.deque(maxlen=1000)
+        self.nCycles = 0
+        self.expectedTriggers = 0.0
+        self.acquireStart = time.monotonic()
+        self.frequencySince = self.acquireStart
+
         self.edgeCounterEnabled = True
-        # start the trigger detection thread and the data collection
-        self._runThread()
+        # transferred captures on their way from the acquisition thread to processing
+        self.rawCaptures = queue.Queue(maxsize=queueSize)
+        self.processThread = threading.Thread(name='captureProcessor', target=self._processLoop, daemon=True)
+        self.processThread.start()
+        self.acquireThread = threading.Thread(name='edgeWatcher', target=self._acquireLoop, daemon=True)
+        self.acquireThread.start()
 
     def __del__(self):        
+        try:
+            self.stop()
+        except:
+            pass
+
         try:
             self.ps.stop()
         except:
@@ -76,44 +164,231 @@ class ps4262:
             pass
         
         try:
-            self.fp.close()
+            self.edgeCounter.close()
         except:
             pass
+
+    @property
+    def edgesCaught(self):
+        return self.edgeCounter.value
         
     def resetTriggerCount(self):
-        self.edgesCaught = 0
-        pickle.dump(self.edgesCaught,self.fp,-1)
-        self.fp.flush()
-        self.fp.seek(0)
-    
-    def _runThread(self):
-        """create a new trigger detection thread and run it"""
-        self._run()
-        self.edgeThread = BaseThread( name='edgeWatcher', target=self.ps.waitReady,\
-                                      callback=self._edgeDetectCallback)
-        
-        self.edgeThread.start()
+        self.edgeCounter.set(0)
     
-    # this gets called when a trigger has been seen
-    def _edgeDetectCallback(self):
-        self.lastTriggerTime = time.gmtime() # returns seconds since 1970 GMT
-        self.edgesCaught = self.edgesCaught +  1  # incriment edge count
-        pickle.dump(self.edgesCaught,self.fp,-1)
-        self.fp.flush()
-        self.fp.seek(0)
-        
-        # store away the scope data
-        voltageData = self.ps.getDataV('A', self.nSamples, returnOverflow=False)
-        self.data = {"nTriggers": self.edgesCaught, "time": self.timeVector, "current": voltageData * self.currentScaleFactor, "timestamp": self.lastTriggerTime} 
-        
-        if self.needFGenUpdate:
-            self.edgeCounterEnabled = False
-            self.setFGen(triggersPerMinute=self.triggersPerMinute)
-            self.edgeCounterEnabled = True
-        # now spawn a new trigger detection thread
+    def stop(self):
+        """stops triggered captures (or streaming), captures already taken can still be collected"""
+        self.stopStreaming()
         if self.edgeCounterEnabled:
-            self._runThread()
+            self.edgeCounterEnabled = False
+            self.acquireThread.join()
+            self.processThread.join()
+
+    def _acquireLoop(self):
+        """
+        acquisition thread: arm, wait for the trigger, transfer, re-arm at
+        once and leave everything else to the processing thread
+        """
+        self._run()
+        while self.edgeCounterEnabled:
+            if not self.ps.isReady():
+                time.sleep(self.readyPollInterval)
+                continue
+            tReady = time.monotonic()
+            self.lastTriggerTime = time.gmtime() # returns seconds since 1970 GMT
+            nTriggers = self.edgeCounter.add(self.nSegments)  # incriment edge count
+
+            rawData = self._rawBuffer()
+            with self.metrics.timer('ps4262.usbTransfer'):
+                self._transfer(rawData)
+            with self.metrics.timer('ps4262.rearm'):
+                if self.needFGenUpdate:
+                    self._setAWG()
+                self._run()
+            deadTime = time.monotonic() - tReady
+            self.deadTimes.append(deadTime)
+            self.nCycles = self.nCycles + 1
+            self.metrics.observe('ps4262.deadTime', deadTime)
+            self.metrics.count('ps4262.triggers', self.nSegments)
 
+            item = (rawData, nTriggers, self.lastTriggerTime, deadTime)
+            del rawData
+            # time held up here is processing not keeping up
+            with self.metrics.timer('ps4262.processingBackPressure'):
+                while self.edgeCounterEnabled:
+                    try:
+                        self.rawCaptures.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+            del item
+        self.rawCaptures.put(None)
+
+    def _processLoop(self):
+        """processing thread: turns transferred raw buffers into queued captures"""
+        while True:
+            item = self.rawCaptures.get()
+            if item is None:
+                break
+            self._process(*item)
+            del item
+
+    def _process(self, rawData, nTriggers, timestamp, deadTime):
+        """builds (and analyses) the capture for one transfer and queues it for getData()"""
+        capture = Capture(self._toCurrent, self._releaseBuffer, rawData, {"nTriggers": nTriggers, "time": self.timeVector, "raw": rawData, "timestamp": timestamp, "nSegments": self.nSegments, "deadTime": deadTime})
+        if self.downsampleMode == 'aggregate':
+            (capture["raw"], capture["rawMin"]) = rawData
+        del rawData
+        if self.analyse:
+            with self.metrics.timer('ps4262.analysis'):
+                capture["summary"] = pulseAnalysis.analyse(capture["current"], self.timeVector, **self.analysisOptions)
+            if (self.keepWaveforms == 0) or (nTriggers // self.nSegments) % self.keepWaveforms != 0:
+                # summary only, the raw buffer goes straight back to the pool
+                capture.release()
+                for key in ("time", "current", "currentMin"):
+                    capture.pop(key, None)
+        self._queueCapture(capture)
+
+    def getDeadTimeStats(self):
+        """
+        Returns how long the scope spent disarmed after each trigger (seconds,
+        over the last 1000 captures, from seeing the trigger to re-arming,
+        on top of up to readyPollInterval to notice it) and an estimate of
+        the triggers missed, from triggerFrequency and the run time so far
+        """
+        deadTimes = np.array(self.deadTimes)
+        expected = self.expectedTriggers + self.awgFrequency * (time.monotonic() - self.frequencySince)
+        caught = self.nCycles * self.nSegments
+        return {"captures": self.nCycles,
+                "meanDeadTime": deadTimes.mean() if len(deadTimes) else np.nan,
+                "maxDeadTime": deadTimes.max() if len(deadTimes) else np.nan,
+                "expectedTriggers": expected,
+                "missedTriggers": max(expected - caught, 0.0)}
+
+    def startStreaming(self, fileName, chunkSize = 2**16, nChunks = 64):
+        """
+        starts the scope sampling channel A nonstop into fileName
+        the driver hands us chunkSize samples at a time at most, up to
+        nChunks of them can wait for the disk before samples get dropped
+        """
+        handle = ctypes.c_int16(self.ps.handle)
+        self.streamBuffer = np.zeros(chunkSize, dtype=np.int16)
+        m = self.ps.lib.ps4000SetDataBuffer(handle, ctypes.c_int(self.ps.CHANNELS['A']),
+                                            self.streamBuffer.ctypes.data_as(ctypes.POINTER(ctypes.c_int16)), ctypes.c_uint32(chunkSize))
+        self.ps.checkResult(m)
+
+        sampleInterval = ctypes.c_uint32(int(round(self.requestedSamplingInterval * 1e9)))
+        nsUnits = ctypes.c_int(2) # PS4000_NS
+        # no trigger, never stop on our own, no downsampling
+        m = self.ps.lib.ps4000RunStreaming(handle, ctypes.byref(sampleInterval), nsUnits, ctypes.c_uint32(0), ctypes.c_uint32(0),
+                                           ctypes.c_int16(0), ctypes.c_uint32(1), ctypes.c_uint32(chunkSize))
+        self.ps.checkResult(m)
+        self.streamInterval = sampleInterval.value * 1e-9
+
+        voltsPerCount = self.ps.CHRange[0] / self.ps.getMaxValue()
+        self.streamer = StreamWriter(fileName, self.streamInterval, voltsPerCount * self.currentScaleFactor,
+                                     self.ps.CHOffset[0] * self.currentScaleFactor, chunkSize = chunkSize, nChunks = nChunks, metrics = self.metrics)
+        # poll often enough that the driver's buffer never fills
+        self.streamPollInterval = min(0.1, chunkSize * self.streamInterval / 4)
+        self._streamingReady = StreamingReadyType(self._streamCallback) # must outlive the streaming
+        self.streaming = True
+        self.streamThread = threading.Thread(name='streamPoller', target=self._streamLoop, daemon=True)
+        self.streamThread.start()
+
+    def stopStreaming(self):
+        """stops streaming and finishes the file"""
+        if not self.streaming:
+            return
+        self.streaming = False
+        self.streamThread.join()
+        self.ps.stop()
+        self.streamer.close()
+
+    def _streamLoop(self):
+        """collects new samples from the driver until stopStreaming()"""
+        handle = ctypes.c_int16(self.ps.handle)
+        while self.streaming:
+            with self.metrics.timer('ps4262.usbStreaming'):
+                m = self.ps.lib.ps4000GetStreamingLatestValues(handle, self._streamingReady, None)
+            if m != self.picoBusy:
+                self.ps.checkResult(m)
+            time.sleep(self.streamPollInterval)
+
+    def _streamCallback(self, handle, noOfSamples, startIndex, overflow, triggerAt, triggered, autoStop, parameter):
+        """driver callback, new samples are at startIndex in streamBuffer"""
+        if noOfSamples > 0:
+            self.streamer.put(self.streamBuffer[startIndex:startIndex+noOfSamples], overRange = bool(overflow & 1))
+
+    def _transfer(self, rawData):
+        """reads the capture (every segment of it) off the scope into rawData"""
+        if self.downsampleRatio == 1:
+            if self.nSegments == 1:
+                self.ps.getDataRaw('A', self.nSamples, data=rawData)
+            else:
+                # one bulk transfer of every segment
+                self.ps.getDataRawBulk('A', numSamples=self.nSamples, fromSegment=0, toSegment=self.nSegments-1, data=rawData)
+            return
+
+        channel = self.ps.CHANNELS['A']
+        mode = self.downsampleModes[self.downsampleMode]
+        row = lambda data, segment: data if self.nSegments == 1 else data[segment]
+        # GetValuesBulk can't downsample so it's one GetValues per segment
+        for segment in range(self.nSegments):
+            if self.downsampleMode == 'decimate':
+                self.ps.getDataRaw('A', self.nSamples, segmentIndex=segment, data=self.fullCapture)
+                row(rawData, segment)[:] = self.fullCapture[:self.nDownsampled * self.downsampleRatio:self.downsampleRatio]
+            elif self.downsampleMode == 'aggregate':
+                self.ps._lowLevelSetDataBuffers(channel, row(rawData[0], segment), row(rawData[1], segment), mode)
+                self.ps._lowLevelGetValues(self.nSamples, 0, self.downsampleRatio, mode, segment)
+                self.ps._lowLevelClearDataBuffers(channel)
+            else:
+                self.ps._lowLevelSetDataBuffer(channel, row(rawData, segment), mode, segment)
+                self.ps._lowLevelGetValues(self.nSamples, 0, self.downsampleRatio, mode, segment)
+                self.ps._lowLevelClearDataBuffer(channel, segment)
+
+    def _rawBuffer(self):
+        """
+        returns a capture sized int16 buffer, one given back with
+        Capture.release() if there is one, else a new one
+        """
+        try:
+            return self.freeBuffers.pop()
+        except IndexError:
+            self.nBuffers = self.nBuffers + 1
+            return np.empty(self.captureShape, dtype=np.int16)
+
+    def _releaseBuffer(self, buf):
+        """takes a buffer back for reuse (from any thread), unless the timebase has changed since"""
+        if buf.shape == self.captureShape:
+            self.freeBuffers.append(buf)
+
+    def _toCurrent(self, rawData):
+        """converts ADC counts to amps"""
+        with self.metrics.timer('ps4262.scaling'):
+            current = self.ps.rawToV('A', rawData)
+            current *= self.currentScaleFactor
+        return current
+
+    def _queueCapture(self, capture):
+        """hands a capture to getData() according to queuePolicy"""
+        with self.capturesCondition:
+            if self.queuePolicy == 'block':
+                while (len(self.captures) >= self.queueSize) and self.edgeCounterEnabled:
+                    self.capturesCondition.wait(0.1)
+                if len(self.captures) >= self.queueSize:
+                    # shutting down with nobody reading
+                    self.capturesDropped = self.capturesDropped + 1
+                    self.metrics.count('ps4262.capturesDropped')
+                    capture.release()
+                    return
+            elif self.queuePolicy == 'dropOldest':
+                while len(self.captures) >= self.queueSize:
+                    self.captures.popleft().release()
+                    self.capturesDropped = self.capturesDropped + 1
+                    self.metrics.count('ps4262.capturesDropped')
+            self.captures.append(capture)
+            self.capturesQueued = self.capturesQueued + 1
+            self.metrics.count('ps4262.captures')
+            self.capturesCondition.notify_all()
             
     def setFGen(self, triggersPerMinute = 10):
         """Sets picoscope function generator parameters
@@ -137,31 +412,67 @@ class ps4262:
             stopFreq=1
             shots=1
         if self.edgeCounterEnabled:
+            # the acquisition thread does it between captures
             self.needFGenUpdate = True
         else:
-            nWaveformSamples = 2 ** 12
-            sPerSample = duration/nWaveformSamples
-            samplesPer5ms = int(np.floor(5e-3/sPerSample))
-            
-            waveform = np.zeros(nWaveformSamples)
-            waveform[0:samplesPer5ms] = 1
+            self._setAWG()
+
+    def _setAWG(self):
+        """programs the function generator for triggerFrequency"""
+        if hasattr(self, 'frequencySince'):
+            # close off the trigger count at the old rate
+            now = time.monotonic()
+            self.expectedTriggers = self.expectedTriggers + self.awgFrequency * (now - self.frequencySince)
+            self.frequencySince = now
+        duration = 1/self.triggerFrequency
+        nWaveformSamples = 2 ** 12
+        sPerSample = duration/nWaveformSamples
+        samplesPer5ms = int(np.floor(5e-3/sPerSample))
         
-            (waveform_duration, deltaPhase) = self.ps.setAWGSimple(
-                waveform, duration, offsetVoltage=0.0,
-                indexMode="Single", triggerSource='None', pkToPk=2.0, shots=0, triggerType="Rising")            
-            #self.ps.setSigGenBuiltInSimple(offsetVoltage=offsetVoltage, pkToPk=pkToPk, waveType=waveType, frequency=frequency, shots=shots, stopFreq=stopFreq)
-            self.needFGenUpdate = False
+        waveform = np.zeros(nWaveformSamples)
+        waveform[0:samplesPer5ms] = 1
+    
+        (waveform_duration, deltaPhase) = self.ps.setAWGSimple(
+            waveform, duration, offsetVoltage=0.0,
+            indexMode="Single", triggerSource='None', pkToPk=2.0, shots=0, triggerType="Rising")            
+        #self.ps.setSigGenBuiltInSimple(offsetVoltage=offsetVoltage, pkToPk=pkToPk, waveType=waveType, frequency=frequency, shots=shots, stopFreq=stopFreq)
+        self.awgFrequency = self.triggerFrequency
+        self.needFGenUpdate = False
 
     def _setChannel(self, VRange = 2):
         self.VRange = VRange
         channelRange = self.ps.setChannel(channel='A', coupling='DC', VRange=VRange, VOffset=0.0, enabled=True, BWLimited=0, probeAttenuation=1.0)
 
-    def _setTimeBase(self, requestedSamplingInterval=1e-6, tCapture=0.3):
+    def _setTimeBase(self, requestedSamplingInterval=1e-6, tCapture=0.3, nSegments=1, downsampleRatio=1, downsampleMode='average'):
+        if downsampleMode not in self.downsampleModes:
+            raise ValueError("downsampleMode must be one of {:}".format(tuple(self.downsampleModes)))
         self.requestedSamplingInterval = requestedSamplingInterval
         self.tCapture = tCapture
+        self.nSegments = nSegments
+        self.downsampleRatio = downsampleRatio
+        self.downsampleMode = downsampleMode if downsampleRatio > 1 else None
         
+        # the scope memory gets split evenly between the segments
+        self.ps.memorySegments(nSegments)
         (self.actualSamplingInterval, self.nSamples, maxSamples) = \
             self.ps.setSamplingInterval(sampleInterval = requestedSamplingInterval, duration = tCapture, oversample=0, segmentIndex=0)
+        if self.nSamples > maxSamples:
+            raise ValueError("{:} segments of {:} samples won't fit in the scope memory, at most {:} samples per segment".format(nSegments, self.nSamples, maxSamples))
+        self.ps.setNoOfCaptures(nSegments)
+        self.nDownsampled = self.nSamples // downsampleRatio
+        self.captureShape = (nSegments, self.nDownsampled) if nSegments > 1 else (self.nDownsampled,)
+        if self.downsampleMode == 'aggregate':
+            # max and min
+            self.captureShape = (2,) + self.captureShape
+        self.fullCapture = np.empty(self.nSamples, dtype=np.int16) if self.downsampleMode == 'decimate' else None
+        # raw buffers given back by Capture.release(), deque as they come back from other threads
+        self.freeBuffers = collections.deque()
+        self.nBuffers = 0 # raw buffers ever allocated
+        # every capture shares this, it only changes with the timebase
+        # downsampled points sit in the middle of the samples they stand for
+        firstSample = (downsampleRatio - 1) / 2 if (self.downsampleMode in ('average', 'aggregate')) else 0
+        self.timeVector = (np.arange(self.nDownsampled) * downsampleRatio + firstSample - int(round(self.nSamples * self.pretrig))) * self.actualSamplingInterval
+        self.timeVector.setflags(write=False)
 
     def getMetadata(self):
         """
@@ -170,25 +481,32 @@ class ps4262:
         metadata = {"Voltage Range" : self.VRange,
         "Trigger Frequency": self.triggerFrequency,
         "Requested Sampling Interval": self.requestedSamplingInterval,
-        "Capture Time": self.tCapture}
+        "Capture Time": self.tCapture,
+        "Segments": self.nSegments,
+        "Downsample Ratio": self.downsampleRatio,
+        "Downsample Mode": self.downsampleMode}
         return metadata
 
-    def getData(self):
+    def getData(self, timeout = None):
         """
-        Returns two np arrays:
-        time in seconds since trigger (can be negative)
-        current in amps
+        Returns the oldest capture waiting in the queue as a dict with
+        time in seconds since trigger (can be negative), current in amps
+        (worked out on first use) and raw, the ADC counts it comes from
+        in rapid block mode current and raw have one row per segment
+        with analyse on there's also a summary dict (one value per segment)
+        and the waveforms may have been left out, see keepWaveforms
+        call its release() when done with raw so the buffer can be reused
+        sleeps until one arrives, or returns None after timeout seconds
         """
-        while self.data is None:
-            pass
-        retVal = self.data
-        self.data = None
+        with self.capturesCondition:
+            if not self.capturesCondition.wait_for(lambda: len(self.captures) > 0, timeout):
+                return None
+            retVal = self.captures.popleft()
+            self.capturesCondition.notify_all()
         return retVal
 
     def _run(self):
         """
-        This arms the trigger
+        This arms the trigger (for all nSegments triggers in rapid block mode)
         """
-        pretrig = 0.1  # 10% of the output data will be from before the trigger event
-        self.ps.runBlock(pretrig = pretrig, segmentIndex = 0)
-        self.timeVector = (np.arange(self.ps.noSamples) - int(round(self.ps.noSamples * pretrig))) * self.actualSamplingInterval
+        self.ps.runBlock(pretrig = self.pretrig, segmentIndex = 0)
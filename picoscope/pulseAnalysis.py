@@ -0,0 +1,81 @@
+# per trigger pulse figures of merit from ps4262 captures
+# works on one capture or a whole (nSegments, nSamples) block at once
+
+import numpy as np
+
+def _lastBefore(mask, end):
+    """index of the last True in each row of mask before column end, -1 if none"""
+    n = mask.shape[1]
+    mask = mask & (np.arange(n) < end[:, None])
+    last = n - 1 - np.argmax(mask[:, ::-1], axis=1)
+    return np.where(mask.any(axis=1), last, -1)
+
+def _firstAfter(mask, start):
+    """index of the first True in each row of mask after column start, -1 if none"""
+    mask = mask & (np.arange(mask.shape[1]) > start[:, None])
+    first = np.argmax(mask, axis=1)
+    return np.where(mask.any(axis=1), first, -1)
+
+def _crossing(y, i, level):
+    """fractional index where rows of y cross level between samples i and i + 1, nan where i is -1"""
+    rows = np.arange(y.shape[0])
+    ok = (i >= 0) & (i + 1 < y.shape[1])
+    i = np.where(ok, i, 0)
+    y0 = y[rows, i]
+    y1 = y[rows, i + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.where(y1 != y0, (level - y0) / (y1 - y0), 0.0)
+    return np.where(ok, i + frac, np.nan)
+
+def _boxcar(x, n):
+    """running mean of n samples along each row (centred, same length)"""
+    if n <= 1:
+        return x
+    c = np.cumsum(x, axis=1)
+    c = np.concatenate((np.zeros((x.shape[0], 1)), c), axis=1)
+    lo = np.clip(np.arange(x.shape[1]) - n // 2, 0, x.shape[1])
+    hi = np.clip(lo + n, 0, x.shape[1])
+    return (c[:, hi] - c[:, lo]) / (hi - lo)
+
+def analyse(current, time, low=0.1, high=0.9, smooth=1):
+    """
+    summarises captures of current (amps, one capture per row or a single
+    1-D capture) sampled at time (seconds since trigger, negative before it)
+    returns a dict of arrays with one value per capture:
+      baseline   mean current before the trigger
+      noiseRms   rms about the baseline before the trigger
+      charge     integral of current above baseline from the trigger on (coulombs)
+      peak       largest current above baseline after the trigger
+      peakTime   when the peak happens
+      riseTime   low to high fraction of the peak on the leading edge
+      fallTime   high to low fraction of the peak on the trailing edge
+    rise and fall times are nan when the pulse doesn't cross the levels
+    smooth > 1 finds the peak and edges on a running mean of that many
+    samples, which stops noise tripping the level crossings early
+    """
+    current = np.atleast_2d(current)
+    dt = time[1] - time[0]
+    trig = int(np.searchsorted(time, 0.0))
+
+    pre = current[:, :trig]
+    baseline = pre.mean(axis=1)
+    noiseRms = pre.std(axis=1)
+
+    x = current - baseline[:, None]
+    charge = x[:, trig:].sum(axis=1) * dt
+    x = _boxcar(x, smooth)
+    iPeak = trig + np.argmax(x[:, trig:], axis=1)
+    peak = x[np.arange(x.shape[0]), iPeak]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = x / peak[:, None]
+    rise = [_crossing(y, _lastBefore(y <= level, iPeak), level) for level in (low, high)]
+    fall = [_crossing(y, _firstAfter(y <= level, iPeak) - 1, level) for level in (high, low)]
+
+    return {"baseline": baseline,
+            "noiseRms": noiseRms,
+            "charge": charge,
+            "peak": peak,
+            "peakTime": time[iPeak],
+            "riseTime": (rise[1] - rise[0]) * dt,
+            "fallTime": (fall[1] - fall[0]) * dt}
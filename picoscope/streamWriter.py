@@ -0,0 +1,157 @@
+# appends a continuous stream of raw scope samples to an HDF5 file
+# from a writer thread, the driver callback only ever copies into a ring
+
+import threading
+import time
+import h5py
+import numpy as np
+import noMetrics
+
+class StreamWriter:
+    """
+    ring of nChunks x chunkSize int16 samples between the scope's streaming
+    callback (put) and a thread that appends whole chunks to fileName
+
+    the file holds:
+      raw       int16 ADC counts, chunked and growing as the run goes
+      gaps      (raw index, samples lost) for every time the ring was full,
+                the samples before raw index are followed by the lost ones
+      overRange (raw index, samples) of blocks the scope flagged as over range
+    and attributes sampleInterval, startTime (unix time of sample 0) and
+    ampsPerCount/ampsOffset to turn counts into current, use load() to get
+    times that account for the gaps
+    """
+    def __init__(self, fileName, sampleInterval, ampsPerCount, ampsOffset=0.0, chunkSize=2**16, nChunks=64, flushInterval=1.0, metrics=noMetrics):
+        self.fileName = fileName
+        self.metrics = metrics # or the repo's metrics module to time the disk writes
+        self.sampleInterval = sampleInterval
+        self.chunkSize = int(chunkSize)
+        self.capacity = self.chunkSize * int(nChunks)
+        self.flushInterval = flushInterval
+        self.ring = np.empty(self.capacity, dtype=np.int16)
+        # only put() moves head and only the writer moves tail, so neither needs a lock
+        self.head = 0 # samples ever accepted into the ring
+        self.tail = 0 # samples ever written out
+        self.nLost = 0 # samples dropped because the ring was full
+        self.gaps = [] # (raw index, samples lost) not yet written out
+        self.overRange = [] # (raw index, samples) not yet written out
+        self.chunkReady = threading.Event()
+        self.running = True
+
+        self.f = h5py.File(fileName, 'w')
+        self.raw = self.f.create_dataset('raw', shape=(0,), maxshape=(None,), dtype=np.int16, chunks=(self.chunkSize,))
+        self.gapTable = self.f.create_dataset('gaps', shape=(0, 2), maxshape=(None, 2), dtype=np.int64, chunks=(1024, 2))
+        self.overRangeTable = self.f.create_dataset('overRange', shape=(0, 2), maxshape=(None, 2), dtype=np.int64, chunks=(1024, 2))
+        self.f.attrs['sampleInterval'] = sampleInterval
+        self.f.attrs['ampsPerCount'] = ampsPerCount
+        self.f.attrs['ampsOffset'] = ampsOffset
+        self.startTime = None
+
+        self.writer = threading.Thread(name='streamWriter', target=self._writeLoop, daemon=True)
+        self.writer.start()
+
+    def put(self, samples, overRange=False):
+        """
+        copies a block of samples into the ring, called from the driver callback
+        never waits: if the writer is too far behind the block is dropped and
+        recorded as a gap
+        """
+        n = len(samples)
+        if self.startTime is None:
+            # first sample's time, back dated by the length of this block
+            self.startTime = time.time() - n * self.sampleInterval
+        self.metrics.count('streamWriter.samples', n)
+        if self.head + n - self.tail > self.capacity:
+            self.nLost = self.nLost + n
+            self.metrics.count('streamWriter.samplesLost', n)
+            if self.gaps and self.gaps[-1][0] == self.head:
+                self.gaps[-1] = (self.head, self.gaps[-1][1] + n)
+            else:
+                self.gaps.append((self.head, n))
+            return
+        if overRange:
+            self.overRange.append((self.head, n))
+        start = self.head % self.capacity
+        m = min(n, self.capacity - start)
+        self.ring[start:start+m] = samples[:m]
+        self.ring[:n-m] = samples[m:]
+        self.head = self.head + n
+        if self.head - self.tail >= self.chunkSize:
+            self.chunkReady.set()
+
+    def close(self):
+        """writes out what's left in the ring and closes the file"""
+        if not self.running:
+            return
+        self.running = False
+        self.chunkReady.set()
+        self.writer.join()
+        self.f.close()
+
+    def _writeLoop(self):
+        """writer thread, appends whole chunks (and whatever's left at the end)"""
+        lastFlush = time.monotonic()
+        while True:
+            self.chunkReady.wait(self.flushInterval)
+            self.chunkReady.clear()
+            running = self.running
+            head = self.head
+            if running:
+                # only whole chunks while running so the file's chunks line up
+                head = head - (head - self.tail) % self.chunkSize
+            if head > self.tail:
+                with self.metrics.timer('streamWriter.diskWrite'):
+                    self._append(head)
+            if (not running) or (time.monotonic() - lastFlush >= self.flushInterval):
+                with self.metrics.timer('streamWriter.diskFlush'):
+                    self._appendTables()
+                    self.f.flush()
+                lastFlush = time.monotonic()
+            if not running:
+                break
+
+    def _append(self, head):
+        """moves ring samples up to head into the file"""
+        n = head - self.tail
+        end = self.raw.shape[0]
+        self.raw.resize((end + n,))
+        start = self.tail % self.capacity
+        m = min(n, self.capacity - start)
+        self.raw[end:end+m] = self.ring[start:start+m]
+        if m < n:
+            self.raw[end+m:end+n] = self.ring[:n-m]
+        self.tail = head
+
+    def _appendTables(self):
+        """writes out the gap and over range records gathered so far"""
+        if self.startTime is not None:
+            self.f.attrs['startTime'] = self.startTime
+        for (table, rows) in ((self.gapTable, self.gaps), (self.overRangeTable, self.overRange)):
+            # keep the last gap back while it may still be growing
+            nRows = len(rows) - 1 if (rows is self.gaps and self.running) else len(rows)
+            if nRows > 0:
+                end = table.shape[0]
+                table.resize((end + nRows, 2))
+                table[end:] = rows[:nRows]
+                del rows[:nRows]
+
+def load(fileName, start=0, stop=None):
+    """
+    reads samples start to stop of a stream file, returns a dict with
+    time (seconds since startTime, gaps accounted for), current in amps,
+    and the file's gaps and overRange tables and attributes
+    """
+    with h5py.File(fileName, 'r') as f:
+        raw = f['raw'][start:stop]
+        gaps = f['gaps'][:]
+        data = {"gaps": gaps, "overRange": f['overRange'][:], "attrs": dict(f.attrs)}
+    attrs = data["attrs"]
+    index = np.arange(start, start + len(raw), dtype=np.int64)
+    if len(gaps) > 0:
+        # every sample is late by the samples lost at or before its raw index
+        lost = np.cumsum(gaps[:, 1])
+        before = np.searchsorted(gaps[:, 0], index, side='right')
+        index = index + np.concatenate(([0], lost))[before]
+    data["time"] = index * attrs['sampleInterval']
+    data["current"] = raw * attrs['ampsPerCount'] - attrs['ampsOffset']
+    return data
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 from ps4262 import ps4262
-import pylab as plt
+from livePlot import LivePlot
 import time
 
 voltageRange = 5 # volts
@@ -11,34 +11,27 @@ triggersPerMinute = 30
 
 ps = ps4262(VRange = voltageRange, requestedSamplingInterval = requestedSamplingInterval, tCapture = captureDuration, triggersPerMinute = triggersPerMinute)
 ps.ps.getAllUnitInfo()
-print (ps.getMetatada())
+print (ps.getMetadata())
 
-def plot(x,y):
-    plt.ion()
-    plt.figure()
-    plt.plot(x, y*1e9)
-    plt.grid(True)
-    plt.title("Picoscope 4000 waveform")
-    plt.ylabel("Current [nA]")
-    plt.xlabel("Time [s]")
-    #plt.legend()
-    plt.show()
-    plt.pause(.001)
+# one window, showing the average of the last 5 captures
+plot = LivePlot(nTraces = 5, average = True)
 
 i = 0
 while i < 5:
-    i = i + 1
     print("Waiting for data...")
-    while not ps.isReady():
-        pass
+    data = ps.getData(timeout = 0.1)
+    if data is None:
+        plot.pause(0.05) # keep the window alive while we wait
+        continue
+    i = i + 1
     print("Data ready!")
-    data = ps.getData() # this call will block until data is ready
-    x = data["time"]
-    y = data["current"]
     # plot the data
-    plot(x,y)
+    plot.push(data)
+    data.release() # the plot keeps its own cut down copy
+    plot.pause(0.001)
 
-# clean up the picoscope by deleting it which calls its deconstructor
+# clean up the picoscope by stopping it and deleting it which calls its deconstructor
+ps.stop()
 del(ps)
 
-time.sleep(30) # give the user a chance to look at the plots
+plot.pause(30) # give the user a chance to look at the plots
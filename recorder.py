@@ -0,0 +1,129 @@
+# writes (time, current) readings to disk from a background thread
+# so acquisition never waits on the file
+
+import threading
+import struct
+import numpy as np
+import metrics
+
+class Recorder:
+  """buffers (time, current) pairs in a ring and writes them out on a writer thread
+  a fileName ending in .npy is a float64 (n,2) array whose header is kept up to
+  date on every flush, so the file loads with numpy.load even mid-run,
+  anything else gets "time, current" text lines
+  """
+  headerLength = 128 # bytes reserved for the .npy header so it can be rewritten in place
+  def __init__(self, fileName, capacity=2**16, flushInterval=1.0):
+    """opens fileName and starts the writer thread
+    capacity is how many readings the ring holds, flushInterval is in seconds
+    """
+    self.fileName = fileName
+    self.binary = fileName.endswith('.npy')
+    self.capacity = int(capacity)
+    self.flushInterval = flushInterval
+    self.ring = np.empty((self.capacity, 2))
+    self.head = 0 # readings ever put in the ring
+    self.tail = 0 # readings ever written out
+    self.nStalls = 0 # times record() had to wait for the writer
+    self.cond = threading.Condition()
+    self.running = True
+
+    if self.binary:
+      self.fp = open(fileName, mode='wb')
+      self._writeHeader()
+    else:
+      self.fp = open(fileName, mode='w')
+    self.writer = threading.Thread(name='recorder', target=self._writeLoop, daemon=True)
+    self.writer.start()
+
+  def __del__(self):
+    try:
+      self.close()
+    except:
+      pass
+
+  def close(self):
+    """writes out whatever is still in the ring and closes the file
+    """
+    with self.cond:
+      if not self.running:
+        return
+      self.running = False
+      self.cond.notify_all()
+    self.writer.join()
+    self.fp.close()
+
+  def record(self, t, current):
+    """adds one reading
+    """
+    self.recordMany(np.array([t]), np.array([current]))
+
+  def recordMany(self, times, currents):
+    """adds a block of readings
+    """
+    n = len(times)
+    done = 0
+    with self.cond:
+      while done < n:
+        while self.head - self.tail == self.capacity:
+          # only if the disk can't keep up at all
+          self.nStalls = self.nStalls + 1
+          metrics.count('recorder.stalls')
+          self.cond.notify_all()
+          self.cond.wait()
+        start = self.head % self.capacity
+        m = min(n - done, self.capacity - (self.head - self.tail), self.capacity - start)
+        self.ring[start:start+m, 0] = times[done:done+m]
+        self.ring[start:start+m, 1] = currents[done:done+m]
+        self.head = self.head + m
+        done = done + m
+      if self.head - self.tail >= self.capacity // 2:
+        self.cond.notify_all()
+
+  def _writeLoop(self):
+    """writer thread, empties the ring every flushInterval or when it's half full
+    """
+    while True:
+      with self.cond:
+        if self.running and (self.head - self.tail < self.capacity // 2):
+          self.cond.wait(self.flushInterval)
+        (head, tail, running) = (self.head, self.tail, self.running)
+      while tail < head:
+        start = tail % self.capacity
+        m = min(head - tail, self.capacity - start)
+        # the producer only writes past head, so this slice is ours until tail moves
+        with metrics.timer('recorder.diskWrite'):
+          self._writeBlock(self.ring[start:start+m])
+        tail = tail + m
+      with metrics.timer('recorder.diskFlush'):
+        self._flush(tail)
+      with self.cond:
+        self.tail = tail
+        self.cond.notify_all()
+      if not running:
+        break
+
+  def _writeBlock(self, block):
+    """appends rows of readings to the file
+    """
+    if self.binary:
+      self.fp.write(block.astype('<f8', copy=False).tobytes())
+    else:
+      self.fp.writelines('{:}, {:}\n'.format(t, current) for (t, current) in block)
+
+  def _flush(self, nRows):
+    """pushes the file to disk with the header saying it holds nRows readings
+    """
+    if self.binary:
+      end = self.fp.tell()
+      self._writeHeader(nRows)
+      self.fp.seek(end)
+    self.fp.flush()
+
+  def _writeHeader(self, nRows=0):
+    """writes a fixed length .npy (version 1.0) header at the start of the file
+    """
+    header = "{{'descr': '<f8', 'fortran_order': False, 'shape': ({:}, 2), }}".format(nRows)
+    header = header.ljust(self.headerLength - 10 - 1) + '\n'
+    self.fp.seek(0)
+    self.fp.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
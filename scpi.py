@@ -0,0 +1,524 @@
+# serial SCPI transport shared by the keithley drivers
+
+import serial
+import logging
+import threading
+import time
+import queue
+import asyncio
+from concurrent.futures import Future
+import numpy as np
+import metrics
+
+log = logging.getLogger(__name__)
+
+def _queryName(cmd):
+  """metrics timer name for a query, by its first header"""
+  first = cmd.split(';', 1)[0].split(' ', 1)[0]
+  return('scpi.query ' + first + (';...' if ';' in cmd else ''))
+
+class SerialTransport:
+  """blocking SCPI transport over a serial port
+  every query waits for its reply before returning
+  """
+  port = None
+  depth = 1 # queries in flight at once
+  # sent on the same line as the sync command, only that line's reply ends in its answer
+  syncMarker = ('*OPC?', '1')
+  desynced = False # a reply went missing, so replies can't be matched to queries until a sync
+  def __init__(self, port='/dev/ttyUSB0', baud=57600, timeout=30):
+    """opens the serial port
+    """
+    self.port = serial.Serial(port,baud,timeout=timeout)
+    self.writeLock = threading.Lock()
+
+  def close(self):
+    """closes the serial port
+    """
+    self.port.close()
+
+  def sync(self,cmd='*IDN?',isReply=None,deadline=2.0):
+    """Drops stale input and resynchronizes with the instrument
+    sends cmd and discards lines until its reply (isReply(reply) true, any reply when
+    isReply is None) comes back, giving up after deadline seconds
+    returns cmd's reply, or the last line read if it never came
+    """
+    with self.writeLock:
+      return(self._sync(cmd, isReply, deadline))
+
+  def _sync(self,cmd,isReply,deadline):
+    """sync() for a caller that holds writeLock
+    """
+    line = ''
+    self.desynced = True
+    oldTimeout = self.port.timeout
+    self.port.reset_input_buffer() # whatever already arrived goes in one go
+    # but a stale reply can still be on its way, the marker's answer on the
+    # end of the line tells this sync's reply apart from it
+    self.port.write((cmd + ';' + self.syncMarker[0]).encode('utf-8') + b'\n')
+    end = time.monotonic() + deadline
+    try:
+      while True:
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+          break
+        self.port.timeout = remaining # pyserial won't take a negative one
+        line = self.port.readline().decode('utf-8', errors='replace')
+        (reply, sep, marker) = line.strip().rpartition(';')
+        if (sep != '') and (marker == self.syncMarker[1]) and ((isReply is None) or isReply(reply)):
+          line = reply + '\r\n'
+          self.desynced = False
+          break
+    finally:
+      self.port.timeout = oldTimeout
+    return(line)
+
+  def _resync(self):
+    """Gets back in step after a lost reply, the caller holds writeLock
+    raises TimeoutError if the instrument doesn't answer
+    """
+    log.warning('resynchronizing with the instrument on %s after a lost reply', self.port.port)
+    metrics.count('scpi.resyncs')
+    self._sync('*OPC?', None, self.port.timeout)
+    if self.desynced:
+      raise TimeoutError('lost track of the replies on {:} and could not resync'.format(self.port.port))
+
+  def _writeLine(self,cmd):
+    """Puts one command line on the wire, the caller holds writeLock
+    """
+    toSend = cmd.encode('utf-8') + b'\n'
+    with metrics.timer('scpi.serialWrite'):
+      self.port.write(toSend)
+    metrics.count('scpi.lines')
+    metrics.count('scpi.bytesOut', len(toSend))
+
+  def write(self,cmd):
+    """Send one command line
+    """
+    with self.writeLock:
+      self._writeLine(cmd)
+
+  def _readReply(self,nVals=None,dtype=None,parse=None,timeout=None):
+    """Reads one reply off the port
+    text replies come back decoded, nVals binary values (#0 block) as a numpy array
+    """
+    if timeout is not None:
+      oldTimeout = self.port.timeout
+      self.port.timeout = max(oldTimeout, timeout)
+    try:
+      with metrics.timer('scpi.serialRead'):
+        if nVals is None:
+          raw = self.port.readline()
+          if not raw.endswith(b'\n'):
+            metrics.count('scpi.timeouts')
+            raise TimeoutError('no complete reply within {:} s'.format(self.port.timeout))
+          ret = raw.decode('utf-8')
+        else:
+          ret = self._readBinary(nVals, dtype)
+    finally:
+      if timeout is not None:
+        self.port.timeout = oldTimeout
+    if metrics.enabled:
+      if nVals is None:
+        metrics.count('scpi.bytesIn', len(raw))
+      else:
+        metrics.count('scpi.bytesIn', 2 + ret.nbytes)
+    if parse is not None:
+      with metrics.timer('scpi.parse'):
+        ret = parse(ret)
+    return(ret)
+
+  def _readBinary(self,nVals,dtype):
+    """Reads a #0 binary block of nVals values of dtype
+    """
+    dtype = np.dtype(dtype)
+    header = self.port.read(2)
+    if header != b'#0':
+      log.error('got unexpected binary block header %r', header)
+      metrics.count('scpi.badReplies')
+    payload = self.port.read(nVals * dtype.itemsize)
+    if (len(payload) < nVals * dtype.itemsize) or not self.port.readline().endswith(b'\n'): # eat the terminator
+      metrics.count('scpi.timeouts')
+      raise TimeoutError('got {:} of {:} binary reply bytes within {:} s'.format(len(payload), nVals * dtype.itemsize, self.port.timeout))
+    return(np.frombuffer(payload, dtype=dtype))
+
+  def submit(self,cmd,nVals=None,dtype=None,parse=None,timeout=None):
+    """Sends a query and returns a Future for its (optionally parsed) reply
+    this transport has no pipeline, so the future is already done
+    """
+    future = Future()
+    metrics.count('scpi.queries')
+    try:
+      with self.writeLock:
+        if self.desynced:
+          self._resync()
+        with metrics.timer(_queryName(cmd)):
+          self._writeLine(cmd)
+          try:
+            future.set_result(self._readReply(nVals, dtype, parse, timeout))
+          except TimeoutError:
+            # its reply may still turn up and would be taken for the next one's
+            self.desynced = True
+            raise
+    except Exception as e:
+      metrics.count('scpi.errors')
+      future.set_exception(e)
+    return(future)
+
+  def query(self,cmd,timeout=None):
+    """Query with command, returns the decoded reply line
+    """
+    return(self.submit(cmd, timeout=timeout).result())
+
+  def queryBinary(self,cmd,nVals,dtype,timeout=None):
+    """Query with command, returns nVals binary values as a numpy array
+    """
+    return(self.submit(cmd, nVals=nVals, dtype=dtype, timeout=timeout).result())
+
+class PipelinedTransport(SerialTransport):
+  """SCPI transport that keeps up to depth queries in flight
+  queries are written as soon as a pipeline slot is free and a reader thread
+  matches the replies to them in the order they were sent
+  a lost reply fails every query in flight and the next submit resyncs first
+  """
+  def __init__(self, port='/dev/ttyUSB0', baud=57600, timeout=30, depth=4):
+    """opens the serial port and starts the reply reader
+    """
+    super(PipelinedTransport, self).__init__(port, baud, timeout)
+    self.depth = depth
+    self.slots = threading.BoundedSemaphore(depth)
+    self.pending = queue.Queue() # (future, nVals, dtype, parse, timeout) in send order
+    self.reader = threading.Thread(name='scpiReader', target=self._readLoop, daemon=True)
+    self.reader.start()
+
+  def close(self):
+    """stops the reader once the outstanding replies are in, then closes the port
+    """
+    self.pending.put(None)
+    self.reader.join(self.port.timeout)
+    self.port.close()
+
+  def _readLoop(self):
+    """Resolves the pending futures in order as replies arrive
+    """
+    while True:
+      item = self.pending.get()
+      if item is None:
+        break
+      (future, nVals, dtype, parse, timeout) = item
+      try:
+        future.set_result(self._readReply(nVals, dtype, parse, timeout))
+      except Exception as e:
+        metrics.count('scpi.errors')
+        future.set_exception(e)
+        if isinstance(e, TimeoutError):
+          self._failPending()
+      finally:
+        self.slots.release()
+
+  def _failPending(self):
+    """After a lost reply none of the queries in flight can be matched to
+    theirs any more, so they all fail and submit() resyncs before the next one
+    """
+    with self.writeLock:
+      self.desynced = True
+      while True:
+        try:
+          item = self.pending.get_nowait()
+        except queue.Empty:
+          break
+        if item is None:
+          self.pending.put(None) # closing, leave it for _readLoop
+          break
+        metrics.count('scpi.errors')
+        item[0].set_exception(TimeoutError('an earlier reply went missing, this one could not be matched to its query'))
+        self.slots.release()
+
+  def submit(self,cmd,nVals=None,dtype=None,parse=None,timeout=None):
+    """Sends a query and returns a Future for its (optionally parsed) reply
+    blocks while depth queries are already in flight
+    """
+    future = Future()
+    metrics.count('scpi.queries')
+    if metrics.enabled:
+      # from asking for a slot to the reply, so a full pipeline shows up too
+      t0 = time.perf_counter()
+      name = _queryName(cmd)
+      future.add_done_callback(lambda f: metrics.observe(name, time.perf_counter() - t0))
+    self.slots.acquire()
+    with self.writeLock:
+      if self.desynced:
+        # nothing is in flight now, _failPending emptied the queue
+        try:
+          self._resync()
+        except Exception as e:
+          self.slots.release()
+          metrics.count('scpi.errors')
+          future.set_exception(e)
+          return(future)
+      # queue before writing so the reader can't see the reply first
+      self.pending.put((future, nVals, dtype, parse, timeout))
+      self._writeLine(cmd)
+    return(future)
+
+class AsyncTransport:
+  """asyncio SCPI transport
+  the event loop watches the serial port, so waiting on one instrument
+  never holds up the others sharing the loop
+  """
+  port = None
+  depth = 1
+  syncMarker = SerialTransport.syncMarker
+  desynced = False # a reply went missing, so replies can't be matched to queries until a sync
+  def __init__(self, port='/dev/ttyUSB0', baud=57600, timeout=30):
+    """opens the serial port, call from inside the running event loop
+    """
+    self.port = serial.Serial(port,baud,timeout=0)
+    self.timeout = timeout
+    self.rx = bytearray()
+    self.rxEvent = asyncio.Event()
+    self.lock = asyncio.Lock()
+    self.loop = asyncio.get_running_loop()
+    self.loop.add_reader(self.port.fileno(), self._onReadable)
+
+  def close(self):
+    """stops watching and closes the serial port
+    """
+    try:
+      self.loop.remove_reader(self.port.fileno())
+    except:
+      pass
+    self.port.close()
+
+  def _onReadable(self):
+    """event loop callback, moves whatever arrived into the receive buffer
+    """
+    with metrics.timer('scpi.serialRead'):
+      got = self.port.read(max(self.port.in_waiting, 1))
+    metrics.count('scpi.bytesIn', len(got))
+    self.rx += got
+    self.rxEvent.set()
+
+  def _writeLine(self,cmd):
+    """Puts one command line on the wire, the caller holds lock
+    """
+    toSend = cmd.encode('utf-8') + b'\n'
+    with metrics.timer('scpi.serialWrite'):
+      self.port.write(toSend)
+    metrics.count('scpi.lines')
+    metrics.count('scpi.bytesOut', len(toSend))
+
+  async def _waitFor(self, ready):
+    """waits until ready() says the receive buffer holds enough
+    """
+    while not ready():
+      self.rxEvent.clear()
+      await self.rxEvent.wait()
+
+  async def _readReply(self,nVals=None,dtype=None,parse=None):
+    """Reads one reply out of the receive buffer
+    """
+    if nVals is None:
+      await self._waitFor(lambda: b'\n' in self.rx)
+      end = self.rx.index(b'\n') + 1
+      ret = bytes(self.rx[:end]).decode('utf-8')
+      del self.rx[:end]
+    else:
+      dtype = np.dtype(dtype)
+      nBytes = 2 + nVals * dtype.itemsize
+      await self._waitFor(lambda: len(self.rx) >= nBytes and b'\n' in self.rx[nBytes:])
+      if bytes(self.rx[:2]) != b'#0':
+        log.error('got unexpected binary block header %r', bytes(self.rx[:2]))
+        metrics.count('scpi.badReplies')
+      ret = np.frombuffer(bytes(self.rx[2:nBytes]), dtype=dtype)
+      del self.rx[:self.rx.index(b'\n', nBytes) + 1] # eat the terminator too
+    if parse is not None:
+      with metrics.timer('scpi.parse'):
+        ret = parse(ret)
+    return(ret)
+
+  async def sync(self,cmd='*IDN?',isReply=None,deadline=2.0):
+    """Drops stale input and resynchronizes with the instrument
+    sends cmd and discards lines until its reply (isReply(reply) true, any reply when
+    isReply is None) comes back, giving up after deadline seconds
+    returns cmd's reply, or the last line read if it never came
+    """
+    async with self.lock:
+      return(await self._sync(cmd, isReply, deadline))
+
+  async def _sync(self,cmd,isReply,deadline):
+    """sync() for a caller that holds lock
+    """
+    line = ''
+    self.desynced = True
+    self.port.reset_input_buffer()
+    self.rx.clear()
+    # a stale reply can still be on its way, the marker's answer on the
+    # end of the line tells this sync's reply apart from it
+    self.port.write((cmd + ';' + self.syncMarker[0]).encode('utf-8') + b'\n')
+    end = self.loop.time() + deadline
+    while self.loop.time() < end:
+      try:
+        line = await asyncio.wait_for(self._readReply(), end - self.loop.time())
+      except asyncio.TimeoutError:
+        break
+      (reply, sep, marker) = line.strip().rpartition(';')
+      if (sep != '') and (marker == self.syncMarker[1]) and ((isReply is None) or isReply(reply)):
+        line = reply + '\r\n'
+        self.desynced = False
+        break
+    return(line)
+
+  async def write(self,cmd):
+    """Send one command line
+    """
+    async with self.lock:
+      self._writeLine(cmd)
+
+  async def ask(self,cmd,nVals=None,dtype=None,parse=None,timeout=None):
+    """Sends a query and waits for its (optionally parsed) reply
+    raises asyncio.TimeoutError if it takes longer than the timeout
+    """
+    if timeout is None:
+      timeout = self.timeout
+    else:
+      timeout = max(self.timeout, timeout)
+    metrics.count('scpi.queries')
+    async with self.lock:
+      if self.desynced:
+        log.warning('resynchronizing with the instrument on %s after a lost reply', self.port.port)
+        metrics.count('scpi.resyncs')
+        await self._sync('*OPC?', None, timeout)
+        if self.desynced:
+          raise asyncio.TimeoutError('lost track of the replies on {:} and could not resync'.format(self.port.port))
+      with metrics.timer(_queryName(cmd)):
+        self._writeLine(cmd)
+        try:
+          return(await asyncio.wait_for(self._readReply(nVals, dtype, parse), timeout))
+        except asyncio.TimeoutError:
+          # its reply may still turn up and would be taken for the next one's
+          self.desynced = True
+          metrics.count('scpi.timeouts')
+          raise
+
+  async def query(self,cmd,timeout=None):
+    """Query with command, returns the decoded reply line
+    """
+    return(await self.ask(cmd, timeout=timeout))
+
+  async def queryBinary(self,cmd,nVals,dtype,timeout=None):
+    """Query with command, returns nVals binary values as a numpy array
+    """
+    return(await self.ask(cmd, nVals=nVals, dtype=dtype, timeout=timeout))
+
+class ScpiState:
+  """what an instrument has been configured with, header -> value
+  lets a setup send only the settings that differ, batched onto as few lines as possible
+  commands with a value are settings, the rest (*RST, INIT, ...) are actions and always go out
+  """
+  maxLineLength = 200 # characters per batched command line
+  def __init__(self):
+    self.settings = {}
+    self.known = False # True once settings can be trusted (seeded or reset)
+    self.seedHeaders = []
+
+  def forget(self):
+    """nothing is known about the instrument any more
+    """
+    self.settings = {}
+    self.known = False
+
+  def reset(self):
+    """the instrument was just *RST, so every setting has to be sent again
+    """
+    self.settings = {}
+    self.known = True
+
+  def _split(self, cmd):
+    """(normalized header, value) of a command, value is None for actions
+    """
+    if ' ' in cmd.strip():
+      (header, value) = cmd.strip().split(' ', 1)
+      return(header.upper().lstrip(':'), value.strip())
+    return(cmd.strip().upper().lstrip(':'), None)
+
+  def _same(self, a, b):
+    """compares two setting values the way the instrument means them
+    numbers numerically, ON/OFF as 1/0, and mnemonics by their short form
+    """
+    if (a is None) or (b is None):
+      return(False)
+    a = a.replace(' ', '').replace('"', '').upper().split(',')
+    b = b.replace(' ', '').replace('"', '').upper().split(',')
+    if len(a) != len(b):
+      return(False)
+    onOff = {'ON': '1', 'OFF': '0'}
+    for (x, y) in zip(a, b):
+      x = onOff.get(x, x)
+      y = onOff.get(y, y)
+      try:
+        if abs(float(x) - float(y)) > 1e-9 * max(abs(float(x)), abs(float(y))):
+          return(False)
+        continue
+      except ValueError:
+        pass
+      if not (x.startswith(y) or y.startswith(x)):
+        return(False)
+    return(True)
+
+  def isSet(self, header, value):
+    """True if header is known to be at value
+    """
+    return(self._same(self.settings.get(header.upper().lstrip(':')), value))
+
+  def seedQuery(self, cmds):
+    """one compound query that reads back every setting in cmds
+    """
+    headers = []
+    for cmd in cmds:
+      (header, value) = self._split(cmd)
+      if (value is not None) and (header not in headers):
+        headers.append(header)
+    self.seedHeaders = headers
+    return(';'.join(':' + header + '?' for header in headers))
+
+  def seed(self, reply):
+    """takes the reply to seedQuery() as what the instrument is set to
+    a reply that doesn't line up leaves nothing known, so everything gets sent
+    """
+    vals = reply.strip().split(';')
+    self.settings = {}
+    if len(vals) == len(self.seedHeaders):
+      self.settings = dict(zip(self.seedHeaders, vals))
+    self.known = True
+
+  def changed(self, cmds):
+    """the commands in cmds that actually change something, in order
+    assumes they will be sent and records the new settings
+    """
+    toSend = []
+    for cmd in cmds:
+      (header, value) = self._split(cmd)
+      if value is None:
+        toSend.append(cmd.strip())
+      elif not (self.known and self._same(self.settings.get(header), value)):
+        toSend.append(cmd.strip())
+        self.settings[header] = value
+    return(toSend)
+
+  def batch(self, cmds):
+    """joins cmds into ;-separated lines no longer than maxLineLength
+    """
+    lines = []
+    line = ''
+    for cmd in cmds:
+      # a leading : keeps each command rooted at the top of the tree
+      if not (cmd.startswith(':') or cmd.startswith('*')):
+        cmd = ':' + cmd
+      if (line != '') and (len(line) + 1 + len(cmd) > self.maxLineLength):
+        lines.append(line)
+        line = ''
+      line = cmd if line == '' else line + ';' + cmd
+    if line != '':
+      lines.append(line)
+    return(lines)